@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+
+""" Local performance benchmarks for the UserApp client. """
+
+import os,sys,inspect
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+parentdir = os.path.dirname(currentdir)
+sys.path.insert(0,parentdir)
+
+import gc
+import json
+import time
+import shutil
+import tempfile
+import subprocess
+import userapp
+import stub_server
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def search_result(users=500):
+    """
+    A user.search result with deep properties/permissions trees.
+    """
+    return {
+        'items': [{
+            'user_id': 'user{i}'.format(i=i),
+            'login': 'user{i}@example.com'.format(i=i),
+            'email': 'user{i}@example.com'.format(i=i),
+            'first_name': 'First',
+            'last_name': 'Last',
+            'properties': dict(('property{p}'.format(p=p), {'value': p, 'override': False}) for p in range(10)),
+            'permissions': dict(('permission{p}'.format(p=p), {'value': p % 2 == 0, 'override': False}) for p in range(10)),
+            'features': dict(('feature{p}'.format(p=p), {'value': True, 'override': False}) for p in range(5)),
+            'locks': [],
+            'created_at': 1400000000 + i
+        } for i in range(users)],
+        'total_items': users
+    }
+
+def measure(fn, repeat=20):
+    """
+    Run fn repeat times, returning (best seconds per call, peak bytes allocated).
+    """
+    best = None
+
+    for i in range(repeat):
+        gc.collect()
+        start = time.time()
+        fn()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    peak = None
+
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+        result = fn()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+    return best, peak
+
+def report(name, best, peak):
+    print("{n:<40} {t:>10.3f} ms {m:>12}".format(
+        n=name,
+        t=best * 1000,
+        m='-' if peak is None else '{k:.0f} KiB'.format(k=peak / 1024.0)
+    ))
+
+def bench_response_objects():
+    data = search_result()
+    raw = json.dumps(data)
+
+    print("Response objects ({n} users)".format(n=len(data['items'])))
+
+    report('to_object', *measure(lambda: userapp.DictionaryUtility.to_object(json.loads(raw))))
+    report('to_lazy_object + first field', *measure(lambda: userapp.DictionaryUtility.to_lazy_object(json.loads(raw)).items[0].user_id))
+
+    eager = userapp.DictionaryUtility.to_object(json.loads(raw))
+    lazy = userapp.DictionaryUtility.to_lazy_object(json.loads(raw))
+
+    report('to_dict (eager)', *measure(lambda: eager.to_dict()))
+    report('to_json (eager)', *measure(lambda: eager.to_json()))
+    report('to_dict (lazy)', *measure(lambda: lazy.to_dict()))
+    report('to_json (lazy)', *measure(lambda: lazy.to_json()))
+
+def single_pass_hook(data):
+    """
+    object_hook building response objects while decoding, for comparison
+    with decoding first and converting the result afterwards.
+    """
+    cache = None
+
+    for key, value in data.items():
+        if isinstance(value, (userapp.IterableObject, list)):
+            value = value if isinstance(value, userapp.IterableObject) else single_pass_list(value)
+            cache = cache if cache is not None else {}
+            cache[key] = value
+            data[key] = value.source
+
+    result = userapp.IterableObject(data)
+    object.__setattr__(result, '_cache', cache)
+    return result
+
+def single_pass_list(values):
+    values = [single_pass_list(value) if isinstance(value, list) else value for value in values]
+    return userapp.IterableList([userapp.DictionaryUtility.unwrap(value) for value in values], values)
+
+def bench_codecs():
+    data = search_result()
+    codecs = [userapp.JsonCodec()]
+
+    if userapp.import_orjson() is not None:
+        codecs.append(userapp.OrjsonCodec())
+
+    raw = codecs[0].dumps(data).encode('utf-8')
+
+    print("Codecs ({n} users, {k:.0f} KiB)".format(n=len(data['items']), k=len(raw) / 1024.0))
+
+    for codec in codecs:
+        report('{c}: dumps'.format(c=codec.name), *measure(lambda: codec.dumps(data)))
+        report('{c}: loads'.format(c=codec.name), *measure(lambda: codec.loads(raw)))
+        report('{c}: loads + to_object'.format(c=codec.name), *measure(lambda: userapp.DictionaryUtility.to_object(codec.loads(raw))))
+        report('{c}: loads + to_lazy_object'.format(c=codec.name), *measure(lambda: userapp.DictionaryUtility.to_lazy_object(codec.loads(raw))))
+
+    report('json: single pass (object_hook)', *measure(lambda: json.loads(raw.decode('utf-8'), object_hook=single_pass_hook)))
+
+class NoopResponse(object):
+    status_code = 200
+    text = '{"user_id":"Bob"}'
+    content = b'{"user_id":"Bob"}'
+
+    def json(self):
+        return {'user_id': 'Bob'}
+
+class NoopTransport(object):
+    """
+    Answers every call without doing any I/O, leaving only client overhead.
+    """
+    response = NoopResponse()
+
+    def call(self, method, url, headers=None, body=None):
+        return self.response
+
+def bench_call_overhead(calls=20000):
+    api = userapp.API(app_id='benchmark', token='token', transport=NoopTransport())
+
+    def run():
+        for i in range(calls):
+            api.user.get(user_id='Bob')
+
+    best, peak = measure(run, repeat=5)
+
+    print("Client overhead ({n} calls, no-op transport)".format(n=calls))
+    print("{n:<40} {t:>10.2f} us".format(n='per call', t=best / calls * 1000000))
+    print("{n:<40} {t:>10.0f}".format(n='calls/sec', t=calls / best))
+
+# Budgets enforced by bench_startup, main exits non-zero when one is exceeded
+IMPORT_BUDGET = 0.05
+CONSTRUCT_BUDGET = 0.00005
+
+def time_in_subprocess(script, repeat=10):
+    """
+    Best time printed by script run in a fresh interpreter. Bytecode is
+    written and reused between runs, like an installed package.
+    """
+    env = dict(os.environ)
+    env.pop('PYTHONDONTWRITEBYTECODE', None)
+    times = []
+
+    for i in range(repeat + 1):
+        output = subprocess.check_output([sys.executable, '-c', script], cwd=parentdir, env=env)
+        times.append(float(output.decode('utf-8').strip()))
+
+    # The first run compiles the bytecode
+    return min(times[1:])
+
+def bench_startup():
+    """
+    Cold start: importing userapp, constructing an API and making the first
+    call, which is when the transport imports its HTTP library.
+    """
+    server = stub_server.StubServer().start()
+    server.on('user.get', [{'user_id': 'Bob'}])
+    exceeded = []
+
+    try:
+        import_time = time_in_subprocess("import time; start = time.time(); import userapp; print(time.time() - start)")
+        requests_time = time_in_subprocess("import time; start = time.time(); import requests; print(time.time() - start)")
+
+        print("Startup")
+        print("{n:<40} {t:>10.3f} ms (budget {b:.0f} ms)".format(n='import userapp', t=import_time * 1000, b=IMPORT_BUDGET * 1000))
+        print("{n:<40} {t:>10.3f} ms".format(n='import requests (deferred)', t=requests_time * 1000))
+
+        if import_time > IMPORT_BUDGET:
+            exceeded.append('import userapp')
+
+        constructions = 10000
+
+        def construct():
+            for i in range(constructions):
+                userapp.API(app_id='benchmark', token='token')
+
+        best, peak = measure(construct, repeat=5)
+
+        print("{n:<40} {t:>10.2f} us (budget {b:.0f} us)".format(n='API(...)', t=best / constructions * 1000000, b=CONSTRUCT_BUDGET * 1000000))
+
+        if best / constructions > CONSTRUCT_BUDGET:
+            exceeded.append('API(...)')
+
+        for transport in ['NativeTransport', 'HttpClientTransport']:
+            first_call = time_in_subprocess((
+                "import time, userapp\n"
+                "api = userapp.API(app_id='benchmark', base_address='{a}', secure=False, transport_class=userapp.{t})\n"
+                "start = time.time()\n"
+                "api.user.get(user_id='Bob')\n"
+                "print(time.time() - start)\n"
+            ).format(a=server.address, t=transport), repeat=5)
+
+            print("{n:<40} {t:>10.3f} ms".format(n='first call, {t}'.format(t=transport), t=first_call * 1000))
+    finally:
+        server.stop()
+
+    for name in exceeded:
+        print("Over budget: {n}".format(n=name))
+
+    return exceeded
+
+class NoopClient(object):
+    """
+    Returns from every call at once, leaving only proxy dispatch.
+    """
+    def call(self, version, service, method, arguments, timeout=None):
+        return None
+
+def bench_dispatch(calls=200000, handles=20000, misspellings=200):
+    """
+    Compare dynamic proxies with stubs generated from the bundled schema,
+    for calls through a warm API, for the first call of new API handles,
+    and for catching a misspelled method.
+    """
+    server = stub_server.StubServer().start()
+    strict = userapp.ServiceSchema.get_default(strict=True)
+
+    print("Dispatch (api.user.invoice.search, no-op client)")
+
+    try:
+        for name, schema in [('dynamic', None), ('stubs', True)]:
+            api = userapp.API(client=NoopClient(), schema=schema)
+            api.user.invoice.search(page=1)
+
+            def warm():
+                for i in range(calls):
+                    api.user.invoice.search(page=1)
+
+            def cold():
+                for i in range(handles):
+                    userapp.API(client=NoopClient(), schema=schema).user.invoice.search(page=1)
+
+            best, peak = measure(warm, repeat=5)
+            print("{n:<40} {t:>10.2f} us".format(n='{s}: warm call'.format(s=name), t=best / calls * 1000000))
+            best, peak = measure(cold, repeat=5)
+            print("{n:<40} {t:>10.2f} us".format(n='{s}: new handle + first call'.format(s=name), t=best / handles * 1000000))
+
+        for name, schema in [('dynamic', None), ('strict stubs', strict)]:
+            api = userapp.API(app_id='benchmark', base_address=server.address, secure=False, schema=schema)
+
+            def misspelled():
+                for i in range(misspellings):
+                    try:
+                        api.user.invoice.serch()
+                    except userapp.UserAppInvalidMethodException:
+                        pass
+
+            try:
+                best, peak = measure(misspelled, repeat=3)
+            finally:
+                api.close()
+
+            print("{n:<40} {t:>10.2f} us".format(n='{s}: misspelled method'.format(s=name), t=best / misspellings * 1000000))
+    finally:
+        server.stop()
+
+def bench_export(sizes=(5000, 20000)):
+    """
+    Export users from the stub server, checking that peak memory stays
+    flat as the number of users grows.
+    """
+    template = search_result(1)['items'][0]
+    server = stub_server.StubServer().start()
+    directory = tempfile.mkdtemp()
+
+    def search(arguments, headers):
+        start = (arguments['page'] - 1) * arguments['page_size']
+        end = min(start + arguments['page_size'], server.total_users)
+        return {'items': [dict(template, user_id='user{i}'.format(i=i)) for i in range(start, end)], 'total_items': server.total_users}
+
+    server.on('user.search', search)
+    api = userapp.API(app_id='benchmark', base_address=server.address, secure=False)
+
+    print("Export (stub server, page_size=100, parallel=4)")
+
+    try:
+        for users in sizes:
+            for name in ['users.ndjson', 'users.ndjson.gz']:
+                server.total_users = users
+                path = os.path.join(directory, name)
+                exporter = userapp.UserExporter(api, page_size=100, parallel=4)
+
+                best, peak = measure(lambda: exporter.export(path, resume=False), repeat=1)
+
+                print("{n:<40} {t:>10.0f} users/s {m:>12} {s:>10.0f} KiB on disk".format(
+                    n='{u} users to {f}'.format(u=users, f=name),
+                    t=users / best,
+                    m='-' if peak is None else '{k:.0f} KiB'.format(k=peak / 1024.0),
+                    s=os.path.getsize(path) / 1024.0
+                ))
+    finally:
+        api.close()
+        server.stop()
+        shutil.rmtree(directory)
+
+    if resource is not None:
+        print("{n:<40} {m:>12.0f} KiB".format(n='peak RSS of the process', m=resource.getrusage(resource.RUSAGE_SELF).ru_maxrss))
+
+def bench_streaming(users=5000):
+    """
+    Compare reading a large search page buffered and streamed, for the
+    time until the first item is available and the peak memory of
+    reading all items.
+    """
+    payload = json.dumps(search_result(users)).encode('utf-8')
+    server = stub_server.StubServer().start()
+    server.on('user.search', lambda arguments, headers: payload)
+    api = userapp.API(app_id='benchmark', base_address=server.address, secure=False)
+
+    def buffered_first():
+        return api.user.search().items[0]
+
+    def buffered_all():
+        for item in api.user.search().items:
+            item.user_id
+
+    def streamed_first():
+        result = api.user.search.stream()
+        item = next(iter(result))
+        result.close()
+        return item
+
+    def streamed_all():
+        for item in api.user.search.stream():
+            item.user_id
+
+    print("Streaming ({n} users, {k:.0f} KiB)".format(n=users, k=len(payload) / 1024.0))
+
+    try:
+        report('buffered: first item', *measure(buffered_first, repeat=5))
+        report('buffered: all items', *measure(buffered_all, repeat=5))
+        report('streamed: first item', *measure(streamed_first, repeat=5))
+        report('streamed: all items', *measure(streamed_all, repeat=5))
+    finally:
+        api.close()
+        server.stop()
+
+def bench_compression(calls=20):
+    """
+    Call user.search and a user.save with large properties, with and
+    without compression, reporting the time per call and the share of
+    bytes saved on the wire. requests accepts compressed responses on
+    its own, so for the NativeTransport off only sends requests as is.
+    """
+    data = search_result()
+    record = {'user_id': 'user0', 'properties': dict(('property{p}'.format(p=p), {'value': 'Some text value {p}. '.format(p=p) * 20, 'override': False}) for p in range(50))}
+    server = stub_server.StubServer().start()
+    server.compression = 'gzip'
+    server.on('user.search', lambda arguments, headers: data)
+    server.on('user.save', lambda arguments, headers: arguments)
+
+    print("Compression ({c} calls of user.search with {n} users and user.save with {k:.0f} KiB of properties)".format(
+        c=calls, n=len(data['items']), k=len(json.dumps(record)) / 1024.0))
+
+    try:
+        for transport in [userapp.NativeTransport, userapp.HttpClientTransport]:
+            for compression in [None, userapp.Compression()]:
+                api = userapp.API(app_id='benchmark', base_address=server.address, secure=False, transport_class=transport, compression=compression)
+                name = '{t}, {c}'.format(t=transport.__name__, c='gzip' if compression else 'off')
+
+                try:
+                    best, peak = measure(lambda: [api.user.search() for i in range(calls)], repeat=3)
+                    report('{n}: search'.format(n=name), best / calls, peak)
+                    best, peak = measure(lambda: [api.user.save(**record) for i in range(calls)], repeat=3)
+                    report('{n}: save'.format(n=name), best / calls, peak)
+                finally:
+                    api.close()
+
+                if compression is not None:
+                    stats = compression.get_stats()
+                    print("{n:<40} {s:>10.1f} % saved".format(
+                        n='{n}: wire'.format(n=name),
+                        s=100.0 * stats['bytes_saved'] / (stats['request_bytes'] + stats['response_bytes'])
+                    ))
+    finally:
+        server.stop()
+
+def bench_bulk_write(records=2000, latency=0.002):
+    """
+    Save records through the stub server, which answers after a
+    fixed latency, with a growing number of concurrent calls.
+    """
+    def save(arguments, headers):
+        time.sleep(latency)
+        return {'user_id': arguments['user_id']}
+
+    server = stub_server.StubServer().start()
+    server.on('user.save', save)
+    api = userapp.API(app_id='benchmark', base_address=server.address, secure=False, pool_max_connections=32)
+
+    print("Bulk write ({n} records, {l:.0f} ms latency)".format(n=records, l=latency * 1000))
+
+    try:
+        for workers in [1, 8, 32]:
+            writer = userapp.BulkWriter(api, max_workers=workers)
+            stats = writer.write({'user_id': 'user{i}'.format(i=i), 'first_name': 'First'} for i in range(records))
+
+            print("{n:<40} {t:>10.0f} records/s".format(n='{w} workers'.format(w=workers), t=stats['records_per_second']))
+    finally:
+        api.close()
+        server.stop()
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(int(len(samples) * p / 100.0), len(samples) - 1)]
+
+def report_latencies(name, latencies, elapsed, peak=None):
+    print("{n:<40} {c:>8.0f} calls/s  p50 {p50:>7.3f} ms  p99 {p99:>7.3f} ms {m:>12}".format(
+        n=name,
+        c=len(latencies) / elapsed,
+        p50=percentile(latencies, 50) * 1000,
+        p99=percentile(latencies, 99) * 1000,
+        m='-' if peak is None else '{k:.0f} KiB'.format(k=peak / 1024.0)
+    ))
+
+def record_calls(path):
+    """
+    Record a mix of calls against the stub server for replaying.
+    """
+    users = search_result(50)
+    server = stub_server.StubServer().start()
+    server.on('user.get', lambda arguments, headers: [users['items'][0]])
+    server.on('user.search', users)
+    server.on('user.save', users['items'][0])
+
+    transport = userapp.RecordingTransport(userapp.NativeTransport(userapp.logging.getLogger('benchmark')), path)
+    api = userapp.API(app_id='benchmark', token='token', base_address=server.address, secure=False, transport=transport)
+
+    try:
+        api.user.get(user_id='user0')
+        api.user.search(page=1, page_size=50)
+        api.user.save(user_id='user0', first_name='First')
+    finally:
+        api.close()
+        server.stop()
+
+    return [
+        (api.user.get, {'user_id': 'user0'}),
+        (api.user.search, {'page': 1, 'page_size': 50}),
+        (api.user.save, {'user_id': 'user0', 'first_name': 'First'})
+    ]
+
+def bench_replay(calls=3000, latency=0.001):
+    """
+    Replay recorded calls with a simulated latency, for the sync client
+    calling one at a time and for concurrent calls through gather.
+    """
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'calls.ndjson')
+
+    try:
+        mix = record_calls(path)
+        api = userapp.API(app_id='benchmark', token='token', transport=userapp.ReplayTransport(path, latency=latency))
+        methods = [(getattr(api.user, method._method_name), arguments) for method, arguments in mix]
+
+        print("Replay ({n} calls of user.get/search/save, {l:.0f} ms latency)".format(n=calls, l=latency * 1000))
+
+        latencies = []
+        start = time.time()
+
+        for i in range(calls):
+            method, arguments = methods[i % len(methods)]
+            call_start = time.time()
+            method(**arguments)
+            latencies.append(time.time() - call_start)
+
+        elapsed = time.time() - start
+        peak = None
+
+        # Allocations are traced in a pass of their own, tracing slows calls down
+        if tracemalloc is not None:
+            gc.collect()
+            tracemalloc.start()
+
+            for method, arguments in methods:
+                method(**arguments)
+
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        report_latencies('sync, sequential', latencies, elapsed, peak)
+
+        for workers in [8, 32]:
+            latencies = []
+            start = time.time()
+
+            def timed(method, arguments):
+                call_start = time.time()
+                method(**arguments)
+                latencies.append(time.time() - call_start)
+
+            timed_calls = [(lambda method=method, arguments=arguments: timed(method, arguments)) for method, arguments in methods] * (calls // len(methods))
+            pool = userapp.WorkerPool(workers)
+
+            for future in pool.map(lambda fn: fn(), timed_calls):
+                future.result()
+
+            pool.shutdown()
+            report_latencies('concurrent, {w} workers'.format(w=workers), latencies, time.time() - start)
+
+        start = time.time()
+        results = api.gather([methods[i % len(methods)] for i in range(calls)], max_workers=32)
+        elapsed = time.time() - start
+
+        print("{n:<40} {c:>8.0f} calls/s".format(n='gather, 32 workers', c=len(results) / elapsed))
+    finally:
+        shutil.rmtree(directory)
+
+def main():
+    exceeded = bench_startup()
+    print("")
+    bench_response_objects()
+    print("")
+    bench_codecs()
+    print("")
+    bench_export()
+    print("")
+    bench_streaming()
+    print("")
+    bench_compression()
+    print("")
+    bench_bulk_write()
+    print("")
+    bench_call_overhead()
+    print("")
+    bench_dispatch()
+    print("")
+    bench_replay()
+
+    return 1 if exceeded else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
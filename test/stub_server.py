@@ -0,0 +1,143 @@
+""" Local stub of the UserApp API, used by the unit tests and benchmarks. """
+
+import sys
+import json
+import zlib
+import socket
+import threading
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+class StubRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        raw_body = self.rfile.read(length) if length > 0 else b''
+        size = len(raw_body)
+
+        if self.headers.get('Content-Encoding') in ('gzip', 'deflate'):
+            raw_body = zlib.decompress(raw_body, 32 + zlib.MAX_WBITS)
+
+        # Path format: /v{version}/{service}.{method}
+        path = self.path.lstrip('/')
+        version, _, call = path.partition('/')
+        service, _, method = call.rpartition('.')
+
+        try:
+            arguments = json.loads(raw_body.decode('utf-8')) if raw_body else {}
+        except ValueError:
+            arguments = None
+
+        self.server.record(dict(
+            version=version[1:],
+            service=service,
+            method=method,
+            arguments=arguments,
+            size=size,
+            headers=dict((name.lower(), value) for name, value in self.headers.items())
+        ))
+
+        status, result = self.server.handle_call(service, method, arguments, self.headers)
+
+        payload = result if isinstance(result, bytes) else json.dumps(result).encode('utf-8')
+        encoding = self.server.compression
+
+        if encoding is not None and encoding in (self.headers.get('Accept-Encoding') or ''):
+            # deflate is sent zlib wrapped, as HTTP specifies
+            compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS if encoding == 'gzip' else zlib.MAX_WBITS)
+            payload = compressor.compress(payload) + compressor.flush()
+        else:
+            encoding = None
+
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+
+        if encoding is not None:
+            self.send_header('Content-Encoding', encoding)
+
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def log_message(self, *args):
+        pass
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    """
+    A threaded HTTP server answering calls on the form /v1/service.method.
+    Handlers are registered per 'service.method' and receive the decoded
+    arguments, returning the result to serialize. Compressed request
+    bodies are decompressed, and responses are compressed with the
+    compression encoding when set and accepted by the client.
+    """
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 128
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubRequestHandler)
+        self.calls = []
+        self.connections = 0
+        self.handlers = {}
+        self.compression = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @property
+    def address(self):
+        return '{h}:{p}'.format(h=self.server_address[0], p=self.server_address[1])
+
+    def on(self, name, handler):
+        """
+        Register a handler for 'service.method'. The handler is either a
+        callable taking (arguments, headers) or a static result.
+        """
+        self.handlers[name] = handler
+
+    def record(self, call):
+        with self._lock:
+            self.calls.append(call)
+
+    def handle_call(self, service, method, arguments, headers):
+        name = "{s}.{m}".format(s=service, m=method)
+        handler = self.handlers.get(name)
+
+        if handler is None:
+            return 200, {'error_code': 'INVALID_METHOD', 'message': "Method '{n}' does not exist.".format(n=name)}
+
+        result = handler(arguments, headers) if callable(handler) else handler
+
+        if isinstance(result, tuple):
+            return result
+
+        return 200, result
+
+    def get_request(self):
+        request = HTTPServer.get_request(self)
+
+        with self._lock:
+            self.connections += 1
+
+        return request
+
+    def handle_error(self, request, client_address):
+        # Clients closing a connection before reading the whole response are expected
+        if not isinstance(sys.exc_info()[1], socket.error):
+            HTTPServer.handle_error(self, request, client_address)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, kwargs={'poll_interval':0.05})
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
@@ -5,9 +5,35 @@ currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentfram
 parentdir = os.path.dirname(currentdir)
 sys.path.insert(0,parentdir)
 
+import time
+import gzip
+import json
+import base64
+import shutil
+import logging
+import socket
+import subprocess
+import tempfile
+import threading
 import unittest
 import userapp
-import exceptions
+import userapp.__main__
+import stub_server
+
+try:
+	import exceptions
+except ImportError:
+	import builtins as exceptions
+
+try:
+	import asyncio
+except ImportError:
+	asyncio=None
+
+try:
+	from StringIO import StringIO
+except ImportError:
+	from io import StringIO
 
 class IterableObjectTests(unittest.TestCase):
 	def setUp(self):
@@ -105,6 +131,1728 @@ class IterableObjectTests(unittest.TestCase):
 	def testCanSerializeToJson(self):
 		self.assertEqual(self.object.to_json(), '{"locks": [{"issued_by": "locksmith"}], "user_id": "Bob", "properties": {"age": {"override": true, "value": 154}}}')
 
+	def testHasNoInstanceDictionary(self):
+		self.assertFalse(hasattr(self.object, '__dict__'))
+
+	def testConvertsToWrappedDictionary(self):
+		self.object.properties.age.value=155
+		self.object.locks[0].issued_by='admin'
+		self.object.locks.append({'issued_by':'locksmith'})
+
+		self.assertTrue(self.object.to_dict() is self.object.source)
+		self.assertEqual(self.object.to_dict(), {
+			'user_id':'Bob',
+			'properties':{'age':{'value':155, 'override':True}},
+			'locks':[{'issued_by':'admin'}, {'issued_by':'locksmith'}]
+		})
+
+	def testWritesListChangesThrough(self):
+		self.object.locks.insert(0, {'issued_by':'admin'})
+		self.assertEqual(self.object.locks[0].issued_by, 'admin')
+
+		self.object.locks.pop()
+		self.object.locks[0]={'issued_by':'owner'}
+
+		self.assertEqual(self.object.to_dict()['locks'], [{'issued_by':'owner'}])
+		self.assertTrue(isinstance(self.object.locks[0], userapp.IterableObject))
+
+	def testUnwrapsObjectsInAssignedLists(self):
+		self.object.locks=self.object.locks+[{'issued_by':'admin'}]
+		self.object.locks=[lock for lock in self.object.locks if lock.issued_by == 'admin']+[{'by':self.object.properties.age}]
+		self.object.locks.append({'by':self.object.properties})
+
+		self.assertEqual(json.loads(json.dumps(self.object.to_dict()))['locks'], [
+			{'issued_by':'admin'},
+			{'by':{'value':154, 'override':True}},
+			{'by':{'age':{'value':154, 'override':True}}}
+		])
+		self.assertEqual(self.object.locks[0].issued_by, 'admin')
+
+	def testWritesSortAndRepeatThrough(self):
+		self.object.locks.append({'issued_by':'admin'})
+		self.object.locks.sort(key=lambda lock: lock.issued_by)
+		self.assertEqual(self.object.to_dict()['locks'], [{'issued_by':'admin'}, {'issued_by':'locksmith'}])
+
+		self.object.locks*=2
+		self.assertEqual(len(self.object.source['locks']), 4)
+
+		self.object.locks.clear()
+		self.assertEqual(self.object.source['locks'], [])
+		self.assertTrue('"locks": []' in self.object.to_json())
+
+class LazyIterableObjectTests(IterableObjectTests):
+	def setUp(self):
+		self.object=userapp.DictionaryUtility.to_lazy_object({
+			'user_id':'Bob',
+			'properties':{
+				'age':{
+					'value':154,
+					'override':True
+				}
+			},
+			'locks':[
+				{
+					'issued_by':'locksmith'
+				}
+			]
+		})
+
+	def testWrapsNestedValuesOnAccess(self):
+		self.assertTrue(isinstance(self.object.source['properties'], dict))
+		self.assertTrue(self.object.properties is self.object.properties)
+		self.assertTrue(isinstance(self.object.properties.source['age'], dict))
+
+
+class NativeTransportTests(unittest.TestCase):
+	def setUp(self):
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.get', lambda arguments, headers: [{'user_id':arguments.get('user_id')}])
+		self.api=userapp.API(app_id='test', base_address=self.server.address, secure=False)
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+
+	def testCanCallThroughPooledTransport(self):
+		result=self.api.user.get(user_id='Bob')
+		self.assertEqual(result[0].user_id, 'Bob')
+		self.assertEqual(self.server.calls[0]['service'], 'user')
+		self.assertEqual(self.server.calls[0]['method'], 'get')
+
+	def testReusesConnectionsBetweenCalls(self):
+		for i in range(5):
+			self.api.user.get(user_id='Bob')
+
+		stats=self.api.get_pool_stats()
+
+		self.assertEqual(self.server.connections, 1)
+		self.assertEqual(stats['requests'], 5)
+		self.assertEqual(stats['connections_created'], 1)
+		self.assertEqual(stats['connections_reused'], 4)
+		self.assertEqual(stats['connections_open'], 1)
+
+	def testEvictsIdleConnections(self):
+		self.api.set_option('pool_idle_timeout', 0)
+		self.api.user.get(user_id='Bob')
+		time.sleep(0.01)
+		self.api.user.get(user_id='Bob')
+
+		stats=self.api.get_pool_stats()
+
+		self.assertEqual(stats['evictions'], 1)
+		self.assertEqual(stats['connections_created'], 2)
+
+	def testCanReturnLazyResponses(self):
+		self.api.set_option('lazy_responses', True)
+		result=self.api.user.get(user_id='Bob')
+
+		self.assertTrue(isinstance(result[0], userapp.LazyIterableObject))
+		self.assertEqual(result[0].user_id, 'Bob')
+
+	def testRecompilesCallsWhenCredentialsChange(self):
+		self.server.on('user.login', {'token':'abc123', 'user_id':'Bob'})
+
+		self.api.user.get(user_id='Bob')
+		self.api.set_option('token', 'xyz')
+		self.api.user.get(user_id='Bob')
+		self.api.user.login(login='Bob', password='secret')
+		self.api.user.get(user_id='Bob')
+
+		authorizations=[call['headers']['authorization'] for call in self.server.calls]
+
+		self.assertEqual(authorizations[0], 'Basic '+base64.b64encode(b'test:').decode('ascii'))
+		self.assertEqual(authorizations[1], 'Basic '+base64.b64encode(b'test:xyz').decode('ascii'))
+		self.assertEqual(authorizations[3], 'Basic '+base64.b64encode(b'test:abc123').decode('ascii'))
+
+	def testRecompilesCallsWhenAddressChanges(self):
+		self.api.user.get(user_id='Bob')
+		self.api.set_option('base_address', 'localhost:1')
+
+		with self.assertRaises(Exception):
+			self.api.user.get(user_id='Bob')
+
+	def testCachesProxiesOnAttributeAccess(self):
+		self.assertTrue(self.api.user.payment_method is self.api.user.paymentMethod)
+		self.assertTrue('payment_method' in self.api.user.__dict__)
+
+	def testCanSetTransportOptions(self):
+		self.api.set_option('read_timeout', 5)
+		self.assertEqual(self.api.get_option('read_timeout'), 5)
+		self.assertEqual(self.api.get_client()._transport._get_timeout(), (None, 5))
+
+	def testEncodesAndDecodesWithCodec(self):
+		calls=[]
+
+		class RecordingCodec(userapp.JsonCodec):
+			def dumps(self, data):
+				calls.append('dumps')
+				return userapp.JsonCodec.dumps(self, data)
+
+			def loads(self, content):
+				calls.append('loads')
+				return userapp.JsonCodec.loads(self, content)
+
+		self.api.set_option('codec', RecordingCodec())
+		result=self.api.user.get(user_id='Bob')
+
+		self.assertEqual(result[0].user_id, 'Bob')
+		self.assertEqual(calls, ['dumps', 'loads'])
+
+	def testCanUseFastestCodec(self):
+		self.api.set_option('codec', True)
+		result=self.api.user.get(user_id='Bob', properties=userapp.DictionaryUtility.to_object({'age':{'value':42}}))
+
+		self.assertEqual(result[0].user_id, 'Bob')
+		self.assertEqual(self.server.calls[0]['arguments']['properties'], {'age':{'value':42}})
+		self.assertEqual(self.api.get_option('codec').name, 'orjson' if userapp.import_orjson() is not None else 'json')
+
+class HttpClientTransportTests(NativeTransportTests):
+	def setUp(self):
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.get', lambda arguments, headers: [{'user_id':arguments.get('user_id')}])
+		self.server.on('user.search', lambda arguments, headers: {'items':[{'user_id':str(i)} for i in range(10)], 'total_items':10})
+		self.api=userapp.API(app_id='test', base_address=self.server.address, secure=False, transport_class=userapp.HttpClientTransport)
+
+	def testUsesStandardLibraryTransport(self):
+		self.assertTrue(isinstance(self.api.get_client()._transport, userapp.HttpClientTransport))
+
+	def testReconnectsWhenPooledConnectionWasClosed(self):
+		self.api.user.get(user_id='Bob')
+
+		for connection in self.api.get_client()._transport._idle[('http', '127.0.0.1', self.server.server_address[1])]:
+			connection.connection.sock.shutdown(socket.SHUT_RDWR)
+
+		result=self.api.user.get(user_id='Bob')
+
+		self.assertEqual(result[0].user_id, 'Bob')
+		self.assertEqual(self.api.get_pool_stats()['connections_created'], 2)
+
+	def testRaisesConnectionErrors(self):
+		self.api.set_option('base_address', 'localhost:1')
+
+		with self.assertRaises(userapp.UserAppConnectionException):
+			self.api.user.get(user_id='Bob')
+
+	def testRaisesTimeouts(self):
+		self.server.on('user.get', lambda arguments, headers: time.sleep(0.2) or [])
+
+		with self.assertRaises(userapp.UserAppTimeoutException):
+			self.api.user.get(user_id='Bob', _timeout=0.05)
+
+	def testCanStreamResults(self):
+		for i in range(3):
+			result=self.api.user.search.stream()
+			self.assertEqual([user.user_id for user in result], [str(i) for i in range(10)])
+			self.assertEqual(result.total_items, 10)
+
+		self.assertEqual(self.api.get_pool_stats()['connections_created'], 1)
+
+	def testDoesNotImportRequests(self):
+		script=(
+			"import sys, userapp\n"
+			"api=userapp.API(app_id='test', base_address='{a}', secure=False, transport_class=userapp.HttpClientTransport)\n"
+			"loaded=('requests' in sys.modules, 'asyncio' in sys.modules)\n"
+			"api.user.get(user_id='Bob')\n"
+			"print('{{l}} {{r}}'.format(l=loaded, r='requests' in sys.modules))\n"
+		).format(a=self.server.address)
+
+		output=subprocess.check_output([sys.executable, '-c', script], cwd=parentdir)
+
+		self.assertEqual(output.decode('utf-8').strip(), '(False, False) False')
+
+class CompressionTests(unittest.TestCase):
+	transport_class=userapp.NativeTransport
+
+	def setUp(self):
+		self.users=[{'user_id':str(i), 'properties':{'bio':{'value':'Likes long walks. '*80}}} for i in range(20)]
+
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.save', lambda arguments, headers: arguments)
+		self.server.on('user.search', lambda arguments, headers: {'items':self.users, 'total_items':len(self.users)})
+		self.compression=userapp.Compression(min_size=256)
+		self.api=userapp.API(app_id='test', base_address=self.server.address, secure=False, transport_class=self.transport_class, compression=self.compression)
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+
+	def testCompressesLargeRequestBodies(self):
+		result=self.api.user.save(user_id='Bob', properties=self.users[0]['properties'])
+		stats=self.compression.get_stats()
+
+		self.assertEqual(result.properties.bio.value, self.users[0]['properties']['bio']['value'])
+		self.assertEqual(self.server.calls[0]['headers']['content-encoding'], 'gzip')
+		self.assertEqual(self.server.calls[0]['size'], stats['request_bytes_sent'])
+		self.assertEqual(stats['requests_compressed'], 1)
+		self.assertTrue(stats['request_bytes_sent'] < stats['request_bytes'])
+
+	def testSendsSmallRequestBodiesAsIs(self):
+		self.api.user.save(user_id='Bob')
+
+		self.assertFalse('content-encoding' in self.server.calls[0]['headers'])
+		self.assertEqual(self.compression.get_stats()['requests_compressed'], 0)
+
+	def testAdvertisesCompressedResponses(self):
+		self.api.user.save(user_id='Bob')
+		self.assertEqual(self.server.calls[0]['headers']['accept-encoding'], 'gzip, deflate')
+
+	def testDecompressesResponses(self):
+		for encoding in ['gzip', 'deflate']:
+			self.server.compression=encoding
+			result=self.api.user.search()
+			self.assertEqual([user.user_id for user in result.items], [str(i) for i in range(20)])
+
+		stats=self.compression.get_stats()
+
+		self.assertEqual(stats['responses_compressed'], 2)
+		self.assertTrue(stats['bytes_saved'] > stats['response_bytes'] / 2)
+
+	def testDecompressesStreamedResponses(self):
+		self.server.compression='gzip'
+		result=self.api.user.search.stream()
+
+		self.assertEqual([user.properties.bio.value for user in result], [user['properties']['bio']['value'] for user in self.users])
+
+	def testCanEnableWithSetOption(self):
+		self.api.set_option('compression', None)
+		self.api.user.save(user_id='Bob', properties=self.users[0]['properties'])
+
+		self.api.set_option('compression', True)
+		self.api.user.save(user_id='Bob', properties=self.users[0]['properties'])
+
+		self.assertFalse('content-encoding' in self.server.calls[0]['headers'])
+		self.assertEqual(self.server.calls[1]['headers']['content-encoding'], 'gzip')
+		self.assertEqual(self.api.get_option('compression').get_stats()['requests_compressed'], 1)
+
+class HttpClientCompressionTests(CompressionTests):
+	transport_class=userapp.HttpClientTransport
+
+class RecordReplayTests(unittest.TestCase):
+	def setUp(self):
+		self.counter=[0]
+
+		def count(arguments, headers):
+			self.counter[0]+=1
+			return self.counter[0]
+
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.get', lambda arguments, headers: [{'user_id':arguments.get('user_id')}])
+		self.server.on('user.login', {'token':'secret-session', 'user_id':'Bob'})
+		self.server.on('user.count', count)
+		self.directory=tempfile.mkdtemp()
+		self.path=os.path.join(self.directory, 'calls.ndjson')
+
+		transport=userapp.RecordingTransport(userapp.NativeTransport(logging.getLogger('userapp.test')), self.path)
+		api=userapp.API(app_id='test', base_address=self.server.address, secure=False, transport=transport)
+		api.user.get(user_id='Bob')
+		api.user.login(login='Bob', password='secret-password')
+		api.user.count()
+		api.user.count()
+		api.close()
+
+		self.server.stop()
+
+	def tearDown(self):
+		shutil.rmtree(self.directory)
+
+	def create_api(self, **kwargs):
+		self.transport=userapp.ReplayTransport(self.path, **kwargs)
+		return userapp.API(app_id='test', base_address=self.server.address, secure=False, transport=self.transport)
+
+	def testReplaysRecordedCalls(self):
+		api=self.create_api()
+
+		self.assertEqual(api.user.get(user_id='Bob')[0].user_id, 'Bob')
+		self.assertEqual(api.user.login(login='Bob', password='secret-password').user_id, 'Bob')
+		self.assertEqual([api.user.count() for i in range(3)], [1, 2, 1])
+		self.assertEqual(self.transport.get_stats(), {'calls':5, 'misses':0})
+
+	def testRaisesOnCallsNotRecorded(self):
+		api=self.create_api()
+
+		with self.assertRaises(userapp.UserAppTransportException):
+			api.user.get(user_id='Alice')
+
+	def testRedactsCredentials(self):
+		with open(self.path) as f:
+			recording=f.read()
+
+		self.assertFalse('secret-password' in recording)
+		self.assertFalse('secret-session' in recording)
+
+	def testSimulatesLatency(self):
+		api=self.create_api(latency=0.05)
+		start=time.time()
+		api.user.get(user_id='Bob')
+
+		self.assertTrue(time.time()-start >= 0.05)
+
+	def testRecordsStreamedCalls(self):
+		streamed=[]
+
+		class StreamingTransport(userapp.NativeTransport):
+			def call(self, *args, **kwargs):
+				streamed.append(kwargs.get('stream', False))
+				return userapp.NativeTransport.call(self, *args, **kwargs)
+
+		server=stub_server.StubServer().start()
+		server.on('user.search', {'items':[{'user_id':'Bob'}, {'user_id':'Alice'}], 'total_items':2})
+
+		transport=userapp.RecordingTransport(StreamingTransport(logging.getLogger('userapp.test')), self.path)
+		api=userapp.API(app_id='test', base_address=server.address, secure=False, transport=transport)
+
+		try:
+			self.assertEqual([user.user_id for user in api.user.search.stream()], ['Bob', 'Alice'])
+		finally:
+			api.close()
+			server.stop()
+
+		result=self.create_api().user.search.stream()
+
+		self.assertEqual(streamed, [True])
+		self.assertEqual([user.user_id for user in result], ['Bob', 'Alice'])
+		self.assertEqual(result.total_items, 2)
+
+class ResponseCacheTests(unittest.TestCase):
+	def setUp(self):
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.get', lambda arguments, headers: [{'user_id':arguments.get('user_id')}])
+		self.server.on('user.search', {'items':[], 'total_items':0})
+		self.server.on('user.save', lambda arguments, headers: {'user_id':arguments.get('user_id')})
+		self.server.on('property.search', [])
+		self.cache=userapp.ResponseCache(max_size=2, ttls={'property.search':0.05})
+		self.api=userapp.API(app_id='test', base_address=self.server.address, secure=False, cache=self.cache)
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+
+	def testServesRepeatedReadsFromCache(self):
+		self.api.user.get(user_id='Bob')
+		result=self.api.user.get(user_id='Bob')
+
+		self.assertEqual(result[0].user_id, 'Bob')
+		self.assertEqual(len(self.server.calls), 1)
+		self.assertEqual(self.cache.get_stats()['hits'], 1)
+		self.assertEqual(self.cache.get_stats()['misses'], 1)
+
+	def testKeysOnTokenAndArguments(self):
+		self.api.user.get(user_id='Bob')
+		self.api.user.get(user_id='Alice')
+		self.api.set_option('token', 'other')
+		self.api.user.get(user_id='Bob')
+
+		self.assertEqual(len(self.server.calls), 3)
+
+	def testExpiresEntriesAfterTtl(self):
+		self.api.property.search()
+		time.sleep(0.1)
+		self.api.property.search()
+
+		self.assertEqual(len(self.server.calls), 2)
+
+	def testEvictsLeastRecentlyUsed(self):
+		self.api.user.get(user_id='Bob')
+		self.api.user.get(user_id='Alice')
+		self.api.user.get(user_id='Bob')
+		self.api.user.get(user_id='Eve')
+		self.api.user.get(user_id='Bob')
+
+		self.assertEqual(len(self.server.calls), 3)
+		self.assertEqual(self.cache.get_stats()['evictions'], 1)
+
+	def testInvalidatesEntriesTouchedByWrites(self):
+		self.api.user.get(user_id='Bob')
+		self.api.user.search()
+		self.api.user.save(user_id='Alice')
+		self.api.user.get(user_id='Bob')
+		self.api.user.search()
+
+		self.assertEqual([call['method'] for call in self.server.calls], ['get', 'search', 'save', 'search'])
+		self.assertEqual(self.cache.get_stats()['invalidations'], 1)
+
+	def testWritesToAnyUserInvalidateSelf(self):
+		self.api.user.get(user_id='self')
+		self.api.user.get(user_id='Bob')
+		self.api.user.save(user_id='abc', first_name='new')
+		self.api.user.get(user_id='self')
+		self.api.user.get(user_id='Bob')
+
+		self.assertEqual([call['arguments'].get('user_id') for call in self.server.calls], ['self', 'Bob', 'abc', 'self'])
+
+class TimeoutAndHedgingTests(unittest.TestCase):
+	def setUp(self):
+		self.delays=[]
+
+		def get_user(arguments, headers):
+			time.sleep(self.delays.pop(0) if self.delays else 0)
+			return [{'user_id':arguments.get('user_id')}]
+
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.get', get_user)
+		self.server.on('user.save', get_user)
+		self.hedger=userapp.RequestHedger(delay=0.05)
+		self.api=userapp.API(app_id='test', base_address=self.server.address, secure=False)
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+
+	def testRaisesWhenCallExceedsTimeout(self):
+		self.delays=[0.5]
+
+		with self.assertRaises(userapp.UserAppTimeoutException):
+			self.api.user.get(user_id='Bob', _timeout=0.1)
+
+		self.assertEqual(self.server.calls[0]['arguments'], {'user_id':'Bob'})
+
+	def testUsesDefaultTimeout(self):
+		self.api.set_option('timeout', 0.1)
+		self.delays=[0.5]
+
+		with self.assertRaises(userapp.UserAppTimeoutException):
+			self.api.user.get(user_id='Bob')
+
+	def testHedgesSlowReads(self):
+		self.api.set_option('hedging', self.hedger)
+		self.delays=[0.5, 0]
+
+		start=time.time()
+		result=self.api.user.get(user_id='Bob')
+
+		self.assertEqual(result[0].user_id, 'Bob')
+		self.assertTrue(time.time()-start < 0.4)
+		self.assertEqual(self.hedger.get_stats()['hedges_fired'], 1)
+		self.assertEqual(self.hedger.get_stats()['hedges_won'], 1)
+
+	def testDoesNotHedgeWrites(self):
+		self.api.set_option('hedging', self.hedger)
+		self.delays=[0.1]
+		self.api.user.save(user_id='Bob')
+
+		self.assertEqual(len(self.server.calls), 1)
+		self.assertEqual(self.hedger.get_stats()['calls'], 0)
+
+	def testHedgesAfterPercentileOfRecentLatencies(self):
+		hedger=userapp.RequestHedger(percentile=50, delay=1, min_samples=3)
+
+		for latency in [0.1, 0.2, 0.3]:
+			hedger.record('user.get', latency)
+
+		self.assertEqual(hedger.get_delay('user.get'), 0.2)
+		self.assertEqual(hedger.get_delay('user.search'), 1)
+
+class ResilienceTests(unittest.TestCase):
+	def setUp(self):
+		self.failures=0
+
+		def flaky(arguments, headers):
+			if self.failures > 0:
+				self.failures-=1
+				return 503, {'message':'Unavailable'}
+			return {'user_id':'Bob'}
+
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.get', flaky)
+		self.server.on('user.save', flaky)
+		self.retry=userapp.RetryPolicy(max_attempts=3, backoff=0.001, budget_ratio=0.5, budget_min=2)
+		self.breaker=userapp.CircuitBreaker(failure_threshold=2, reset_timeout=0.1)
+		self.api=userapp.API(app_id='test', base_address=self.server.address, secure=False, retry=self.retry)
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+
+	def testRaisesTransportExceptionOnServerError(self):
+		self.api.set_option('retry', None)
+		self.failures=1
+
+		with self.assertRaises(userapp.UserAppTransportException):
+			self.api.user.get()
+
+	def testRetriesReads(self):
+		self.failures=2
+
+		self.assertEqual(self.api.user.get().user_id, 'Bob')
+		self.assertEqual(len(self.server.calls), 3)
+		self.assertEqual(self.retry.get_stats()['retries'], 2)
+
+	def testDoesNotRetryWrites(self):
+		self.failures=1
+
+		with self.assertRaises(userapp.UserAppTransportException):
+			self.api.user.save(user_id='Bob')
+
+		self.assertEqual(len(self.server.calls), 1)
+
+	def testRetriesWritesThatCouldNotConnect(self):
+		self.api.set_option('base_address', '127.0.0.1:1')
+
+		with self.assertRaises(userapp.UserAppConnectionException):
+			self.api.user.save(user_id='Bob')
+
+		self.assertEqual(self.retry.get_stats()['retries'], 2)
+
+	def testRetriesShareTimeoutOfCall(self):
+		self.server.on('user.search', lambda arguments, headers: time.sleep(0.2) or {})
+		start=time.time()
+
+		with self.assertRaises(userapp.UserAppTimeoutException):
+			self.api.user.search(_timeout=0.1)
+
+		self.assertTrue(time.time() - start < 0.18)
+
+	def testStopsRetryingWhenBudgetIsExhausted(self):
+		self.failures=6
+
+		for i in range(2):
+			with self.assertRaises(userapp.UserAppTransportException):
+				self.api.user.get()
+
+		self.assertEqual(len(self.server.calls), 4)
+		self.assertEqual(self.retry.get_stats()['budget_exhausted'], 1)
+
+	def testOpensCircuitAfterFailures(self):
+		self.api.set_option('retry', None)
+		self.api.set_option('circuit_breaker', self.breaker)
+		self.failures=2
+
+		for i in range(2):
+			with self.assertRaises(userapp.UserAppTransportException):
+				self.api.user.get()
+
+		with self.assertRaises(userapp.UserAppCircuitOpenException):
+			self.api.user.get()
+
+		self.assertEqual(len(self.server.calls), 2)
+		self.assertEqual(self.breaker.get_state(self.server.address), 'open')
+
+		time.sleep(0.15)
+
+		self.assertEqual(self.api.user.get().user_id, 'Bob')
+		self.assertEqual(self.breaker.get_state(self.server.address), 'closed')
+		self.assertEqual(self.breaker.get_stats()['opened'], 1)
+		self.assertEqual(self.breaker.get_stats()['half_opened'], 1)
+		self.assertEqual(self.breaker.get_stats()['rejected'], 1)
+
+	def testTrialEndingWithOtherErrorDoesNotBlockCircuit(self):
+		self.api.set_option('retry', None)
+		self.api.set_option('circuit_breaker', self.breaker)
+		self.failures=2
+
+		for i in range(2):
+			with self.assertRaises(userapp.UserAppTransportException):
+				self.api.user.get()
+
+		time.sleep(0.15)
+
+		# The arguments cannot be serialized, so the trial never reaches the server
+		with self.assertRaises(Exception) as context:
+			self.api.user.get(user_id=object())
+
+		self.assertFalse(isinstance(context.exception, userapp.UserAppException))
+
+		self.assertEqual(self.breaker.get_state(self.server.address), 'open')
+
+		time.sleep(0.15)
+
+		self.assertEqual(self.api.user.get().user_id, 'Bob')
+		self.assertEqual(self.breaker.get_state(self.server.address), 'closed')
+
+class RateLimiterTests(unittest.TestCase):
+	def setUp(self):
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.get', {'user_id':'Bob'})
+		self.server.on('user.save', {'user_id':'Bob'})
+
+	def tearDown(self):
+		self.server.stop()
+
+	def testLimitsCallRate(self):
+		limiter=userapp.RateLimiter(rate=20, burst=1)
+		api=userapp.API(app_id='test', base_address=self.server.address, secure=False, rate_limiter=limiter)
+
+		start=time.time()
+		for i in range(5):
+			api.user.get()
+
+		self.assertTrue(time.time()-start >= 0.18)
+		self.assertEqual(limiter.get_stats()['acquired'], 5)
+		self.assertEqual(limiter.get_stats()['waited'], 4)
+		api.close()
+
+	def testLimitsPerMethod(self):
+		limiter=userapp.RateLimiter(rate=1000, limits={'user.save':10})
+
+		start=time.time()
+		for i in range(20):
+			limiter.acquire('test', 'user', 'get')
+		self.assertTrue(time.time()-start < 0.05)
+
+		for i in range(13):
+			limiter.acquire('test', 'user', 'save')
+		self.assertTrue(time.time()-start >= 0.25)
+
+	def testSendsInteractiveCallsFirst(self):
+		limiter=userapp.RateLimiter(rate=10, burst=1)
+		limiter.acquire('test', 'user', 'get')
+		order=[]
+
+		def call(service, method):
+			limiter.acquire('test', service, method)
+			order.append(method)
+
+		batch=threading.Thread(target=call, args=('user', 'save'))
+		batch.start()
+		time.sleep(0.02)
+		interactive=threading.Thread(target=call, args=('user', 'login'))
+		interactive.start()
+		time.sleep(0.02)
+
+		self.assertEqual(limiter.get_stats()['queued'], 2)
+
+		batch.join()
+		interactive.join()
+
+		self.assertEqual(order, ['login', 'save'])
+
+	@unittest.skipIf(asyncio is None, "asyncio is not available")
+	def testLimitsAsyncCalls(self):
+		loop=asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		limiter=userapp.RateLimiter(rate=20, burst=1)
+		api=userapp.AsyncAPI(app_id='test', base_address=self.server.address, secure=False, rate_limiter=limiter)
+
+		start=time.time()
+		loop.run_until_complete(asyncio.gather(*[api.user.get() for i in range(5)]))
+
+		self.assertTrue(time.time()-start >= 0.18)
+		self.assertEqual(limiter.get_stats()['queued'], 0)
+
+		loop.run_until_complete(api.close())
+		loop.close()
+		asyncio.set_event_loop(None)
+
+class HookTests(unittest.TestCase):
+	def setUp(self):
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.get', [{'user_id':'Bob'}])
+		self.server.on('user.save', {'error_code':'INVALID_ARGUMENT_USER_ID', 'message':'Invalid user id.'})
+		self.metrics=userapp.MetricsCollector()
+		self.api=userapp.API(app_id='test', base_address=self.server.address, secure=False, hooks=[self.metrics])
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+
+	def testCallsHooksAroundCalls(self):
+		events=[]
+
+		class RecordingHook(userapp.Hook):
+			def before_send(self, context):
+				events.append(('before_send', context.name))
+
+			def after_receive(self, context):
+				events.append(('after_receive', context.name, context.status_code, context.result[0].user_id))
+
+			def on_error(self, context, error):
+				events.append(('on_error', context.name, error.error_code))
+
+		self.api.add_hook(RecordingHook())
+		self.api.user.get(user_id='Bob')
+
+		with self.assertRaises(userapp.UserAppServiceException):
+			self.api.user.save(user_id='Bob')
+
+		self.assertEqual(events, [
+			('before_send', 'user.get'),
+			('after_receive', 'user.get', 200, 'Bob'),
+			('before_send', 'user.save'),
+			('on_error', 'user.save', 'INVALID_ARGUMENT_USER_ID')
+		])
+
+	def testCollectsMetricsPerMethod(self):
+		for i in range(3):
+			self.api.user.get(user_id='Bob')
+
+		with self.assertRaises(userapp.UserAppServiceException):
+			self.api.user.save(user_id='Bob')
+
+		snapshot=self.metrics.snapshot()
+
+		self.assertEqual(snapshot['user.get']['calls'], 3)
+		self.assertEqual(snapshot['user.get']['errors'], 0)
+		self.assertEqual(sum(snapshot['user.get']['latency']['counts']), 3)
+		self.assertEqual(snapshot['user.get']['request_bytes'], 3*len('{"user_id": "Bob"}'))
+		self.assertEqual(snapshot['user.get']['response_bytes'], 3*len('[{"user_id": "Bob"}]'))
+		self.assertTrue(snapshot['user.get']['decode_time'] > 0)
+		self.assertTrue(snapshot['user.get']['convert_time'] > 0)
+		self.assertEqual(snapshot['user.save']['error_codes'], {'INVALID_ARGUMENT_USER_ID':1})
+
+	def testCollectsTransportErrors(self):
+		self.api.set_option('base_address', '127.0.0.1:1')
+
+		with self.assertRaises(userapp.UserAppConnectionException):
+			self.api.user.get(user_id='Bob')
+
+		self.assertEqual(self.metrics.snapshot()['user.get']['error_codes'], {'UserAppConnectionException':1})
+
+class RecordingHandler(logging.Handler):
+	def __init__(self):
+		logging.Handler.__init__(self)
+		self.messages=[]
+
+	def emit(self, record):
+		self.messages.append(record.getMessage())
+
+class TracingTests(unittest.TestCase):
+	def setUp(self):
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.login', {'token':'secret-session', 'user_id':'Bob', 'blob':'x'*100})
+		self.handler=RecordingHandler()
+		self.logger=logging.getLogger('userapp.test.tracing')
+		self.logger.addHandler(self.handler)
+		self.logger.setLevel(logging.DEBUG)
+		self.api=userapp.API(app_id='test', token='secret-token', base_address=self.server.address, secure=False, logger=self.logger)
+
+	def tearDown(self):
+		self.logger.removeHandler(self.handler)
+		self.api.close()
+		self.server.stop()
+
+	def testRedactsCredentials(self):
+		self.api.user.login(login='bob', password='secret-password')
+
+		log=' '.join(self.handler.messages)
+
+		self.assertEqual(len(self.handler.messages), 2)
+		self.assertFalse('secret-password' in log)
+		self.assertFalse('secret-session' in log)
+		self.assertFalse(base64.b64encode(b'test:secret-token').decode('ascii') in log)
+		self.assertTrue('[REDACTED]' in log)
+		self.assertTrue('bob' in log)
+
+	def testTruncatesLargeBodies(self):
+		self.api.set_option('trace_max_body', 20)
+		self.api.user.login(login='bob', password='secret-password')
+
+		self.assertTrue(self.handler.messages[1].endswith('characters truncated)'))
+		self.assertFalse('x'*100 in self.handler.messages[1])
+
+	def testSamplesCalls(self):
+		self.api.set_option('trace_sample_rate', 0)
+
+		for i in range(10):
+			self.api.user.login(login='bob', password='secret-password')
+
+		self.assertEqual(self.handler.messages, [])
+
+	def testSkipsTracingUnlessEnabled(self):
+		self.logger.setLevel(logging.INFO)
+		self.api.user.login(login='bob', password='secret-password')
+
+		self.assertFalse(self.api.get_client()._tracer.should_trace())
+		self.assertEqual(self.handler.messages, [])
+
+class SingleFlightTests(unittest.TestCase):
+	def setUp(self):
+		def get_user(arguments, headers):
+			time.sleep(0.2)
+
+			if arguments.get('user_id') == 'broken':
+				return 500, {}
+
+			return [{'user_id':arguments.get('user_id')}]
+
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.get', get_user)
+		self.server.on('user.save', {'user_id':'Bob'})
+		self.single_flight=userapp.SingleFlight()
+		self.api=userapp.API(app_id='test', base_address=self.server.address, secure=False, single_flight=self.single_flight)
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+
+	def run_concurrently(self, count, fn):
+		start=threading.Event()
+		results=[None]*count
+
+		def worker(i):
+			start.wait()
+
+			try:
+				results[i]=fn(i)
+			except Exception as e:
+				results[i]=e
+
+		threads=[threading.Thread(target=worker, args=(i,)) for i in range(count)]
+
+		for thread in threads:
+			thread.start()
+
+		start.set()
+
+		for thread in threads:
+			thread.join()
+
+		return results
+
+	def testCoalescesIdenticalReads(self):
+		results=self.run_concurrently(8, lambda i: self.api.user.get(user_id='Bob'))
+
+		self.assertEqual([result[0].user_id for result in results], ['Bob']*8)
+		self.assertFalse(results[0] is results[1])
+		self.assertEqual(len(self.server.calls), 1)
+		self.assertEqual(self.single_flight.get_stats(), {'calls':8, 'coalesced':7, 'in_flight':0})
+
+	def testSendsDifferentReadsAndWrites(self):
+		self.run_concurrently(4, lambda i: self.api.user.get(user_id=str(i % 2)))
+		self.run_concurrently(4, lambda i: self.api.user.save(user_id='Bob'))
+
+		self.assertEqual(len(self.server.calls), 6)
+
+	def testSharesErrors(self):
+		results=self.run_concurrently(4, lambda i: self.api.user.get(user_id='broken'))
+
+		self.assertTrue(all(isinstance(result, userapp.UserAppTransportException) for result in results))
+		self.assertEqual(len(self.server.calls), 1)
+
+	def testFollowersTimeOut(self):
+		leader=threading.Thread(target=lambda: self.api.user.get(user_id='Bob'))
+		leader.start()
+		time.sleep(0.05)
+
+		with self.assertRaises(userapp.UserAppTimeoutException):
+			self.api.user.get(user_id='Bob', _timeout=0.05)
+
+		leader.join()
+
+		self.assertEqual(len(self.server.calls), 1)
+
+	@unittest.skipIf(asyncio is None, "asyncio is not available")
+	def testCoalescesIdenticalAsyncReads(self):
+		loop=asyncio.new_event_loop()
+		asyncio.set_event_loop(loop)
+		api=userapp.AsyncAPI(app_id='test', base_address=self.server.address, secure=False, single_flight=True)
+
+		try:
+			results=loop.run_until_complete(asyncio.gather(*[api.user.get(user_id='Bob') for i in range(8)]))
+			loop.run_until_complete(api.close())
+		finally:
+			loop.close()
+			asyncio.set_event_loop(None)
+
+		self.assertEqual([result[0].user_id for result in results], ['Bob']*8)
+		self.assertEqual(len(self.server.calls), 1)
+		self.assertEqual(api.get_option('single_flight').get_stats()['coalesced'], 7)
+
+class UserSnapshotsTests(unittest.TestCase):
+	def setUp(self):
+		user={
+			'user_id':'Bob',
+			'permissions':{'admin':{'value':True, 'override':False}, 'editor':{'value':False, 'override':False}},
+			'features':{'beta':{'value':True, 'override':False}}
+		}
+
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.get', lambda arguments, headers: [dict(user, user_id=arguments['user_id'].replace('self', 'Bob'))])
+		self.server.on('user.save', {'user_id':'Bob'})
+		self.snapshots=userapp.UserSnapshots(refresh_interval=60)
+		self.api=userapp.API(app_id='test', token='abc', base_address=self.server.address, secure=False, user_snapshots=self.snapshots)
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+
+	def testChecksAgainstSnapshot(self):
+		self.assertTrue(self.api.has_permission('admin'))
+		self.assertFalse(self.api.has_permission(['admin', 'editor']))
+		self.assertFalse(self.api.has_permission('missing'))
+		self.assertTrue(self.api.has_feature('beta', user_id='Bob'))
+
+		self.assertEqual(len(self.server.calls), 1)
+		self.assertEqual(self.snapshots.get_stats()['local_checks'], 4)
+
+	def testSnapshotsUsersReturnedByGet(self):
+		self.api.user.get(user_id='Alice')
+		self.assertTrue(self.api.has_permission('admin', user_id='Alice'))
+		self.assertEqual(len(self.server.calls), 1)
+
+	def testRefreshesAfterInvalidation(self):
+		self.api.has_permission('admin', user_id='Bob')
+		self.api.user.save(user_id='Bob', first_name='Robert')
+		self.api.has_permission('admin', user_id='Bob')
+
+		self.assertEqual([call['method'] for call in self.server.calls], ['get', 'save', 'get'])
+
+	def testRefreshesSelfAfterWriteById(self):
+		self.api.has_permission('admin')
+		self.api.user.save(user_id='Bob', first_name='Robert')
+		self.api.has_permission('admin')
+
+		self.assertEqual([call['method'] for call in self.server.calls], ['get', 'save', 'get'])
+
+	def testRefreshesFromCachedResponse(self):
+		cache=userapp.ResponseCache()
+		other=userapp.API(app_id='test', token='abc', base_address=self.server.address, secure=False, cache=cache)
+		other.user.get(user_id='Bob')
+		other.close()
+
+		api=userapp.API(app_id='test', token='abc', base_address=self.server.address, secure=False, cache=cache, user_snapshots=self.snapshots)
+
+		for i in range(3):
+			self.assertTrue(api.has_permission('admin', user_id='Bob'))
+
+		api.close()
+
+		self.assertEqual(len(self.server.calls), 1)
+		self.assertEqual(self.snapshots.get_stats()['local_checks'], 3)
+		self.assertEqual(self.snapshots.get_stats()['remote_checks'], 0)
+
+	def testFallsBackToRemoteCheck(self):
+		self.server.on('user.get', [{'user_id':'Bob'}])
+		self.server.on('user.hasPermission', {'user_id':'Bob', 'missing_permissions':['admin']})
+
+		self.assertFalse(self.api.has_permission('admin', user_id='Bob'))
+		self.assertEqual(self.server.calls[-1]['arguments'], {'user_id':'Bob', 'permission':['admin']})
+
+	def testServiceMethodsAreStillCalledRemotely(self):
+		self.server.on('user.hasPermission', {'user_id':'Bob', 'missing_permissions':['admin']})
+
+		stubbed=userapp.API(app_id='test', token='abc', base_address=self.server.address, secure=False, user_snapshots=self.snapshots, schema=True)
+
+		for api in [self.api, stubbed]:
+			result=api.user.has_permission(user_id='Bob', permission='admin')
+
+			self.assertEqual(result.missing_permissions, ['admin'])
+			self.assertEqual(self.server.calls[-1]['method'], 'hasPermission')
+			self.assertEqual(self.server.calls[-1]['arguments'], {'user_id':'Bob', 'permission':'admin'})
+
+		stubbed.close()
+
+		self.assertEqual(len(self.server.calls), 2)
+
+class PaginatorTests(unittest.TestCase):
+	def setUp(self):
+		users=[{'user_id':str(i)} for i in range(23)]
+
+		def search(arguments, headers):
+			start=(arguments['page']-1)*arguments['page_size']
+			return {'items':users[start:start+arguments['page_size']], 'total_items':len(users)}
+
+		def search_without_total(arguments, headers):
+			return {'items':search(arguments, headers)['items']}
+
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.search', search)
+		self.server.on('user.invoice.search', search_without_total)
+		self.api=userapp.API(app_id='test', base_address=self.server.address, secure=False)
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+
+	def testYieldsAllItemsInOrder(self):
+		paginator=self.api.user.search.iter(page_size=5, filters={'query':'*'})
+		users=[user.user_id for user in paginator]
+
+		self.assertEqual(users, [str(i) for i in range(23)])
+		self.assertEqual(paginator.total_items, 23)
+		self.assertEqual(sorted(call['arguments']['page'] for call in self.server.calls), [1, 2, 3, 4, 5])
+		self.assertEqual(self.server.calls[0]['arguments']['filters'], {'query':'*'})
+
+	def testFetchesPagesInParallel(self):
+		users=[user.user_id for user in self.api.user.search.iter(page_size=2, parallel=4)]
+
+		self.assertEqual(users, [str(i) for i in range(23)])
+		self.assertEqual(len(self.server.calls), 12)
+
+	def testStopsOnShortPageWithoutTotal(self):
+		users=[invoice.user_id for invoice in self.api.user.invoice.search.iter(page_size=10)]
+
+		self.assertEqual(users, [str(i) for i in range(23)])
+		self.assertEqual(len(self.server.calls), 3)
+
+class StreamingResultTests(unittest.TestCase):
+	def setUp(self):
+		self.users=[{'user_id':str(i), 'first_name':u'\u00c5sa', 'properties':{'age':{'value':i}}} for i in range(10)]
+
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.search', lambda arguments, headers: {'items':self.users, 'total_items':len(self.users)})
+		self.server.on('user.invoice.search', lambda arguments, headers: ('{"total_items": 10, "items": '+json.dumps(self.users)+'}').encode('utf-8'))
+		self.server.on('user.save', {'error_code':'INVALID_ARGUMENT_USER_ID', 'message':'Invalid user id.'})
+		self.api=userapp.API(app_id='test', base_address=self.server.address, secure=False)
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+
+	def testYieldsItemsOneByOne(self):
+		result=self.api.user.search.stream(page_size=10)
+
+		self.assertEqual([user.properties.age.value for user in result], list(range(10)))
+		self.assertEqual(result.total_items, 10)
+
+	def testReadsFieldsBeforeItemsUpFront(self):
+		result=self.api.user.invoice.search.stream()
+
+		self.assertEqual(result.total_items, 10)
+		self.assertEqual(len(result._read_ahead), 0)
+		self.assertEqual([invoice.user_id for invoice in result.items], [str(i) for i in range(10)])
+
+	def testReadsAheadForFieldsAfterItems(self):
+		result=self.api.user.search.stream()
+
+		self.assertEqual(result.total_items, 10)
+		self.assertEqual([user.first_name for user in result], [u'\u00c5sa']*10)
+
+	def testParsesValuesSplitAcrossChunks(self):
+		class ChunkedResponse(object):
+			def iter_content(self, chunk_size):
+				content=('{"items": [{"name": "\u00c5sa"}, {"name": "Bob"}], "total_items": 12345}').encode('utf-8')
+				return (content[i:i+1] for i in range(len(content)))
+
+		result=userapp.StreamingResult(ChunkedResponse())
+
+		self.assertEqual([item.name for item in result], [u'\u00c5sa', 'Bob'])
+		self.assertEqual(result.total_items, 12345)
+
+	def testRaisesErrorResults(self):
+		with self.assertRaises(userapp.UserAppServiceException):
+			self.api.user.save.stream(user_id='Bob')
+
+	def testReleasesConnectionWhenRead(self):
+		for i in range(3):
+			list(self.api.user.search.stream())
+
+		self.assertEqual(self.api.get_pool_stats()['connections_created'], 1)
+
+class UserExporterTests(unittest.TestCase):
+	def setUp(self):
+		self.users=[{'user_id':str(i), 'properties':{'age':{'value':i, 'override':False}}} for i in range(23)]
+		self.failing_pages=[]
+
+		def search(arguments, headers):
+			if arguments['page'] in self.failing_pages:
+				self.failing_pages.remove(arguments['page'])
+				return 500, {}
+
+			start=(arguments['page']-1)*arguments['page_size']
+			return {'items':self.users[start:start+arguments['page_size']], 'total_items':len(self.users)}
+
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.search', search)
+		self.api=userapp.API(app_id='test', base_address=self.server.address, secure=False)
+		self.directory=tempfile.mkdtemp()
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+		shutil.rmtree(self.directory)
+
+	def read(self, path):
+		with (gzip.open(path) if path.endswith('.gz') else open(path, 'rb')) as f:
+			return [json.loads(line.decode('utf-8')) for line in f.read().splitlines()]
+
+	def testExportsUsersAsNdjson(self):
+		path=os.path.join(self.directory, 'users.ndjson')
+		stats=userapp.UserExporter(self.api, page_size=5, parallel=3).export(path)
+
+		self.assertEqual(self.read(path), self.users)
+		self.assertEqual(stats, {'users':23, 'pages':5, 'resumed_from':None})
+		self.assertEqual(self.server.calls[0]['arguments']['sort_field'], 'created_at')
+		self.assertFalse(os.path.exists(path+'.checkpoint'))
+
+	def testCompressesOutput(self):
+		path=os.path.join(self.directory, 'users.ndjson.gz')
+		userapp.UserExporter(self.api, page_size=5).export(path)
+
+		self.assertEqual(self.read(path), self.users)
+
+	def testResumesFromCheckpoint(self):
+		for name in ['users.ndjson', 'users.ndjson.gz']:
+			path=os.path.join(self.directory, name)
+			exporter=userapp.UserExporter(self.api, page_size=5, parallel=1)
+			self.failing_pages.append(3)
+
+			with self.assertRaises(userapp.UserAppTransportException):
+				exporter.export(path)
+
+			self.assertTrue(os.path.exists(path+'.checkpoint'))
+
+			stats=exporter.export(path)
+
+			self.assertEqual(stats['resumed_from'], 3)
+			self.assertEqual(stats['users'], 23)
+			self.assertEqual(self.read(path), self.users)
+
+	def testCanExportFromCommandLine(self):
+		path=os.path.join(self.directory, 'users.ndjson.gz')
+		result=userapp.__main__.main(['--app-id', 'test', '--base-address', self.server.address, '--insecure', 'export', path, '--page-size', '10'])
+
+		self.assertEqual(result, 0)
+		self.assertEqual(self.read(path), self.users)
+
+class BulkWriterTests(unittest.TestCase):
+	def setUp(self):
+		self.attempts={}
+		self.gate=threading.Event()
+		self.gate.set()
+
+		def save(arguments, headers):
+			self.gate.wait()
+			user_id=arguments['user_id']
+			self.attempts[user_id]=self.attempts.get(user_id, 0)+1
+
+			if user_id == 'invalid':
+				return {'error_code':'INVALID_ARGUMENT_USER_ID', 'message':'Invalid user id.'}
+			if user_id == 'down' or (user_id == 'flaky' and self.attempts[user_id] == 1):
+				return 500, {}
+
+			return {'user_id':user_id}
+
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.save', save)
+		self.api=userapp.API(app_id='test', base_address=self.server.address, secure=False)
+		self.directory=tempfile.mkdtemp()
+
+	def tearDown(self):
+		self.gate.set()
+		self.api.close()
+		self.server.stop()
+		shutil.rmtree(self.directory)
+
+	def testReportsOutcomeOfEveryRecord(self):
+		records=[{'user_id':user_id} for user_id in ['a', 'invalid', 'flaky', 'down', 'b']]
+		report=StringIO()
+		stats=userapp.BulkWriter(self.api, max_workers=3, backoff=0.001).write(records, report=report)
+
+		outcomes=[json.loads(line) for line in report.getvalue().splitlines()]
+
+		self.assertEqual([outcome['index'] for outcome in outcomes], [0, 1, 2, 3, 4])
+		self.assertEqual([outcome['status'] for outcome in outcomes], ['ok', 'error', 'transport_error', 'transport_error', 'ok'])
+		self.assertEqual(outcomes[1]['error_code'], 'INVALID_ARGUMENT_USER_ID')
+		self.assertEqual(stats['succeeded'], 2)
+		self.assertEqual(stats['failed'], 3)
+		self.assertEqual(stats['error_codes'], {'INVALID_ARGUMENT_USER_ID':1, 'UserAppTransportException':2})
+
+	def testRetriesWritesOnlyWhenNoConnectionWasMade(self):
+		records=[{'user_id':'flaky'}, {'user_id':'down'}]
+		stats=userapp.BulkWriter(self.api, max_workers=2, backoff=0.001).write(records)
+
+		# The server may have saved them, so failed saves are not sent again
+		self.assertEqual(self.attempts, {'flaky':1, 'down':1})
+		self.assertEqual(stats['retries'], 0)
+
+		self.api.set_option('base_address', '127.0.0.1:1')
+		report=StringIO()
+		stats=userapp.BulkWriter(self.api, max_workers=2, backoff=0.001).write(records, report=report)
+
+		self.assertEqual([json.loads(line)['attempts'] for line in report.getvalue().splitlines()], [3, 3])
+		self.assertEqual(stats['retries'], 4)
+		self.assertEqual(stats['error_codes'], {'UserAppConnectionException':2})
+
+	def testHoldsBackRecordsWhileCallsArePending(self):
+		read=[]
+
+		def records():
+			for i in range(50):
+				read.append(i)
+				yield {'user_id':str(i)}
+
+		self.gate.clear()
+		writer=userapp.BulkWriter(self.api, max_workers=2, max_pending=4)
+		thread=threading.Thread(target=writer.write, args=(records(),))
+		thread.start()
+		time.sleep(0.2)
+
+		self.assertEqual(len(read), 4)
+
+		self.gate.set()
+		thread.join()
+
+		self.assertEqual(len(self.attempts), 50)
+
+	def testCanWriteFromCommandLine(self):
+		path=os.path.join(self.directory, 'users.ndjson')
+		report_path=os.path.join(self.directory, 'report.ndjson')
+
+		with open(path, 'w') as f:
+			f.write('{"user_id":"a"}\n{"user_id":"invalid"}\n\n{"user_id":"b"}\n')
+
+		result=userapp.__main__.main(['--app-id', 'test', '--base-address', self.server.address, '--insecure', 'write', path, '--report', report_path])
+
+		with open(report_path) as f:
+			statuses=[json.loads(line)['status'] for line in f]
+
+		self.assertEqual(result, 1)
+		self.assertEqual(statuses, ['ok', 'error', 'ok'])
+
+	def testReportsMalformedLinesAndContinues(self):
+		path=os.path.join(self.directory, 'users.ndjson')
+
+		with open(path, 'w') as f:
+			f.write('{"user_id":"a"}\n{"user_id":\n{"user_id":"b"}\n')
+
+		report=StringIO()
+		stats=userapp.BulkWriter(self.api).write_file(path, report=report)
+
+		outcomes=[json.loads(line) for line in report.getvalue().splitlines()]
+
+		self.assertEqual([outcome['status'] for outcome in outcomes], ['ok', 'error', 'ok'])
+		self.assertEqual(outcomes[1]['attempts'], 1)
+		self.assertEqual(sorted(self.attempts), ['a', 'b'])
+		self.assertEqual(stats['failed'], 1)
+		self.assertEqual(stats['retries'], 0)
+
+class CredentialsTests(unittest.TestCase):
+	def setUp(self):
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.get', lambda arguments, headers: [{'user_id':arguments.get('user_id')}])
+		self.server.on('user.login', lambda arguments, headers: {'token':'session-'+arguments.get('login'), 'user_id':arguments.get('login')})
+		self.server.on('user.logout', {})
+		self.api=userapp.API(app_id='test', token='shared', base_address=self.server.address, secure=False)
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+
+	def authorization(self, token):
+		return 'Basic '+base64.b64encode(('test:'+token).encode('ascii')).decode('ascii')
+
+	def testUsesTokenWithinBlock(self):
+		with self.api.as_token('abc'):
+			self.api.user.get(user_id='Bob')
+			self.assertEqual(self.api.get_option('token'), 'abc')
+
+		self.api.user.get(user_id='Bob')
+
+		self.assertEqual(self.server.calls[0]['headers']['authorization'], self.authorization('abc'))
+		self.assertEqual(self.server.calls[1]['headers']['authorization'], self.authorization('shared'))
+
+	def testLoginAndLogoutOnlyAffectBlock(self):
+		with self.api.as_token(''):
+			self.api.user.login(login='Bob', password='secret')
+			self.assertEqual(self.api.get_option('token'), 'session-Bob')
+			self.api.user.logout()
+			self.assertEqual(self.api.get_option('token'), '')
+
+		self.assertEqual(self.api.get_option('token'), 'shared')
+
+	def testBatchedCallsUseTokenOfBlock(self):
+		with self.api.as_token('abc'):
+			with self.api.batch() as batch:
+				for i in range(4):
+					batch.user.get(user_id=str(i))
+
+		self.assertEqual(set(call['headers']['authorization'] for call in self.server.calls), set([self.authorization('abc')]))
+
+	def testLoginInGatheredCallDoesNotChangeSubmitterToken(self):
+		with self.api.as_token(''):
+			self.api.user.login(login='bob', password='secret')
+			self.api.gather([(self.api.user.login, {'login':'alice', 'password':'secret'})])
+			self.api.user.get(user_id='bob')
+
+			self.assertEqual(self.api.get_option('token'), 'session-bob')
+
+		self.assertEqual(self.server.calls[-1]['headers']['authorization'], self.authorization('session-bob'))
+
+	@unittest.skipIf(asyncio is None, "asyncio is not available")
+	def testLoginInTaskDoesNotChangeOtherTasksToken(self):
+		loop=asyncio.new_event_loop()
+		api=userapp.AsyncAPI(app_id='test', token='shared', base_address=self.server.address, secure=False)
+
+		try:
+			with api.as_token('parent'):
+				# Both tasks run in copies of the block's context
+				loop.run_until_complete(api.user.login(login='alice', password='secret'))
+				loop.run_until_complete(api.user.get(user_id='parent'))
+
+				self.assertEqual(api.get_option('token'), 'parent')
+		finally:
+			loop.run_until_complete(api.close())
+			loop.close()
+
+		self.assertEqual(self.server.calls[-1]['headers']['authorization'], self.authorization('parent'))
+
+	def testTokensDoNotBleedBetweenThreads(self):
+		start=threading.Event()
+		errors=[]
+
+		def worker(i):
+			start.wait()
+
+			try:
+				with self.api.as_token('token{i}'.format(i=i)):
+					for j in range(10):
+						self.api.user.get(user_id='{i}-before'.format(i=i))
+
+					self.api.user.login(login='user{i}'.format(i=i), password='secret')
+
+					for j in range(10):
+						self.api.user.get(user_id='{i}-after'.format(i=i))
+			except Exception as e:
+				errors.append(e)
+
+		threads=[threading.Thread(target=worker, args=(i,)) for i in range(16)]
+
+		for thread in threads:
+			thread.start()
+
+		start.set()
+
+		for thread in threads:
+			thread.join()
+
+		self.assertEqual(errors, [])
+		self.assertEqual(len(self.server.calls), 16*21)
+
+		for call in self.server.calls:
+			if call['method'] != 'get':
+				continue
+
+			i, _, phase=call['arguments']['user_id'].partition('-')
+			token='token'+i if phase == 'before' else 'session-user'+i
+
+			self.assertEqual(call['headers']['authorization'], self.authorization(token))
+
+		self.assertEqual(self.api.get_option('token'), 'shared')
+
+class ClientPoolTests(unittest.TestCase):
+	def setUp(self):
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.get', lambda arguments, headers: [{'user_id':arguments.get('user_id')}])
+		self.api=userapp.API(app_id='template', base_address=self.server.address, secure=False, lazy_responses=True)
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+
+	def testHandlesShareConnectionPool(self):
+		for i in range(5):
+			result=self.api.for_app('app{i}'.format(i=i), 'token{i}'.format(i=i)).user.get(user_id='Bob')
+			self.assertTrue(isinstance(result[0], userapp.LazyIterableObject))
+
+		authorizations=[call['headers']['authorization'] for call in self.server.calls]
+
+		self.assertEqual(self.server.connections, 1)
+		self.assertEqual(self.api.get_pool_stats()['requests'], 5)
+		self.assertEqual(authorizations[3], 'Basic '+base64.b64encode(b'app3:token3').decode('ascii'))
+
+	def testReusesHandles(self):
+		handle=self.api.for_app('app', 'token')
+
+		self.assertTrue(self.api.for_app('app', 'token') is handle)
+		self.assertFalse(self.api.for_app('app', 'other') is handle)
+		self.assertTrue(handle.get_client()._transport is self.api.get_client()._transport)
+
+	def testEvictsLeastRecentlyUsedHandles(self):
+		pool=userapp.ClientPool(self.api, max_clients=2)
+
+		first=pool.get('app1')
+		pool.get('app2')
+		pool.get('app1')
+		pool.get('app3')
+
+		self.assertTrue(pool.get('app1') is first)
+		self.assertEqual(pool.get_stats(), {'created':3, 'reused':2, 'evictions':1, 'clients':2})
+
+		pool.get('app2')
+
+		self.assertEqual(pool.get_stats()['created'], 4)
+
+class ServiceSchemaTests(unittest.TestCase):
+	def setUp(self):
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.get', lambda arguments, headers: [{'user_id':arguments.get('user_id')}])
+		self.server.on('user.resetPassword', {})
+		self.server.on('user.invoice.search', lambda arguments, headers: {'items':[{'invoice_id':str(i)} for i in range(3)], 'total_items':3})
+		self.server.on('user.export', {'url':'https://example.com/users.ndjson'})
+		self.api=userapp.API(app_id='test', base_address=self.server.address, secure=False, schema=True)
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+
+	def testCallsThroughGeneratedStubs(self):
+		result=self.api.user.get(user_id='Bob')
+		invoices=self.api.user.invoice.search(_timeout=5)
+
+		self.assertTrue(isinstance(self.api.user, userapp.ServiceStub))
+		self.assertTrue(isinstance(self.api.user.invoice.search, userapp.StubMethod))
+		self.assertEqual(result[0].user_id, 'Bob')
+		self.assertEqual(invoices.total_items, 3)
+		self.assertEqual([(call['service'], call['method']) for call in self.server.calls], [('user', 'get'), ('user.invoice', 'search')])
+
+	def testAcceptsBothNamingConventions(self):
+		self.api.user.reset_password(login='Bob')
+
+		self.assertTrue(self.api.user.payment_method is self.api.user.paymentMethod)
+		self.assertTrue(self.api.user.reset_password is self.api.user.resetPassword)
+		self.assertEqual(self.server.calls[0]['method'], 'resetPassword')
+
+	def testFallsBackToDynamicProxies(self):
+		result=self.api.user.export()
+
+		self.assertFalse(isinstance(self.api.user.export, userapp.StubMethod))
+		self.assertFalse(isinstance(self.api.widget, userapp.ServiceStub))
+		self.assertFalse(isinstance(self.api.v2.user, userapp.ServiceStub))
+		self.assertEqual(result.url, 'https://example.com/users.ndjson')
+
+	def testValidatesNamesLocallyWhenStrict(self):
+		self.api=userapp.API(app_id='test', base_address=self.server.address, secure=False, schema=userapp.ServiceSchema.get_default(strict=True))
+
+		with self.assertRaises(userapp.UserAppInvalidServiceException):
+			self.api.usr.get()
+
+		with self.assertRaises(userapp.UserAppInvalidMethodException):
+			self.api.user.gett()
+
+		with self.assertRaises(userapp.UserAppInvalidMethodException):
+			self.api.user.invoice.serch()
+
+		self.assertEqual(len(self.server.calls), 0)
+
+	def testLooksUpSpecialNamesWhenStrict(self):
+		self.api=userapp.API(app_id='test', base_address=self.server.address, secure=False, schema=userapp.ServiceSchema.get_default(strict=True))
+
+		hasattr(self.api, '__foo__')
+		hasattr(self.api.user, '__foo__')
+
+		self.assertEqual(len(self.server.calls), 0)
+
+	def testCanLoadSchemaFromFile(self):
+		directory=tempfile.mkdtemp()
+		path=os.path.join(directory, 'schema.json')
+
+		try:
+			with open(path, 'w') as f:
+				json.dump({'1':{'user':['export']}}, f)
+
+			api=userapp.API(app_id='test', base_address=self.server.address, secure=False, schema=userapp.ServiceSchema.load(path, strict=True))
+			result=api.user.export()
+		finally:
+			shutil.rmtree(directory)
+
+		self.assertTrue(isinstance(api.user.export, userapp.StubMethod))
+		self.assertEqual(result.url, 'https://example.com/users.ndjson')
+
+		with self.assertRaises(userapp.UserAppInvalidMethodException):
+			api.user.get()
+
+	def testWorksWithIteratingAndGathering(self):
+		invoices=list(self.api.user.invoice.search.iter(page_size=10))
+		results=self.api.gather([(self.api.user.get, {'user_id':'Bob'}), (self.api.user.invoice.search, {})])
+
+		self.assertEqual([invoice.invoice_id for invoice in invoices], ['0', '1', '2'])
+		self.assertEqual(results[0][0].user_id, 'Bob')
+		self.assertEqual(results[1].total_items, 3)
+
+	def testSharesStubsBetweenClients(self):
+		other=userapp.API(app_id='other', schema=True)
+		handle=self.api.for_app('other')
+
+		self.assertTrue(type(other.user) is type(self.api.user))
+		self.assertTrue(type(handle.user) is type(self.api.user))
+		self.assertTrue(other.user.get.get_client() is other.get_client())
+
+class BatchTests(unittest.TestCase):
+	def setUp(self):
+		def get_user(arguments, headers):
+			time.sleep(0.1)
+			return [{'user_id':arguments.get('user_id')}]
+
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.get', get_user)
+		self.server.on('user.count', 3)
+		self.api=userapp.API(app_id='test', base_address=self.server.address, secure=False)
+
+	def tearDown(self):
+		self.api.close()
+		self.server.stop()
+
+	def testReturnsResultsInSubmissionOrder(self):
+		with self.api.batch() as batch:
+			count=batch.user.count()
+			users=[batch.user.get(user_id=str(i)) for i in range(5)]
+			missing=batch.user.nonExisting()
+
+		self.assertEqual(count.result(), 3)
+		self.assertEqual([user.result()[0].user_id for user in users], [str(i) for i in range(5)])
+		self.assertTrue(isinstance(missing.exception(), userapp.UserAppInvalidMethodException))
+		self.assertEqual(batch.results[0], 3)
+		self.assertTrue(isinstance(batch.results[6], userapp.UserAppInvalidMethodException))
+
+	def testFailsQueuedCallsWhenBlockRaises(self):
+		with self.assertRaises(KeyError):
+			with self.api.batch() as batch:
+				count=batch.user.count()
+				{}['missing']
+
+		self.assertTrue(isinstance(count.exception(timeout=1), KeyError))
+		self.assertEqual(len(self.server.calls), 0)
+
+	def testDispatchesCallsConcurrently(self):
+		start=time.time()
+		results=self.api.gather([(self.api.user.get, {'user_id':str(i)}) for i in range(8)], max_workers=8)
+
+		self.assertTrue(time.time()-start < 0.5)
+		self.assertEqual([result[0].user_id for result in results], [str(i) for i in range(8)])
+
+class RawServer(object):
+	"""
+	Accepts a single connection and answers its request with raw
+	bytes, or not at all, then waits for the client to close it.
+	"""
+	def __init__(self, reply=None):
+		self.reply=reply
+		self.closed=threading.Event()
+		self.socket=socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		self.socket.bind(('127.0.0.1', 0))
+		self.socket.listen(1)
+		self.address='{h}:{p}'.format(h=self.socket.getsockname()[0], p=self.socket.getsockname()[1])
+
+		thread=threading.Thread(target=self.serve)
+		thread.daemon=True
+		thread.start()
+
+	def serve(self):
+		connection, _=self.socket.accept()
+		connection.recv(65536)
+
+		if self.reply is not None:
+			connection.sendall(self.reply)
+
+		while connection.recv(65536):
+			pass
+
+		self.closed.set()
+		connection.close()
+
+	def stop(self):
+		self.socket.close()
+
+@unittest.skipIf(asyncio is None, "asyncio is not available")
+class AsyncAPITests(unittest.TestCase):
+	def setUp(self):
+		self.server=stub_server.StubServer().start()
+		self.server.on('user.get', lambda arguments, headers: [{'user_id':arguments.get('user_id')}])
+		self.server.on('user.login', {'token':'abc123', 'user_id':'Bob'})
+		self.server.on('user.logout', {})
+		self.server.on('user.save', {'error_code':'INVALID_ARGUMENT_USER_ID', 'message':'Invalid user id.'})
+		self.loop=asyncio.new_event_loop()
+		asyncio.set_event_loop(self.loop)
+		self.api=userapp.AsyncAPI(app_id='test', base_address=self.server.address, secure=False)
+
+	def tearDown(self):
+		self.loop.run_until_complete(self.api.close())
+		self.loop.close()
+		asyncio.set_event_loop(None)
+		self.server.stop()
+
+	def testCanAwaitProxiedCall(self):
+		result=self.loop.run_until_complete(self.api.user.get(user_id='Bob'))
+		self.assertEqual(result[0].user_id, 'Bob')
+
+	def testRunsCallsConcurrentlyOverPool(self):
+		calls=[self.api.user.get(user_id=str(i)) for i in range(10)]
+		results=self.loop.run_until_complete(asyncio.gather(*calls))
+
+		self.assertEqual([r[0].user_id for r in results], [str(i) for i in range(10)])
+		self.assertEqual(self.api.get_pool_stats()['requests'], 10)
+		self.assertTrue(self.server.connections <= 10)
+
+		self.loop.run_until_complete(self.api.user.get(user_id='Bob'))
+		self.assertEqual(self.api.get_pool_stats()['connections_reused'], 1)
+
+	def testSetsAndUnsetsTokenOnLoginAndLogout(self):
+		self.loop.run_until_complete(self.api.user.login(login='Bob', password='secret'))
+		self.assertEqual(self.api.get_option('token'), 'abc123')
+
+		self.loop.run_until_complete(self.api.user.logout())
+		self.assertEqual(self.api.get_option('token'), '')
+
+	def testRaisesServiceExceptions(self):
+		with self.assertRaises(userapp.UserAppServiceException) as context:
+			self.loop.run_until_complete(self.api.user.save(user_id='invalid'))
+
+		self.assertEqual(context.exception.error_code, 'INVALID_ARGUMENT_USER_ID')
+
+		with self.assertRaises(userapp.UserAppInvalidMethodException):
+			self.loop.run_until_complete(self.api.user.nonExisting())
+
+	def testClosesConnectionOfTimedOutCall(self):
+		server=RawServer()
+		self.api.set_option('base_address', server.address)
+
+		try:
+			with self.assertRaises(userapp.UserAppTimeoutException):
+				self.loop.run_until_complete(self.api.user.get(user_id='Bob', _timeout=0.1))
+
+			self.assertTrue(server.closed.wait(2))
+		finally:
+			server.stop()
+
+	def testWrapsMalformedResponse(self):
+		server=RawServer(b'garbage\r\n\r\n')
+		self.api.set_option('base_address', server.address)
+
+		try:
+			with self.assertRaises(userapp.UserAppTransportException):
+				self.loop.run_until_complete(self.api.user.get(user_id='Bob'))
+
+			self.assertTrue(server.closed.wait(2))
+		finally:
+			server.stop()
+
+	def testRejectsHedging(self):
+		with self.assertRaises(userapp.UserAppInvalidOptionException):
+			userapp.AsyncAPI(app_id='test', hedging=True)
+
+		with self.assertRaises(userapp.UserAppInvalidOptionException):
+			self.api.set_option('hedging', userapp.RequestHedger())
+
+		self.api.set_option('hedging', None)
+
+	def testRejectsBatches(self):
+		with self.assertRaises(userapp.UserAppException):
+			self.api.batch()
+
+		with self.assertRaises(userapp.UserAppException):
+			self.api.gather([(self.api.user.get, {'user_id':'Bob'})])
+
+		self.assertEqual(len(self.server.calls), 0)
+
+	def testRejectsIteration(self):
+		with self.assertRaises(userapp.UserAppException):
+			self.api.user.search.iter(page_size=10)
+
+		self.assertEqual(len(self.server.calls), 0)
+
+	def testRetriesShareTimeoutOfCall(self):
+		self.server.on('user.search', lambda arguments, headers: time.sleep(0.2) or {})
+		self.api.set_option('retry', userapp.RetryPolicy(max_attempts=3, backoff=0.001))
+		start=time.time()
+
+		with self.assertRaises(userapp.UserAppTimeoutException):
+			self.loop.run_until_complete(self.api.user.search(_timeout=0.1))
+
+		self.assertTrue(time.time() - start < 0.18)
+
+	def testCompressesRequestsAndResponses(self):
+		self.server.on('user.save', lambda arguments, headers: arguments)
+		self.server.compression='gzip'
+		self.api.set_option('compression', userapp.Compression(min_size=0))
+
+		result=self.loop.run_until_complete(self.api.user.save(user_id='Bob'))
+		stats=self.api.get_option('compression').get_stats()
+
+		self.assertEqual(result.user_id, 'Bob')
+		self.assertEqual(self.server.calls[0]['headers']['content-encoding'], 'gzip')
+		self.assertEqual(stats['requests_compressed'], 1)
+		self.assertEqual(stats['responses_compressed'], 1)
+
 def main():
 	unittest.main()
 
@@ -1,11 +1,88 @@
 """ Base class for making API calls to the UserApp API. """
 
+import os
 import sys
 import re
+import gzip
+import zlib
 import json
+import codecs
 import base64
+import bisect
+import random
+import hashlib
+import time
 import logging
-import requests
+import weakref
+import threading
+import contextlib
+import collections
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:
+    from urlparse import urlsplit
+
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+# Imported on first use, see import_requests, import_http_client and import_orjson
+requests = None
+httplib = None
+socket = None
+orjson = None
+
+def import_requests():
+    """
+    Import requests on first use, keeping it out of the
+    cost of importing userapp and constructing clients.
+    """
+    global requests
+
+    if requests is None:
+        import requests.adapters
+
+    return requests
+
+def import_http_client():
+    """
+    Import the standard library HTTP client on first use.
+    """
+    global httplib, socket
+
+    if httplib is None:
+        import socket
+
+        try:
+            import http.client as httplib
+        except ImportError:
+            import httplib
+
+    return httplib
+
+def import_orjson():
+    """
+    Import orjson on first use, returning None if it is not installed.
+    """
+    global orjson
+
+    if orjson is None:
+        try:
+            import orjson
+        except ImportError:
+            pass
+
+    return orjson
+
+# Used by clients not given a logger of their own
+default_logger = logging.getLogger(__name__)
 
 class IterableObjectEncoder(json.JSONEncoder):
     def default(self, obj):
@@ -15,27 +92,39 @@ class IterableObject(object):
     """
     Wraps a dictionary and makes it feel and
     look like an object but with the power of being iterable.
+
+    The wrapped dictionary is kept as is, nested dictionaries
+    and lists are wrapped in views that write through to it.
     """
+    __slots__ = ('source', '_cache')
+
     def __init__(self, source):
         object.__setattr__(self, 'source', source)
+        object.__setattr__(self, '_cache', None)
 
     def __iter__(self):
-        return self.source.items()
+        return iter([(key, self._get(key)) for key in list(self.source.keys())])
 
     def __getattr__(self, key):
         if not key in self.source:
             raise AttributeError("Object has not attribute '{k}'".format(k=key))
 
-        return self.source[key]
+        return self._get(key)
 
     def __setattr__(self, key, value):
         if isinstance(value, dict) or isinstance(value, list):
-            value=DictionaryUtility.to_object(value)
-        
+            value=DictionaryUtility.wrap(value)
+
+        if isinstance(value, IterableObject) or isinstance(value, IterableList):
+            self._set_cached(key, value)
+            value=value.source
+        elif self._cache is not None:
+            self._cache.pop(key, None)
+
         self.source[key]=value
 
     def __getitem__(self, key):
-        return self.source[key]
+        return self._get(key)
 
     def __setitem__(self, key, value):
         self.__setattr__(key, value)
@@ -50,10 +139,123 @@ class IterableObject(object):
         return str(self.source)
 
     def to_json(self):
-        return json.dumps(self, cls=IterableObjectEncoder)
+        return json.dumps(self.source, cls=IterableObjectEncoder)
+
+    def to_dict(self):
+        """
+        Returns the wrapped dictionary. It is shared with
+        this object, not copied.
+        """
+        return self.source
+
+    def _get(self, key):
+        if self._cache is not None and key in self._cache:
+            return self._cache[key]
+
+        value=self.source[key]
+
+        if isinstance(value, dict) or isinstance(value, list):
+            value=DictionaryUtility.to_lazy_object(value)
+            self._set_cached(key, value)
+
+        return value
+
+    def _set_cached(self, key, value):
+        if self._cache is None:
+            object.__setattr__(self, '_cache', {})
+
+        self._cache[key]=value
+
+class LazyIterableObject(IterableObject):
+    """
+    An IterableObject whose nested dictionaries and
+    lists are only wrapped once they are accessed.
+    """
+    __slots__ = ()
+
+class IterableList(list):
+    """
+    A list of wrapped values that writes changes
+    through to the list it wraps.
+    """
+    __slots__ = ('source',)
+
+    def __init__(self, source, values):
+        list.__init__(self, values)
+        self.source = source
+
+    def __setitem__(self, index, value):
+        if isinstance(index, slice):
+            values = [DictionaryUtility.wrap(v) for v in value]
+            list.__setitem__(self, index, values)
+            self.source[index] = [DictionaryUtility.unwrap(v) for v in values]
+        else:
+            value = DictionaryUtility.wrap(value)
+            list.__setitem__(self, index, value)
+            self.source[index] = DictionaryUtility.unwrap(value)
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        del self.source[index]
+
+    # Python 2 routes simple slices through these
+    def __setslice__(self, i, j, values):
+        self.__setitem__(slice(i, j), values)
+
+    def __delslice__(self, i, j):
+        self.__delitem__(slice(i, j))
+
+    def __iadd__(self, values):
+        self.extend(values)
+        return self
+
+    def __imul__(self, count):
+        list.__imul__(self, count)
+        self._write_back()
+        return self
+
+    def append(self, value):
+        value = DictionaryUtility.wrap(value)
+        list.append(self, value)
+        self.source.append(DictionaryUtility.unwrap(value))
+
+    def extend(self, values):
+        for value in values:
+            self.append(value)
+
+    def insert(self, index, value):
+        value = DictionaryUtility.wrap(value)
+        list.insert(self, index, value)
+        self.source.insert(index, DictionaryUtility.unwrap(value))
+
+    def pop(self, index=-1):
+        value = list.pop(self, index)
+        self.source.pop(index)
+        return value
+
+    def remove(self, value):
+        del self[self.index(value)]
+
+    def reverse(self):
+        list.reverse(self)
+        self.source.reverse()
+
+    def sort(self, *args, **kwargs):
+        # Sorted by the wrapped values, so keys see objects rather than dictionaries
+        list.sort(self, *args, **kwargs)
+        self._write_back()
+
+    def clear(self):
+        del self[:]
+
+    def _write_back(self):
+        self.source[:] = [DictionaryUtility.unwrap(value) for value in self]
+
+    def to_json(self):
+        return json.dumps(self.source, cls=IterableObjectEncoder)
 
     def to_dict(self):
-        return DictionaryUtility.to_dict(self)
+        return self.source
 
 class DictionaryUtility:
     """
@@ -64,19 +266,83 @@ class DictionaryUtility:
         """
         Convert a dictionary to an object (recursive).
         """
-        def convert(item): 
+        new_object = object.__new__
+        set_source = IterableObject.source.__set__
+        set_cache = IterableObject._cache.__set__
+
+        def convert(item):
             if isinstance(item, dict):
-                return IterableObject({k: convert(v) for k, v in item.items()})
+                cache = None
+                for key, value in item.items():
+                    if isinstance(value, (dict, list)):
+                        if cache is None:
+                            cache = {}
+                        cache[key] = convert(value)
+
+                # Setting the slots directly skips the cost of __init__
+                result = new_object(IterableObject)
+                set_source(result, item)
+                set_cache(result, cache)
+                return result
             if isinstance(item, list):
-                def yield_convert(item):
-                    for index, value in enumerate(item):
-                        yield convert(value)
-                return list(yield_convert(item))
+                return IterableList(item, [convert(value) for value in item])
             else:
                 return item
 
         return convert(item)
 
+    @staticmethod
+    def wrap(item):
+        """
+        Convert an assigned value to an object. Objects within it, i.e.
+        from obj.locks = [lock for lock in obj.locks], are replaced by
+        what they wrap, so that wrapped data never holds objects.
+        """
+        def strip(item):
+            if isinstance(item, IterableList):
+                return
+            elif isinstance(item, dict):
+                keys = item.keys()
+            elif isinstance(item, list):
+                keys = range(len(item))
+            else:
+                return
+
+            for key in keys:
+                value = item[key]
+
+                if isinstance(value, IterableObject) or isinstance(value, IterableList):
+                    item[key] = value.source
+                else:
+                    strip(value)
+
+        strip(item)
+
+        return DictionaryUtility.to_object(item)
+
+    @staticmethod
+    def to_lazy_object(item):
+        """
+        Convert a dictionary to an object, deferring the
+        conversion of nested values until they are accessed.
+        """
+        if isinstance(item, dict):
+            return LazyIterableObject(item)
+        if isinstance(item, list):
+            return IterableList(item, [DictionaryUtility.to_lazy_object(value) for value in item])
+        else:
+            return item
+
+    @staticmethod
+    def unwrap(item):
+        """
+        Get the dictionary or list wrapped by an object.
+        """
+        if isinstance(item, IterableObject) or isinstance(item, IterableList):
+            return item.source
+
+        return item
+
     @staticmethod
     def to_dict(item):
         """
@@ -84,10 +350,7 @@ class DictionaryUtility:
         """
         def convert(item):
             if isinstance(item, IterableObject):
-                if isinstance(item.source, dict):
-                    return {k: convert(v.source) if hasattr(v, 'source') else convert(v) for k, v in item}
-                else:
-                    return convert(item.source)
+                return convert(item.source)
             elif isinstance(item, dict):
                 return {k: convert(v) for k, v in item.items()}
             elif isinstance(item, list):
@@ -100,6 +363,48 @@ class DictionaryUtility:
 
         return convert(item)
 
+class JsonCodec(object):
+    """
+    Encodes request bodies and decodes response bodies
+    using the json module of the standard library.
+    """
+    name = 'json'
+
+    def dumps(self, data):
+        return json.dumps(data, cls=IterableObjectEncoder)
+
+    def loads(self, content):
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+
+        return json.loads(content)
+
+    @staticmethod
+    def get_fastest():
+        """
+        Get the fastest codec available, falling back to JsonCodec.
+        """
+        if import_orjson() is not None:
+            return OrjsonCodec()
+
+        return JsonCodec()
+
+class OrjsonCodec(JsonCodec):
+    """
+    Codec backed by orjson, decoding directly from response bytes.
+    """
+    name = 'orjson'
+
+    def __init__(self):
+        if import_orjson() is None:
+            raise ImportError("OrjsonCodec requires the orjson package.")
+
+    def dumps(self, data):
+        return orjson.dumps(data, default=DictionaryUtility.unwrap)
+
+    def loads(self, content):
+        return orjson.loads(content)
+
 class UserAppException(Exception):
     """
     Base class for all UserApp exceptions.
@@ -112,6 +417,26 @@ class UserAppTransportException(UserAppException):
     """
     pass
 
+class UserAppConnectionException(UserAppTransportException):
+    """
+    A connection to the API could not be made.
+    """
+    pass
+
+class UserAppCircuitOpenException(UserAppTransportException):
+    """
+    Calls to the host are failing, so the call was not attempted.
+    """
+    def __init__(self, message, host=None):
+        UserAppTransportException.__init__(self, message)
+        self.host = host
+
+class UserAppTimeoutException(UserAppTransportException):
+    """
+    A call did not complete within its deadline.
+    """
+    pass
+
 class UserAppInvalidOptionException(Exception):
     """
     Option does not exist.
@@ -143,203 +468,2453 @@ class UserAppServiceException(UserAppException):
         UserAppException.__init__(self, message)
         self.error_code = error_code
 
-class NativeTransport(object):
-    def __init__(self, logger):
-        self._logger = logger
+class ContextLocal(object):
+    """
+    A value local to the current contextvars context, so that it
+    follows asyncio tasks. Falls back to a value per thread where
+    contextvars is not available.
+    """
+    _instances = weakref.WeakSet()
 
-    def call(self, method, url, headers=None, body=None):
-        if headers is None:
-            headers={}
+    def __init__(self, name):
+        if contextvars is not None:
+            self._var = contextvars.ContextVar(name, default=None)
+        else:
+            self._local = threading.local()
+            ContextLocal._instances.add(self)
 
-        if 'Content-Type' in headers:
-            if headers['Content-Type'] == 'application/json':
+    def get(self):
+        if contextvars is not None:
+            return self._var.get()
 
-                body=json.dumps(body)
+        return getattr(self._local, 'value', None)
 
-        if method != 'post':
-            raise UserAppTransportException("Method {m} not supported.".format(m=method))
+    def set(self, value):
+        """
+        Set the value, returning the previous one.
+        """
+        previous = self.get()
 
-        self._logger.debug("Calling {m} {u} with headers {h} and body {b}".format(
-            m=method,
-            u=url,
-            h=headers,
-            b=body
-        ))
+        if contextvars is not None:
+            self._var.set(value)
+        else:
+            self._local.value = value
 
-        response=requests.post(
-            url=url,
-            data=body,
-            headers=headers,
-            verify=True
-        )
+        return previous
 
-        return response
+    @staticmethod
+    def bind(fn):
+        """
+        Wrap fn to run with the context-local values of the
+        caller, for handing it over to another thread.
+        """
+        if contextvars is not None:
+            context = contextvars.copy_context()
+            return lambda *args, **kwargs: context.run(fn, *args, **kwargs)
 
-class Client(object):
+        values = [(local, local.get()) for local in ContextLocal._instances]
+
+        def run(*args, **kwargs):
+            previous = [(local, local.set(value)) for local, value in values]
+
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                for local, value in previous:
+                    local.set(value)
+
+        return run
+
+class Credentials(collections.namedtuple('Credentials', ['token', 'app_id', 'headers'])):
     """
-    Handles communication with the UserApp API.
+    The token used by calls made within a Client.as_token() block, with
+    the headers compiled for it. Immutable, since every context copied
+    from the block shares it. Changing the token sets new credentials.
     """
-    def __init__(self, app_id, token="", base_address='api.userapp.io', throw_errors=True, secure=True, debug=False, logger=None, transport=None):
-        self._app_id=app_id
-        self._token=token
-        self._base_address=base_address
-        self._throw_errors=throw_errors
-        self._secure=secure
-        self._debug=debug
+    __slots__ = ()
 
-        # Setup logging, add handler if debug mode
-        self._logger=logging.getLogger(__name__) if logger is None else logger
-        if debug:
-            self._logger.setLevel(logging.DEBUG)
-            if len(self._logger.handlers) == 0:
-                log_handler = logging.StreamHandler()
-                log_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
-                log_handler.setFormatter(log_format)
-                self._logger.addHandler(log_handler)
-                log_handler.setLevel(logging.DEBUG)
+    def __new__(cls, token, app_id=None, headers=None):
+        return super(Credentials, cls).__new__(cls, token, app_id, headers)
 
-        self._transport=transport if not transport is None else NativeTransport(self._logger)
+class Future(object):
+    """
+    The pending result of a call running in the background.
+    """
+    def __init__(self):
+        self._event = threading.Event()
+        self._result = None
+        self._exception = None
 
-    def call(self, version, service, method, arguments):
-        protocol = 'https' if self._secure else 'http'
+    def done(self):
+        return self._event.is_set()
 
-        if not service:
-            raise UserAppInvalidServiceException("No service specified.")
+    def wait(self, timeout=None):
+        """
+        Wait for the result, returning whether it was set in time.
+        """
+        return self._event.wait(timeout)
 
-        if not service:
-            raise UserAppInvalidMethodException("No method on service '{s}' specified.".format(s=service))
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise UserAppException("Timed out waiting for result.")
 
-        target_url = "{p}://{a}/v{v}/{s}.{m}".format(
-            p=protocol,
-            a=self._base_address,
-            v=version,
-            s=service,
-            m=method
-        )
+        if self._exception is not None:
+            raise self._exception
 
-        encoded_credentials=None
+        return self._result
 
-        # Python 2/3 compatibility
-        if sys.version_info[0] < 3:
-            encoded_credentials=base64.b64encode('{u}:{p}'.format(u=self._app_id, p=self._token)).encode('ascii')
-        else:
-            encoded_credentials=base64.b64encode(byte('{u}:{p}'.format(u=self._app_id, p=self._token), 'ascii')).decode('ascii')
-
-        response = self._transport.call(
-            'post',
-            url=target_url,
-            headers={
-                'Content-Type':'application/json',
-                'Authorization':'Basic '+encoded_credentials
-            },
-            body=arguments
-        )
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise UserAppException("Timed out waiting for result.")
 
-        if response is None and response.status_code != 200:
-            raise UserAppTransportException("Recieved HTTP status {s}, expected 200.".format(s=response.status_code))
+        return self._exception
 
-        self._logger.debug("Recieved response={r}".format(r=response.text))
-        result = DictionaryUtility.to_object(response.json())
-        is_error_result=hasattr(result, 'error_code')
+    def set_result(self, result):
+        self._result = result
+        self._event.set()
 
-        # If we got an error back in the response result, or if the
-        # HTTP response code was bad, raise the appropriate exception.
-        if self._throw_errors and is_error_result:
-            if result.error_code == 'INVALID_SERVICE':
-                raise UserAppInvalidServiceException("Service '{s}' does not exist.".format(s=service), service)
-            elif result.error_code == 'INVALID_METHOD':
-                raise UserAppInvalidMethodException("Method '{m}' on service '{s}' does not exist.".format(m=method,s=service), service, method)
-            else:
-                raise UserAppServiceException(result.message, result.error_code)
+    def set_exception(self, exception):
+        self._exception = exception
+        self._event.set()
 
-        # For ease of use. Automatically set/unset the token during login/logout
-        if service == 'user':
-            if not is_error_result and method == 'login':
-                self._token = result.token
-            elif method == 'logout':
-                self._token = ""
+class WorkerPool(object):
+    """
+    A bounded pool of daemon worker threads. A thread is
+    started per submitted task until max_workers is reached.
+    """
+    def __init__(self, max_workers=8):
+        if max_workers < 1:
+            raise ValueError("max_workers must be at least 1.")
 
-        return result
+        self._max_workers = max_workers
+        self._queue = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self._shutdown = False
 
-    def set_option(self, name, value):
-        if not self._is_valid_option(name):
-            raise UserAppInvalidOptionException("Option {s} does not exist.".format(s=name))
+    def submit(self, fn, *args, **kwargs):
+        future = Future()
 
-        return setattr(self, '_'+name, value)
+        with self._lock:
+            if self._shutdown:
+                raise UserAppException("Cannot submit to a pool that has been shut down.")
 
-    def get_option(self, name):
-        if not self._is_valid_option(name):
-            raise UserAppInvalidOptionException("Option {s} does not exist.".format(s=name))
+            self._queue.put((future, ContextLocal.bind(fn), args, kwargs))
 
-        return getattr(self, '_'+name)
+            if len(self._workers) < self._max_workers:
+                worker = threading.Thread(target=self._work)
+                worker.daemon = True
+                worker.start()
+                self._workers.append(worker)
 
-    def _is_valid_option(self, name):
-        return name in ['app_id','token','base_address','secure','debug']
+        return future
 
-    def get_logger(self):
-        return self._logger
+    def map(self, fn, items):
+        """
+        Run fn over all items, returning futures in submission order.
+        """
+        return [self.submit(fn, item) for item in items]
 
-    def set_logger(self, logger):
-        self._logger = logger
+    def shutdown(self, wait=True):
+        with self._lock:
+            self._shutdown = True
+            workers = list(self._workers)
 
-class ClientProxy(object):
+        for worker in workers:
+            self._queue.put(None)
+
+        if wait:
+            for worker in workers:
+                worker.join()
+
+    def _work(self):
+        while True:
+            task = self._queue.get()
+
+            if task is None:
+                return
+
+            future, fn, args, kwargs = task
+
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except Exception as e:
+                future.set_exception(e)
+
+class MemoryCacheBackend(object):
     """
-    Proxies Python attribute/function calls into UserApp client calls.
+    In-process cache storage, evicting the least recently
+    used entry once max_size entries are stored.
     """
-    def __init__(self, **kwargs):
-        self._client=None
-        self._parent=None
-        self._version=1
-        self._service_name=""
-        self._method_name=""
-        self._services={}
+    def __init__(self, max_size=1000):
+        self._max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
 
-        if 'parent' in kwargs:
-            self._parent=kwargs['parent']
-            del kwargs['parent']
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.pop(key, None)
 
-        if 'version' in kwargs:
-            self._version=kwargs['version']
-            del kwargs['version']
+            if entry is None:
+                return None
 
-        if 'service_name' in kwargs:
-            self._service_name=kwargs['service_name']
-            del kwargs['service_name']
+            value, expires_at = entry
 
-        if 'method_name' in kwargs:
-            self._method_name=kwargs['method_name']
-            del kwargs['method_name']
+            if expires_at is not None and expires_at <= time.time():
+                return None
 
-        if self._parent is None:
-            self._client=Client(**kwargs)
-        else:
-            self._client=self._parent._client
+            self._entries[key] = entry
 
-    def __call__(self, *args, **kwargs):
-        if self._parent is None:
-            raise UserAppInvalidMethodException("Service does not exist.")
+            return value
 
-        return self._client.call(self._version, self._parent._service_name, self._method_name, kwargs)
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, None if ttl is None else time.time() + ttl)
 
-    def __getattr__(self, name):
-        name = self._apply_naming_convention(name)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
 
-        if not name in self._services:
-            if self._parent is None and self._is_version(name):
-                self._services[name] = ClientProxy(
-                    parent=self,
-                    version=name[1:]
-                )
-            else:
-                self._services[name] = ClientProxy(
-                    parent=self,
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+class ResponseCache(object):
+    """
+    Read-through cache of API responses. Read methods are cached per
+    app id, token, version, service, method and arguments, while any
+    other method invalidates the cached entries of its service, or
+    only those referencing the same ids when the ids are known.
+
+    Any backend implementing get(key), set(key, value, ttl),
+    delete(key) and clear() can be used to store the entries.
+    """
+    read_methods = set(['get', 'search', 'count', 'hasPermission', 'hasFeature'])
+    passive_methods = set(['login', 'logout', 'heartbeat'])
+
+    def __init__(self, backend=None, max_size=1000, default_ttl=60, ttls=None):
+        self._backend = backend if not backend is None else MemoryCacheBackend(max_size)
+        self._default_ttl = default_ttl
+        self._ttls = ttls if not ttls is None else {}
+        self._max_size = max_size
+        self._index = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits':0, 'misses':0, 'invalidations':0}
+
+    def get_key(self, app_id, token, version, service, method, arguments):
+        """
+        The key to cache a call under, or None if it should not be cached.
+        """
+        if not self.get_ttl(service, method):
+            return None
+
+        return "{a}:{t}:v{v}:{s}.{m}:{r}".format(
+            a=app_id,
+            t=hashlib.sha1(token.encode('utf-8')).hexdigest() if token else '',
+            v=version,
+            s=service,
+            m=method,
+            r=json.dumps(arguments, sort_keys=True, separators=(',', ':'), default=DictionaryUtility.unwrap)
+        )
+
+    def get_ttl(self, service, method):
+        name = "{s}.{m}".format(s=service, m=method)
+
+        if name in self._ttls:
+            return self._ttls[name]
+
+        return self._default_ttl if method in self.read_methods else None
+
+    def get(self, key):
+        value = self._backend.get(key)
+
+        with self._lock:
+            if value is None:
+                self._stats['misses'] += 1
+            else:
+                self._stats['hits'] += 1
+                entry = self._index.pop(key, None)
+                if entry is not None:
+                    self._index[key] = entry
+
+        return value
+
+    def store(self, key, service, method, arguments, value):
+        self._backend.set(key, value, self.get_ttl(service, method))
+
+        with self._lock:
+            self._index.pop(key, None)
+            self._index[key] = (service.split('.')[0], self._get_ids(arguments))
+
+            # Entries no longer indexed could not be invalidated, so drop them
+            dropped = []
+            while len(self._index) > self._max_size:
+                dropped.append(self._index.popitem(last=False)[0])
+
+        for key in dropped:
+            self._backend.delete(key)
+
+    def invalidate(self, service, arguments=None):
+        """
+        Drop cached entries of a service, and of its nested services.
+        When the arguments hold ids, only entries referencing the same
+        ids, entries of 'self', which may be any of them, and entries not
+        tied to any id, such as searches, are dropped.
+        """
+        root = service.split('.')[0]
+        ids = self._get_ids(arguments)
+        match_all = not ids or 'self' in ids
+
+        with self._lock:
+            keys = [key for key, (entry_root, entry_ids) in self._index.items()
+                if entry_root == root and (match_all or not entry_ids or 'self' in entry_ids or entry_ids & ids)]
+
+            for key in keys:
+                del self._index[key]
+
+            self._stats['invalidations'] += len(keys)
+
+        for key in keys:
+            self._backend.delete(key)
+
+    def update(self, key, service, method, arguments, value, is_error_result):
+        """
+        Store or invalidate after a call has been made.
+        """
+        if is_error_result:
+            return
+
+        if key is not None:
+            self.store(key, service, method, arguments, value)
+        elif not method in self.read_methods and not method in self.passive_methods:
+            self.invalidate(service, arguments)
+
+    def clear(self):
+        with self._lock:
+            self._index.clear()
+
+        self._backend.clear()
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+
+        stats['evictions'] = getattr(self._backend, 'evictions', 0)
+        stats['size'] = len(self._backend) if hasattr(self._backend, '__len__') else None
+
+        return stats
+
+    def _get_ids(self, arguments):
+        ids = set()
+
+        for name, value in (arguments or {}).items():
+            if name.endswith('_id'):
+                for id in (value if isinstance(value, list) else [value]):
+                    ids.add(str(id))
+
+        return ids
+
+class SingleFlight(object):
+    """
+    Lets identical read calls in flight at the same time share one
+    request. The first caller sends it, while callers with the same
+    credentials, version, service, method and arguments wait for
+    and share its response.
+    """
+    methods = ResponseCache.read_methods | set(['heartbeat'])
+
+    def __init__(self):
+        self._calls = {}
+        self._lock = threading.Lock()
+        self._stats = {'calls':0, 'coalesced':0}
+
+    def get_key(self, app_id, token, version, service, method, arguments):
+        """
+        The key identical calls share, or None if the call is not coalesced.
+        """
+        if not method in self.methods:
+            return None
+
+        return (app_id, token, version, service, method,
+            json.dumps(arguments, sort_keys=True, separators=(',', ':'), default=DictionaryUtility.unwrap))
+
+    def call(self, key, fn, timeout=None):
+        """
+        Call fn, or wait for the response of an identical call in flight.
+        """
+        if key is None:
+            return fn()
+
+        future, leader = self.join(key)
+
+        if not leader:
+            if not future.wait(timeout):
+                raise UserAppTimeoutException("Call did not complete within {t} seconds.".format(t=timeout))
+
+            return future.result()
+
+        try:
+            response = fn()
+        except Exception as e:
+            self.leave(key, future, exception=e)
+            raise
+
+        self.leave(key, future, response=response)
+
+        return response
+
+    def join(self, key, create_future=Future):
+        """
+        Get the future of the call in flight under key, and whether
+        the caller leads it, in which case it must call leave().
+        """
+        with self._lock:
+            self._stats['calls'] += 1
+            future = self._calls.get(key)
+
+            if future is not None:
+                self._stats['coalesced'] += 1
+                return future, False
+
+            future = self._calls[key] = create_future()
+
+            return future, True
+
+    def leave(self, key, future, response=None, exception=None):
+        with self._lock:
+            self._calls.pop(key, None)
+
+        if exception is not None:
+            future.set_exception(exception)
+        else:
+            future.set_result(response)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['in_flight'] = len(self._calls)
+            return stats
+
+class RequestHedger(object):
+    """
+    Runs idempotent calls with a hedge: if the first attempt has not
+    answered within the given percentile of recent latencies of the
+    method, a second attempt is fired and whichever answers first wins.
+    Until min_samples latencies are known, the fixed delay is used.
+    """
+    def __init__(self, percentile=95, delay=0.1, min_samples=20, window=200, max_workers=20):
+        self._percentile = percentile
+        self._delay = delay
+        self._min_samples = min_samples
+        self._window = window
+        self._pool = WorkerPool(max_workers)
+        self._latencies = {}
+        self._lock = threading.Lock()
+        self._stats = {'calls':0, 'hedges_fired':0, 'hedges_won':0, 'timeouts':0}
+
+    def call(self, name, fn, timeout=None):
+        """
+        Call fn, hedging it. Raises UserAppTimeoutException
+        if no attempt answers within timeout seconds.
+        """
+        answers = queue.Queue()
+        start = time.time()
+
+        def attempt(index):
+            attempt_start = time.time()
+            try:
+                answers.put((index, fn(), None, time.time() - attempt_start))
+            except Exception as e:
+                answers.put((index, None, e, None))
+
+        self._count('calls')
+        self._pool.submit(attempt, 0)
+
+        delay = self.get_delay(name)
+        attempts = 1
+
+        if timeout is not None:
+            delay = min(delay, timeout)
+
+        try:
+            answer = answers.get(timeout=delay)
+        except queue.Empty:
+            self._count('hedges_fired')
+            self._pool.submit(attempt, 1)
+            attempts = 2
+            answer = None
+
+        first_error = None
+
+        while True:
+            if answer is None:
+                remaining = None if timeout is None else timeout - (time.time() - start)
+
+                try:
+                    if remaining is not None and remaining <= 0:
+                        raise queue.Empty()
+                    answer = answers.get(timeout=remaining)
+                except queue.Empty:
+                    self._count('timeouts')
+                    raise UserAppTimeoutException("Call to {n} did not complete within {t} seconds.".format(n=name, t=timeout))
+
+            index, result, error, latency = answer
+            attempts -= 1
+
+            if error is None:
+                if index == 1:
+                    self._count('hedges_won')
+                self.record(name, latency)
+                return result
+
+            first_error = first_error or error
+            answer = None
+
+            if attempts == 0:
+                raise first_error
+
+    def record(self, name, latency):
+        with self._lock:
+            latencies = self._latencies.get(name)
+
+            if latencies is None:
+                latencies = self._latencies[name] = collections.deque(maxlen=self._window)
+
+            latencies.append(latency)
+
+    def get_delay(self, name):
+        with self._lock:
+            latencies = self._latencies.get(name)
+
+            if latencies is None or len(latencies) < self._min_samples:
+                return self._delay
+
+            ordered = sorted(latencies)
+
+        return ordered[min(int(len(ordered) * self._percentile / 100.0), len(ordered) - 1)]
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+class RetryPolicy(object):
+    """
+    Retries failed calls with exponential backoff and full jitter.
+    Read methods are retried on any transport error, other methods
+    only when no connection could be made. Retries are paid for from
+    a budget that gains budget_ratio of a retry per call, holding at
+    most budget_min retries, so retries stay a fraction of traffic.
+    """
+    def __init__(self, max_attempts=3, backoff=0.05, max_backoff=2.0, budget_ratio=0.1, budget_min=10):
+        self._max_attempts = max_attempts
+        self._backoff = backoff
+        self._max_backoff = max_backoff
+        self._budget_ratio = budget_ratio
+        self._budget_min = budget_min
+        self._balance = float(budget_min)
+        self._lock = threading.Lock()
+        self._stats = {'calls':0, 'retries':0, 'budget_exhausted':0}
+
+    def record_call(self):
+        with self._lock:
+            self._stats['calls'] += 1
+            self._balance = min(self._balance + self._budget_ratio, self._budget_min)
+
+    def get_backoff(self, method, error, attempt):
+        """
+        Seconds to wait before retrying a failed attempt
+        (counted from 1), or None if it should not be retried.
+        """
+        if attempt >= self._max_attempts or not RetryPolicy.is_retryable(method, error):
+            return None
+
+        with self._lock:
+            if self._balance < 1:
+                self._stats['budget_exhausted'] += 1
+                return None
+
+            self._balance -= 1
+            self._stats['retries'] += 1
+
+        return random.uniform(0, min(self._max_backoff, self._backoff * (2 ** (attempt - 1))))
+
+    @staticmethod
+    def is_retryable(method, error):
+        """
+        Whether a call of method failing with error can be retried
+        without the risk of it being applied twice.
+        """
+        if isinstance(error, UserAppCircuitOpenException):
+            return False
+
+        return method in ResponseCache.read_methods or isinstance(error, UserAppConnectionException)
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['budget'] = self._balance
+            return stats
+
+class CircuitBreaker(object):
+    """
+    Fails calls fast while a host is failing. After failure_threshold
+    consecutive transport failures the circuit of the host opens, and
+    after reset_timeout seconds a single trial call is let through.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, logger=None):
+        self._failure_threshold = failure_threshold
+        self._reset_timeout = reset_timeout
+        self._logger = logger if not logger is None else default_logger
+        self._circuits = {}
+        self._lock = threading.Lock()
+        self._stats = {'rejected':0, 'opened':0, 'half_opened':0, 'closed':0}
+
+    def before_call(self, host):
+        with self._lock:
+            circuit = self._get_circuit(host)
+
+            if circuit['state'] == self.OPEN:
+                if time.time() - circuit['opened_at'] < self._reset_timeout:
+                    self._stats['rejected'] += 1
+                    raise UserAppCircuitOpenException("Circuit for {h} is open.".format(h=host), host)
+
+                self._transition(host, circuit, self.HALF_OPEN)
+            elif circuit['state'] == self.HALF_OPEN and circuit['trial']:
+                self._stats['rejected'] += 1
+                raise UserAppCircuitOpenException("Circuit for {h} is half open.".format(h=host), host)
+
+            circuit['trial'] = circuit['state'] == self.HALF_OPEN
+
+    def record_success(self, host):
+        with self._lock:
+            circuit = self._get_circuit(host)
+            circuit['failures'] = 0
+            circuit['trial'] = False
+
+            if circuit['state'] != self.CLOSED:
+                self._transition(host, circuit, self.CLOSED)
+
+    def record_failure(self, host, trial_only=False):
+        """
+        Record a failed call. With trial_only, the failure is only
+        recorded for the trial call of a half open circuit.
+        """
+        with self._lock:
+            circuit = self._get_circuit(host)
+
+            if trial_only and not circuit['trial']:
+                return
+
+            circuit['failures'] += 1
+            circuit['trial'] = False
+
+            if circuit['state'] == self.HALF_OPEN or circuit['state'] == self.CLOSED and circuit['failures'] >= self._failure_threshold:
+                circuit['opened_at'] = time.time()
+                self._transition(host, circuit, self.OPEN)
+
+    def get_state(self, host):
+        with self._lock:
+            return self._get_circuit(host)['state']
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['circuits'] = dict((host, circuit['state']) for host, circuit in self._circuits.items())
+            return stats
+
+    def _get_circuit(self, host):
+        if not host in self._circuits:
+            self._circuits[host] = {'state':self.CLOSED, 'failures':0, 'opened_at':None, 'trial':False}
+
+        return self._circuits[host]
+
+    def _transition(self, host, circuit, state):
+        self._logger.warning("Circuit for {h} changed from {f} to {t}.".format(h=host, f=circuit['state'], t=state))
+        circuit['state'] = state
+        self._stats[{self.OPEN:'opened', self.HALF_OPEN:'half_opened', self.CLOSED:'closed'}[state]] += 1
+
+class RateLimiter(object):
+    """
+    Token bucket limiting the call rate per app id, and optionally per
+    service or service.method through limits, i.e. {'user.save':5}.
+    Calls over the limit wait in a queue ordered by priority class,
+    so interactive calls like user.login are sent before batch traffic.
+    """
+    INTERACTIVE = 0
+    NORMAL = 1
+    BATCH = 2
+
+    default_priorities = {
+        'user.login':INTERACTIVE,
+        'user.logout':INTERACTIVE,
+        'token.heartbeat':INTERACTIVE
+    }
+
+    def __init__(self, rate, burst=None, limits=None, priorities=None, default_priority=NORMAL):
+        self._rate = float(rate)
+        self._burst = burst if not burst is None else max(rate, 1)
+        self._limits = limits if not limits is None else {}
+        self._priorities = dict(self.default_priorities, **(priorities or {}))
+        self._default_priority = default_priority
+        self._buckets = {}
+        self._waiting = []
+        self._sequence = 0
+        self._condition = threading.Condition()
+        self._stats = {'acquired':0, 'waited':0, 'max_queued':0, 'total_wait':0.0, 'max_wait':0.0}
+
+    def acquire(self, app_id, service, method, priority=None):
+        """
+        Block until the call may be sent.
+        """
+        entry = self.enqueue(app_id, service, method, priority)
+
+        with self._condition:
+            while True:
+                wait = self._try_take(entry)
+
+                if wait is None:
+                    return
+
+                self._condition.wait(wait)
+
+    def enqueue(self, app_id, service, method, priority=None):
+        """
+        Queue a call, returning the entry to acquire with try_acquire().
+        """
+        name = "{s}.{m}".format(s=service, m=method)
+
+        if priority is None:
+            priority = self._priorities.get(name, self._priorities.get(service, self._default_priority))
+
+        keys = [(app_id, None)]
+
+        for limited in (name, service):
+            if limited in self._limits:
+                keys.append((app_id, limited))
+                break
+
+        with self._condition:
+            self._sequence += 1
+            entry = {'priority':(priority, self._sequence), 'keys':keys, 'queued_at':time.time()}
+            self._waiting.append(entry)
+            self._waiting.sort(key=lambda waiting: waiting['priority'])
+            self._stats['max_queued'] = max(self._stats['max_queued'], len(self._waiting))
+
+        return entry
+
+    def try_acquire(self, entry):
+        """
+        Returns None if the queued call may be sent, otherwise
+        the number of seconds to wait before trying again.
+        """
+        with self._condition:
+            return self._try_take(entry)
+
+    def cancel(self, entry):
+        """
+        Remove a queued call that will no longer be sent.
+        """
+        with self._condition:
+            if entry in self._waiting:
+                self._waiting.remove(entry)
+                self._condition.notify_all()
+
+    def get_stats(self):
+        with self._condition:
+            stats = dict(self._stats)
+            stats['queued'] = len(self._waiting)
+            return stats
+
+    def _try_take(self, entry):
+        now = time.time()
+
+        for waiting in self._waiting:
+            wait = max(self._refill(key, now) for key in waiting['keys'])
+
+            if wait > 0:
+                if waiting is entry:
+                    return wait
+                continue
+
+            # A call of higher priority can go first, wake it up
+            if not waiting is entry:
+                self._condition.notify_all()
+                return 0.001
+
+            for key in entry['keys']:
+                self._buckets[key][0] -= 1
+
+            self._waiting.remove(entry)
+            self._condition.notify_all()
+
+            waited = now - entry['queued_at']
+            self._stats['acquired'] += 1
+            self._stats['total_wait'] += waited
+            self._stats['max_wait'] = max(self._stats['max_wait'], waited)
+            if waited > 0.001:
+                self._stats['waited'] += 1
+
+            return None
+
+    def _refill(self, key, now):
+        """
+        Refill a bucket, returning seconds until it holds a token.
+        """
+        rate, burst = (self._rate, self._burst) if key[1] is None else (float(self._limits[key[1]]), max(self._limits[key[1]], 1))
+        bucket = self._buckets.get(key)
+
+        if bucket is None:
+            bucket = self._buckets[key] = [burst, now]
+
+        bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+
+        return 0 if bucket[0] >= 1 else (1 - bucket[0]) / rate
+
+class CallContext(object):
+    """
+    What is known about a call, handed to hooks. Sizes are in bytes
+    and times in seconds.
+    """
+    __slots__ = ('version', 'service', 'method', 'arguments', 'started_at', 'latency', 'cached', 'status_code',
+        'request_bytes', 'response_bytes', 'decode_time', 'convert_time', 'error_code', 'result', 'error')
+
+    def __init__(self, version, service, method, arguments):
+        self.version = version
+        self.service = service
+        self.method = method
+        self.arguments = arguments
+        self.started_at = time.time()
+        self.latency = None
+        self.cached = False
+        self.status_code = None
+        self.request_bytes = None
+        self.response_bytes = None
+        self.decode_time = None
+        self.convert_time = None
+        self.error_code = None
+        self.result = None
+        self.error = None
+
+    @property
+    def name(self):
+        return "{s}.{m}".format(s=self.service, m=self.method)
+
+class Hook(object):
+    """
+    Base class for hooks around client calls. Hooks are
+    called on the calling thread and should be quick.
+    """
+    def before_send(self, context):
+        pass
+
+    def after_receive(self, context):
+        pass
+
+    def on_error(self, context, error):
+        pass
+
+class MetricsCollector(Hook):
+    """
+    Collects per service.method call counts, latency histograms,
+    byte sizes, decode/conversion times and error codes.
+    """
+    default_buckets = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=None):
+        self._buckets = tuple(buckets if not buckets is None else self.default_buckets)
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def after_receive(self, context):
+        self._record(context, None)
+
+    def on_error(self, context, error):
+        self._record(context, error)
+
+    def snapshot(self):
+        """
+        A copy of all metrics as plain dictionaries and lists, keyed by
+        service.method. Histogram counts are per bucket, the last bucket
+        counting latencies above the highest bound.
+        """
+        with self._lock:
+            return dict((name, {
+                'calls': metrics['calls'],
+                'errors': metrics['errors'],
+                'cached': metrics['cached'],
+                'latency': {
+                    'buckets': list(self._buckets),
+                    'counts': list(metrics['latency_counts']),
+                    'sum': metrics['latency_sum']
+                },
+                'request_bytes': metrics['request_bytes'],
+                'response_bytes': metrics['response_bytes'],
+                'decode_time': metrics['decode_time'],
+                'convert_time': metrics['convert_time'],
+                'error_codes': dict(metrics['error_codes'])
+            }) for name, metrics in self._metrics.items())
+
+    def reset(self):
+        with self._lock:
+            self._metrics = {}
+
+    def _record(self, context, error):
+        error_code = getattr(error, 'error_code', None) or context.error_code
+
+        if error is not None and error_code is None:
+            error_code = error.__class__.__name__
+
+        with self._lock:
+            metrics = self._metrics.get(context.name)
+
+            if metrics is None:
+                metrics = self._metrics[context.name] = {
+                    'calls':0, 'errors':0, 'cached':0,
+                    'latency_counts':[0] * (len(self._buckets) + 1), 'latency_sum':0.0,
+                    'request_bytes':0, 'response_bytes':0, 'decode_time':0.0, 'convert_time':0.0,
+                    'error_codes':{}
+                }
+
+            metrics['calls'] += 1
+            metrics['cached'] += 1 if context.cached else 0
+            metrics['latency_counts'][bisect.bisect_left(self._buckets, context.latency)] += 1
+            metrics['latency_sum'] += context.latency
+            metrics['request_bytes'] += context.request_bytes or 0
+            metrics['response_bytes'] += context.response_bytes or 0
+            metrics['decode_time'] += context.decode_time or 0
+            metrics['convert_time'] += context.convert_time or 0
+
+            if error_code is not None:
+                metrics['errors'] += 1
+                metrics['error_codes'][error_code] = metrics['error_codes'].get(error_code, 0) + 1
+
+class UserSnapshots(object):
+    """
+    Keeps the permissions and features of users returned by user.get,
+    so that permission and feature checks can be answered locally.
+    Snapshots are kept per app id and token, and are considered
+    stale after refresh_interval seconds.
+    """
+    def __init__(self, refresh_interval=60):
+        self._refresh_interval = refresh_interval
+        self._snapshots = {}
+        self._lock = threading.Lock()
+        self._stats = {'local_checks':0, 'refreshes':0, 'remote_checks':0}
+
+    def get(self, app_id, token, user_id):
+        """
+        The fresh snapshot of a user, or None if it is stale or missing.
+        """
+        with self._lock:
+            snapshot = self._snapshots.get((app_id, token, user_id))
+
+            if snapshot is None or time.time() - snapshot['updated_at'] > self._refresh_interval:
+                return None
+
+            return snapshot
+
+    def update(self, app_id, token, arguments, result):
+        """
+        Store the users of a user.get result.
+        """
+        users = result if isinstance(result, list) else [result]
+        requested = (arguments or {}).get('user_id', 'self')
+        now = time.time()
+
+        with self._lock:
+            for user in users:
+                if not isinstance(user, IterableObject) or not 'permissions' in user or not 'features' in user:
+                    continue
+
+                snapshot = {
+                    'permissions': self._get_flags(user.source['permissions']),
+                    'features': self._get_flags(user.source['features']),
+                    'updated_at': now
+                }
+
+                self._snapshots[(app_id, token, user.source.get('user_id'))] = snapshot
+
+                if requested == 'self' and len(users) == 1:
+                    self._snapshots[(app_id, token, 'self')] = snapshot
+
+    def invalidate(self, user_ids=None):
+        """
+        Drop the snapshots of the given users, or of all users. The
+        snapshot of 'self' is always dropped, as it may be any of them.
+        """
+        with self._lock:
+            if user_ids is None:
+                self._snapshots.clear()
+                return
+
+            for key in list(self._snapshots.keys()):
+                if key[2] in user_ids or key[2] == 'self':
+                    del self._snapshots[key]
+
+    def observe(self, app_id, token, service, method, arguments, result):
+        """
+        Keep snapshots up to date with a call that has been made.
+        """
+        root = service.split('.')[0]
+
+        if root == 'user' and method == 'get':
+            self.update(app_id, token, arguments, result)
+        elif method in ResponseCache.read_methods or method in ('login', 'heartbeat'):
+            return
+        elif root == 'user' and arguments and 'user_id' in arguments and arguments['user_id'] != 'self':
+            user_ids = arguments['user_id']
+            self.invalidate(set(user_ids if isinstance(user_ids, list) else [user_ids]))
+        elif root in ('user', 'permission', 'feature'):
+            self.invalidate()
+
+    def count(self, name):
+        with self._lock:
+            self._stats[name] += 1
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['users'] = len(self._snapshots)
+            return stats
+
+    def _get_flags(self, values):
+        return dict((name, bool(value.get('value')) if isinstance(value, dict) else bool(value)) for name, value in values.items())
+
+class CallTracer(object):
+    """
+    Logs calls and responses at DEBUG level. Nothing is formatted unless
+    the logger is enabled for DEBUG and the call is sampled. Bodies are
+    truncated to max_body characters, and credentials are redacted.
+    """
+    redacted_headers = set(['authorization'])
+    redacted_fields = set(['password', 'token', 'new_password', 'current_password'])
+
+    def __init__(self, logger, sample_rate=1.0, max_body=2048):
+        self.logger = logger
+        self.sample_rate = sample_rate
+        self.max_body = max_body
+
+    def should_trace(self):
+        if not self.logger.isEnabledFor(logging.DEBUG):
+            return False
+
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def trace_request(self, method, url, headers, body):
+        self.logger.debug("Calling {m} {u} with headers {h} and body {b}".format(
+            m=method,
+            u=url,
+            h=dict((name, '[REDACTED]' if name.lower() in self.redacted_headers else value) for name, value in headers.items()),
+            b=self._truncate(json.dumps(self.redact(body), cls=IterableObjectEncoder))
+        ))
+
+    def trace_response(self, response):
+        try:
+            body = json.dumps(self.redact(json.loads(response.text)))
+        except ValueError:
+            body = response.text
+
+        self.logger.debug("Recieved response={r}".format(r=self._truncate(body)))
+
+    @classmethod
+    def redact(cls, item):
+        if isinstance(item, dict):
+            return dict((key, '[REDACTED]' if key in cls.redacted_fields else cls.redact(value)) for key, value in item.items())
+        if isinstance(item, list):
+            return [cls.redact(value) for value in item]
+
+        if isinstance(item, (IterableObject, IterableList)):
+            return cls.redact(DictionaryUtility.unwrap(item))
+
+        return item
+
+    def _truncate(self, text):
+        if self.max_body is None or len(text) <= self.max_body:
+            return text
+
+        return "{t}... ({n} characters truncated)".format(t=text[:self.max_body], n=len(text) - self.max_body)
+
+class Compression(object):
+    """
+    Advertises compressed responses and gzips request bodies of at
+    least min_size bytes, counting the bytes saved both ways.
+    """
+    accept_encoding = 'gzip, deflate'
+
+    def __init__(self, min_size=1024, level=6, compress_requests=True):
+        self.min_size = min_size
+        self.level = level
+        self.compress_requests = compress_requests
+        self._lock = threading.Lock()
+        self._stats = {'requests_compressed':0, 'request_bytes':0, 'request_bytes_sent':0,
+            'responses_compressed':0, 'response_bytes':0, 'response_bytes_received':0}
+
+    def prepare(self, headers, body):
+        """
+        Get the headers and body to send. The headers are copied,
+        being shared between calls.
+        """
+        headers = dict(headers)
+        headers['Accept-Encoding'] = self.accept_encoding
+
+        if body is None or not self.compress_requests:
+            return headers, body
+
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+
+        if len(body) < self.min_size:
+            return headers, body
+
+        compressed = self.compress(body)
+        headers['Content-Encoding'] = 'gzip'
+
+        with self._lock:
+            self._stats['requests_compressed'] += 1
+            self._stats['request_bytes'] += len(body)
+            self._stats['request_bytes_sent'] += len(compressed)
+
+        return headers, compressed
+
+    def compress(self, data):
+        # gzip.compress is missing on Python 2, a gzip wrapped compressobj is not
+        compressor = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def record_response(self, received, decoded):
+        with self._lock:
+            self._stats['responses_compressed'] += 1
+            self._stats['response_bytes'] += decoded
+            self._stats['response_bytes_received'] += received
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+
+        stats['bytes_saved'] = (stats['request_bytes'] - stats['request_bytes_sent']) + (stats['response_bytes'] - stats['response_bytes_received'])
+
+        return stats
+
+    @staticmethod
+    def create_decompressor(encoding):
+        """
+        Get a decompressor for a Content-Encoding, or None if the
+        content is not compressed with gzip or deflate.
+        """
+        if encoding is None or not encoding.strip().lower() in ('gzip', 'x-gzip', 'deflate'):
+            return None
+
+        # Detects both gzip and zlib headers, as sent for gzip and deflate
+        return zlib.decompressobj(32 + zlib.MAX_WBITS)
+
+    @staticmethod
+    def decompress(encoding, content):
+        decompressor = Compression.create_decompressor(encoding)
+
+        if decompressor is None:
+            return content
+
+        try:
+            return decompressor.decompress(content) + decompressor.flush()
+        except zlib.error as e:
+            raise UserAppTransportException("Could not decompress response: {e}".format(e=e))
+
+class NativeTransport(object):
+    """
+    Transport backed by a long-lived requests session, keeping
+    connections to the API alive and pooled between calls.
+    """
+    def __init__(self, logger, pool_size=10, pool_max_connections=10, pool_idle_timeout=None, connect_timeout=None, read_timeout=None, codec=None, compression=None):
+        self._logger = logger
+        self._codec = codec if not codec is None else JsonCodec()
+        self._compression = compression
+        self._pool_size = pool_size
+        self._pool_max_connections = pool_max_connections
+        self._pool_idle_timeout = pool_idle_timeout
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._session = None
+        self._last_used = None
+        self._lock = threading.Lock()
+        self._retired_stats = {'connections_created':0, 'requests':0}
+        self._evictions = 0
+
+    def call(self, method, url, headers=None, body=None, timeout=None, stream=False):
+        if headers is None:
+            headers={}
+
+        if 'Content-Type' in headers:
+            if headers['Content-Type'] == 'application/json':
+
+                body=self._codec.dumps(body)
+
+        if self._compression is not None:
+            headers, body = self._compression.prepare(headers, body)
+
+        if method != 'post':
+            raise UserAppTransportException("Method {m} not supported.".format(m=method))
+
+        try:
+            response=self._get_session().post(
+                url=url,
+                data=body,
+                headers=headers,
+                verify=True,
+                timeout=self._get_timeout(timeout),
+                stream=stream
+            )
+        except requests.exceptions.Timeout as e:
+            raise UserAppTimeoutException("Call to {u} timed out: {e}".format(u=url, e=e))
+        except requests.exceptions.ConnectionError as e:
+            raise UserAppConnectionException("Could not connect to {u}: {e}".format(u=url, e=e))
+        except requests.exceptions.RequestException as e:
+            raise UserAppTransportException("Call to {u} failed: {e}".format(u=url, e=e))
+
+        # requests decompresses responses itself, the raw response tells what was received
+        if self._compression is not None and not stream and Compression.create_decompressor(response.headers.get('Content-Encoding')) is not None:
+            self._compression.record_response(response.raw.tell(), len(response.content))
+
+        return response
+
+    def configure(self, **options):
+        """
+        Update pool and timeout options. Pool options take effect
+        by recycling the session on the next call.
+        """
+        with self._lock:
+            for name, value in options.items():
+                setattr(self, '_'+name, value)
+
+            if any(name.startswith('pool_') for name in options):
+                self._retire_session()
+
+    def get_pool_stats(self):
+        """
+        Connection pool statistics, summed over all host pools.
+        """
+        with self._lock:
+            stats = dict(self._retired_stats)
+            stats['connections_open'] = 0
+
+            for pool in self._get_host_pools():
+                stats['connections_created'] += pool.num_connections
+                stats['requests'] += pool.num_requests
+                stats['connections_open'] += len([c for c in list(pool.pool.queue) if c is not None])
+
+            stats['connections_reused'] = max(stats['requests'] - stats['connections_created'], 0)
+            stats['evictions'] = self._evictions
+
+            return stats
+
+    def close(self):
+        with self._lock:
+            self._retire_session()
+
+    def _get_session(self):
+        with self._lock:
+            now = time.time()
+
+            # Drop idle connections rather than risk reusing ones the server has closed
+            if self._session is not None and self._pool_idle_timeout is not None and now - self._last_used > self._pool_idle_timeout:
+                self._retire_session()
+                self._evictions += 1
+
+            if self._session is None:
+                import_requests()
+                self._session = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self._pool_size,
+                    pool_maxsize=self._pool_max_connections
+                )
+                self._session.mount('https://', adapter)
+                self._session.mount('http://', adapter)
+
+            self._last_used = now
+
+            return self._session
+
+    def _get_timeout(self, timeout=None):
+        # A per-call timeout bounds both connecting and waiting for the response
+        if timeout is not None:
+            return (min(timeout, self._connect_timeout or timeout), min(timeout, self._read_timeout or timeout))
+
+        if self._connect_timeout is None and self._read_timeout is None:
+            return None
+
+        return (self._connect_timeout, self._read_timeout)
+
+    def _get_host_pools(self):
+        if self._session is None:
+            return []
+
+        pools = []
+
+        for adapter in set(self._session.adapters.values()):
+            manager = adapter.poolmanager
+            for key in manager.pools.keys():
+                pool = manager.pools.get(key)
+                if pool is not None:
+                    pools.append(pool)
+
+        return pools
+
+    def _retire_session(self):
+        if self._session is None:
+            return
+
+        for pool in self._get_host_pools():
+            self._retired_stats['connections_created'] += pool.num_connections
+            self._retired_stats['requests'] += pool.num_requests
+
+        self._session.close()
+        self._session = None
+
+class HttpClientResponse(object):
+    """
+    Response of a HttpClientTransport call, exposing the same
+    surface as the requests response used by the client. The
+    connection is handed back to the pool once the body is read.
+    """
+    def __init__(self, response, release, compression=None):
+        self.status_code = response.status
+        self.headers = dict((name.lower(), value) for name, value in response.getheaders())
+        self._response = response
+        self._release = release
+        self._compression = compression
+        self._decompressor = Compression.create_decompressor(self.headers.get('content-encoding'))
+        self._content = None
+
+    @property
+    def content(self):
+        if self._content is None:
+            self._content = b''.join(self.iter_content(65536))
+
+        return self._content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=1, decode_unicode=False):
+        if self._content is not None:
+            yield self._content
+            return
+
+        received = 0
+        decoded = 0
+
+        try:
+            while True:
+                chunk = self._response.read(chunk_size)
+
+                if not chunk:
+                    break
+
+                received += len(chunk)
+
+                if self._decompressor is not None:
+                    chunk = self._decompressor.decompress(chunk)
+                    decoded += len(chunk)
+
+                    if not chunk:
+                        continue
+
+                yield chunk
+
+            if self._decompressor is not None:
+                chunk = self._decompressor.flush()
+                decoded += len(chunk)
+
+                if chunk:
+                    yield chunk
+        except socket.timeout:
+            self.close()
+            raise UserAppTimeoutException("Timed out reading response.")
+        except (httplib.HTTPException, socket.error) as e:
+            self.close()
+            raise UserAppTransportException("Reading response failed: {e}".format(e=e))
+        except zlib.error as e:
+            self.close()
+            raise UserAppTransportException("Could not decompress response: {e}".format(e=e))
+
+        if self._decompressor is not None and self._compression is not None:
+            self._compression.record_response(received, decoded)
+
+        self._done(True)
+
+    def close(self):
+        # A response read to its end can still hand its connection back
+        self._done(self._response.isclosed())
+
+    def _done(self, reusable):
+        if self._release is not None:
+            release, self._release = self._release, None
+            release(reusable and not self._response.will_close)
+
+class HttpClientConnection(object):
+    def __init__(self, connection):
+        self.connection = connection
+        self.last_used = time.time()
+
+    def close(self):
+        self.connection.close()
+
+class HttpClientTransport(object):
+    """
+    Transport built on the standard library HTTP client only, for
+    when requests is not wanted. Connections are kept alive in a
+    per-host pool between calls, like the NativeTransport.
+    """
+    def __init__(self, logger, pool_size=10, pool_max_connections=10, pool_idle_timeout=None, connect_timeout=None, read_timeout=None, codec=None, compression=None):
+        self._logger = logger
+        self._codec = codec if not codec is None else JsonCodec()
+        self._compression = compression
+        self._pool_size = pool_size
+        self._pool_max_connections = pool_max_connections
+        self._pool_idle_timeout = pool_idle_timeout
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._idle = collections.OrderedDict()
+        self._targets = {}
+        self._lock = threading.Lock()
+        self._stats = {'connections_created':0, 'connections_reused':0, 'requests':0, 'evictions':0}
+
+    def call(self, method, url, headers=None, body=None, timeout=None, stream=False):
+        if headers is None:
+            headers={}
+
+        if 'Content-Type' in headers:
+            if headers['Content-Type'] == 'application/json':
+
+                body=self._codec.dumps(body)
+
+        if self._compression is not None:
+            headers, body = self._compression.prepare(headers, body)
+
+        if method != 'post':
+            raise UserAppTransportException("Method {m} not supported.".format(m=method))
+
+        import_http_client()
+
+        key, path = self._get_target(url)
+        payload = body.encode('utf-8') if not isinstance(body, bytes) and body is not None else body
+        connect_timeout, read_timeout = self._get_timeout(timeout)
+
+        connection, reused = self._checkout(key)
+
+        while True:
+            if connection is None:
+                connection = self._connect(key, connect_timeout)
+
+            connection.connection.sock.settimeout(read_timeout)
+
+            try:
+                connection.connection.request('POST', path, payload, headers)
+                response = connection.connection.getresponse()
+                break
+            except socket.timeout:
+                connection.close()
+                raise UserAppTimeoutException("Call to {u} timed out.".format(u=url))
+            except (httplib.HTTPException, socket.error) as e:
+                connection.close()
+
+                # A pooled connection may have been closed by the server while idle
+                if not reused:
+                    raise UserAppTransportException("Call to {u} failed: {e}".format(u=url, e=e))
+
+                connection, reused = None, False
+
+        with self._lock:
+            self._stats['requests'] += 1
+
+        def release(reusable):
+            if reusable:
+                self._checkin(key, connection)
+            else:
+                connection.close()
+
+        response = HttpClientResponse(response, release, self._compression)
+
+        if not stream:
+            response.content
+
+        return response
+
+    def configure(self, **options):
+        with self._lock:
+            for name, value in options.items():
+                setattr(self, '_'+name, value)
+
+    def get_pool_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['connections_open'] = sum(len(connections) for connections in self._idle.values())
+
+        return stats
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, collections.OrderedDict()
+
+        for connections in idle.values():
+            for connection in connections:
+                connection.close()
+
+    def _get_target(self, url):
+        target = self._targets.get(url)
+
+        if target is None:
+            parts = urlsplit(url)
+            path = (parts.path or '/') + ('?' + parts.query if parts.query else '')
+            target = self._targets[url] = ((parts.scheme, parts.hostname, parts.port), path)
+
+        return target
+
+    def _get_timeout(self, timeout=None):
+        # A per-call timeout bounds both connecting and waiting for the response
+        if timeout is not None:
+            return (min(timeout, self._connect_timeout or timeout), min(timeout, self._read_timeout or timeout))
+
+        return (self._connect_timeout, self._read_timeout)
+
+    def _checkout(self, key):
+        now = time.time()
+
+        with self._lock:
+            connections = self._idle.get(key, [])
+
+            while len(connections) > 0:
+                connection = connections.pop()
+
+                if self._pool_idle_timeout is not None and now - connection.last_used > self._pool_idle_timeout:
+                    connection.close()
+                    self._stats['evictions'] += 1
+                    continue
+
+                self._stats['connections_reused'] += 1
+                return connection, True
+
+        return None, False
+
+    def _checkin(self, key, connection):
+        connection.last_used = time.time()
+        dropped = []
+
+        with self._lock:
+            connections = self._idle.pop(key, [])
+            self._idle[key] = connections
+
+            if len(connections) < self._pool_max_connections:
+                connections.append(connection)
+            else:
+                dropped.append(connection)
+
+            # Keep pools for the pool_size most recently used hosts
+            while len(self._idle) > self._pool_size:
+                dropped.extend(self._idle.popitem(last=False)[1])
+
+        for connection in dropped:
+            connection.close()
+
+    def _connect(self, key, timeout):
+        scheme, host, port = key
+
+        if scheme == 'https':
+            connection = httplib.HTTPSConnection(host, port, timeout=timeout)
+        else:
+            connection = httplib.HTTPConnection(host, port, timeout=timeout)
+
+        try:
+            connection.connect()
+        except socket.timeout:
+            connection.close()
+            raise UserAppTimeoutException("Timed out connecting to {h}.".format(h=host))
+        except socket.error as e:
+            connection.close()
+            raise UserAppConnectionException("Could not connect to {h}: {e}".format(h=host, e=e))
+
+        with self._lock:
+            self._stats['connections_created'] += 1
+
+        return HttpClientConnection(connection)
+
+class RecordedResponse(object):
+    """
+    A response replayed from a recording.
+    """
+    def __init__(self, status_code, content):
+        self.status_code = status_code
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=1):
+        return (self.content[i:i+chunk_size] for i in range(0, len(self.content), chunk_size))
+
+    def close(self):
+        pass
+
+class RecordingTransport(object):
+    """
+    Wraps a transport, appending every call and its response to a
+    file of newline delimited JSON that ReplayTransport can replay.
+    Headers are not recorded, and passwords and tokens are redacted.
+    """
+    def __init__(self, transport, path):
+        self._transport = transport
+        self._path = path
+        self._lock = threading.Lock()
+
+    def call(self, method, url, headers=None, body=None, timeout=None, stream=False):
+        start = time.time()
+        options = {}
+
+        if timeout is not None:
+            options['timeout'] = timeout
+        if stream:
+            options['stream'] = True
+
+        response = self._transport.call(method, url, headers=headers, body=body, **options)
+
+        def record(content):
+            self._record(method, url, body, response.status_code, content, time.time() - start)
+
+        # Streamed responses are recorded once read, so they are still streamed meanwhile
+        if stream:
+            return RecordingResponse(response, record)
+
+        record(response.content)
+
+        return response
+
+    def _record(self, method, url, body, status_code, content, elapsed):
+        text = content.decode('utf-8')
+
+        try:
+            text = json.dumps(CallTracer.redact(json.loads(text)))
+        except ValueError:
+            pass
+
+        record = json.dumps({
+            'method': method,
+            'url': url,
+            'body': CallTracer.redact(body),
+            'status_code': status_code,
+            'content': text,
+            'elapsed': elapsed
+        }, cls=IterableObjectEncoder)
+
+        with self._lock:
+            with open(self._path, 'a') as f:
+                f.write(record+'\n')
+
+    def get_pool_stats(self):
+        return self._transport.get_pool_stats() if hasattr(self._transport, 'get_pool_stats') else None
+
+    def close(self):
+        if hasattr(self._transport, 'close'):
+            return self._transport.close()
+
+class RecordingResponse(object):
+    """
+    A streamed response, handing its content to record once it has
+    been read to the end. Content left unread when it is closed is
+    read first, so that the whole response is recorded.
+    """
+    def __init__(self, response, record):
+        self.status_code = response.status_code
+        self._response = response
+        self._record = record
+        self._recorded = False
+        self._reading = None
+
+    @property
+    def content(self):
+        content = self._response.content
+        self._finish(content)
+        return content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.text)
+
+    def iter_content(self, chunk_size=1):
+        self._reading = self._read(chunk_size)
+        return self._reading
+
+    def close(self):
+        if self._reading is not None:
+            for chunk in self._reading:
+                pass
+
+        if hasattr(self._response, 'close'):
+            self._response.close()
+
+    def _read(self, chunk_size):
+        chunks = []
+
+        for chunk in self._response.iter_content(chunk_size):
+            chunks.append(chunk)
+            yield chunk
+
+        self._finish(b''.join(chunks))
+
+    def _finish(self, content):
+        if not self._recorded:
+            self._recorded = True
+            self._record(content)
+
+class ReplayTransport(object):
+    """
+    Answers calls with the responses recorded by RecordingTransport,
+    matching calls on their method, path and body, whatever address
+    they were recorded against. Calls recorded more
+    than once are answered in the recorded order, starting over once
+    all have been replayed. Every call waits latency seconds, plus up
+    to jitter seconds, or as long as it was recorded to take if latency
+    is None.
+    """
+    def __init__(self, path, latency=0, jitter=0):
+        self._latency = latency
+        self._jitter = jitter
+        self._responses = {}
+        self._positions = {}
+        self._lock = threading.Lock()
+        self._stats = {'calls':0, 'misses':0}
+
+        with open(path) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+
+                record = json.loads(line)
+                key = self._get_key(record['method'], record['url'], record['body'])
+                self._responses.setdefault(key, []).append(record)
+
+    def call(self, method, url, headers=None, body=None, timeout=None, stream=False):
+        key = self._get_key(method, url, CallTracer.redact(body))
+
+        with self._lock:
+            self._stats['calls'] += 1
+            records = self._responses.get(key)
+
+            if records is None:
+                self._stats['misses'] += 1
+                raise UserAppTransportException("No recorded response for {m} {u}.".format(m=method, u=url))
+
+            position = self._positions.get(key, 0)
+            self._positions[key] = (position + 1) % len(records)
+
+        record = records[position]
+        latency = record['elapsed'] if self._latency is None else self._latency + random.uniform(0, self._jitter)
+
+        if latency > 0:
+            time.sleep(latency)
+
+        return RecordedResponse(record['status_code'], record['content'].encode('utf-8'))
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def _get_key(self, method, url, body):
+        path = url.split('://', 1)[-1].partition('/')[2]
+
+        return (method, path, json.dumps(body, sort_keys=True, separators=(',', ':'), default=DictionaryUtility.unwrap))
+
+class Client(object):
+    """
+    Handles communication with the UserApp API.
+    """
+    _transport_options=['pool_size','pool_max_connections','pool_idle_timeout','connect_timeout','read_timeout','codec','compression']
+
+    def __init__(self, app_id, token="", base_address='api.userapp.io', throw_errors=True, secure=True, debug=False, logger=None, transport=None,
+            pool_size=10, pool_max_connections=10, pool_idle_timeout=None, connect_timeout=None, read_timeout=None, lazy_responses=False, cache=None, user_snapshots=None,
+            timeout=None, hedging=None, retry=None, circuit_breaker=None, rate_limiter=None, hooks=None,
+            trace_sample_rate=1.0, trace_max_body=2048, codec=None, single_flight=None, transport_class=None, compression=None):
+        self._app_id=app_id
+        self._token=token
+        self._base_address=base_address
+        self._throw_errors=throw_errors
+        self._secure=secure
+        self._debug=debug
+        self._pool_size=pool_size
+        self._pool_max_connections=pool_max_connections
+        self._pool_idle_timeout=pool_idle_timeout
+        self._connect_timeout=connect_timeout
+        self._read_timeout=read_timeout
+        self._lazy_responses=lazy_responses
+        self._cache=ResponseCache() if cache is True else cache
+        self._user_snapshots=UserSnapshots() if user_snapshots is True else user_snapshots
+        self._timeout=timeout
+        self._hedging=RequestHedger() if hedging is True else hedging
+        self._single_flight=SingleFlight() if single_flight is True else single_flight
+        self._retry=RetryPolicy() if retry is True else retry
+        self._circuit_breaker=CircuitBreaker() if circuit_breaker is True else circuit_breaker
+        self._rate_limiter=rate_limiter
+        self._hooks=list(hooks) if hooks else []
+        self._trace_sample_rate=trace_sample_rate
+        self._trace_max_body=trace_max_body
+        self._codec=JsonCodec.get_fastest() if codec is True else (codec if not codec is None else JsonCodec())
+        self._compression=Compression() if compression is True else compression
+        self._call_plans={}
+        self._headers=None
+        self._credentials=ContextLocal('userapp.credentials')
+        self._transport_class=transport_class if not transport_class is None else NativeTransport
+
+        # Setup logging, add handler if debug mode
+        self._logger=default_logger if logger is None else logger
+        if debug:
+            self._logger.setLevel(logging.DEBUG)
+            if len(self._logger.handlers) == 0:
+                log_handler = logging.StreamHandler()
+                log_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+                log_handler.setFormatter(log_format)
+                self._logger.addHandler(log_handler)
+                log_handler.setLevel(logging.DEBUG)
+
+        self._tracer=CallTracer(self._logger, sample_rate=trace_sample_rate, max_body=trace_max_body)
+        self._transport=transport if not transport is None else self._create_transport()
+
+    def _create_transport(self):
+        return self._transport_class(
+            self._logger,
+            pool_size=self._pool_size,
+            pool_max_connections=self._pool_max_connections,
+            pool_idle_timeout=self._pool_idle_timeout,
+            connect_timeout=self._connect_timeout,
+            read_timeout=self._read_timeout,
+            codec=self._codec,
+            compression=self._compression
+        )
+
+    def call(self, version, service, method, arguments, timeout=None):
+        if not self._hooks:
+            return self._call(version, service, method, arguments, timeout, None)
+
+        context = self._start_call(version, service, method, arguments)
+
+        try:
+            result = self._call(version, service, method, arguments, timeout, context)
+        except Exception as e:
+            self._fail_call(context, e)
+            raise
+
+        return self._finish_call(context, result)
+
+    def add_hook(self, hook):
+        self._hooks = self._hooks + [hook]
+
+    def remove_hook(self, hook):
+        self._hooks = [h for h in self._hooks if not h is hook]
+
+    def _start_call(self, version, service, method, arguments):
+        context = CallContext(version, service, method, arguments)
+
+        for hook in self._hooks:
+            hook.before_send(context)
+
+        return context
+
+    def _finish_call(self, context, result):
+        context.latency = time.time() - context.started_at
+        context.result = result
+
+        for hook in self._hooks:
+            hook.after_receive(context)
+
+        return result
+
+    def _fail_call(self, context, error):
+        context.latency = time.time() - context.started_at
+        context.error = error
+
+        for hook in self._hooks:
+            hook.on_error(context, error)
+
+    def _call(self, version, service, method, arguments, timeout, context):
+        cache_key, result = self._get_cached(version, service, method, arguments)
+
+        if result is not None:
+            if context is not None:
+                context.cached = True
+            # A snapshot refresh may be served from the cache as well
+            self._update_snapshots(service, method, arguments, result)
+            return result
+
+        target_url, headers = self._prepare_call(version, service, method)
+        timeout = timeout if not timeout is None else self._timeout
+        traced = self._tracer.should_trace()
+
+        if traced:
+            self._tracer.trace_request('post', target_url, headers, arguments)
+
+        def send_once(timeout=timeout):
+            if self._rate_limiter is not None:
+                self._rate_limiter.acquire(self._app_id, service, method)
+
+            if timeout is None:
+                response = self._transport.call('post', url=target_url, headers=headers, body=arguments)
+            else:
+                response = self._transport.call('post', url=target_url, headers=headers, body=arguments, timeout=timeout)
+
+            self._check_response(response)
+
+            return response
+
+        def send():
+            if self._retry is None and self._circuit_breaker is None:
+                return send_once()
+
+            attempt = 1
+            # Retries share the timeout of the call rather than getting one each
+            deadline = None if timeout is None else time.time() + timeout
+
+            if self._retry is not None:
+                self._retry.record_call()
+
+            while True:
+                remaining = None if deadline is None else deadline - time.time()
+
+                try:
+                    return self._attempt(lambda: send_once(remaining))
+                except UserAppTransportException as e:
+                    backoff = None if self._retry is None else self._retry.get_backoff(method, e, attempt)
+
+                    if backoff is None or deadline is not None and time.time() + backoff >= deadline:
+                        raise
+
+                    if self._logger.isEnabledFor(logging.DEBUG):
+                        self._logger.debug("Retrying {s}.{m} in {b:.3f}s after: {e}".format(s=service, m=method, b=backoff, e=e))
+                    time.sleep(backoff)
+                    attempt += 1
+
+        def fetch():
+            if self._hedging is not None and method in ResponseCache.read_methods:
+                return self._hedging.call("{s}.{m}".format(s=service, m=method), send, timeout)
+
+            return send()
+
+        if self._single_flight is not None:
+            flight_key = self._single_flight.get_key(self._app_id, self._get_token(), version, service, method, arguments)
+            response = self._single_flight.call(flight_key, fetch, timeout)
+        else:
+            response = fetch()
+
+        if traced:
+            self._tracer.trace_response(response)
+
+        result = self._handle_response(service, method, response, context)
+        self._update_cache(cache_key, service, method, arguments, response, result)
+        self._update_snapshots(service, method, arguments, result)
+
+        return result
+
+    def paginate(self, version, service, method, arguments, page_size=100, parallel=1):
+        """
+        Get a Paginator iterating the items of a search method.
+        """
+        return Paginator(self, version, service, method, arguments, page_size=page_size, parallel=parallel)
+
+    def batch(self, version, max_workers=8):
+        """
+        Get a Batch dispatching queued calls through this client.
+        """
+        return Batch(self, version=version, max_workers=max_workers)
+
+    def stream(self, version, service, method, arguments, timeout=None):
+        """
+        Call a method, returning a StreamingResult that parses the
+        response while it is received. Streamed calls are not cached,
+        coalesced, hedged or retried.
+        """
+        target_url, headers = self._prepare_call(version, service, method)
+        timeout = timeout if not timeout is None else self._timeout
+
+        if self._tracer.should_trace():
+            self._tracer.trace_request('post', target_url, headers, arguments)
+
+        def send():
+            if self._rate_limiter is not None:
+                self._rate_limiter.acquire(self._app_id, service, method)
+
+            response = self._transport.call('post', url=target_url, headers=headers, body=arguments, timeout=timeout, stream=True)
+            self._check_response(response)
+
+            return response
+
+        convert = DictionaryUtility.to_lazy_object if self._lazy_responses else DictionaryUtility.to_object
+        result = StreamingResult(self._attempt(send), convert)
+
+        # Errors are small results without items, raise them as usual
+        if 'error_code' in result._fields:
+            self._handle_result(service, method, result._fields)
+
+        return result
+
+    def _attempt(self, send):
+        """
+        Make an attempt, guarded by the circuit breaker.
+        """
+        if self._circuit_breaker is None:
+            return send()
+
+        self._circuit_breaker.before_call(self._base_address)
+
+        try:
+            response = send()
+        except UserAppTransportException:
+            self._circuit_breaker.record_failure(self._base_address)
+            raise
+        except BaseException:
+            # Other errors say nothing about the host, but a trial must not stay pending
+            self._circuit_breaker.record_failure(self._base_address, trial_only=True)
+            raise
+
+        self._circuit_breaker.record_success(self._base_address)
+
+        return response
+
+    def _check_response(self, response):
+        if response is None:
+            raise UserAppTransportException("Recieved no response.")
+
+        # Server errors have no result to return, treat them as transport failures
+        if response.status_code >= 500:
+            raise UserAppTransportException("Recieved HTTP status {s}, expected 200.".format(s=response.status_code))
+
+    @contextlib.contextmanager
+    def as_token(self, token):
+        """
+        Use token for calls made in the current thread or asyncio task
+        until the block exits. Logging in or out within the block only
+        changes the token of the block.
+        """
+        previous = self._credentials.set(Credentials(token))
+
+        try:
+            yield
+        finally:
+            self._credentials.set(previous)
+
+    def has_permission(self, permission, user_id='self', version=1):
+        """
+        Check whether a user has a permission, or all of a list of
+        permissions, answered from the user's snapshot when possible.
+        """
+        return self._check_flags('permissions', 'hasPermission', 'permission', permission, user_id, version)
+
+    def has_feature(self, feature, user_id='self', version=1):
+        """
+        Check whether a user has a feature, or all of a list of
+        features, answered from the user's snapshot when possible.
+        """
+        return self._check_flags('features', 'hasFeature', 'feature', feature, user_id, version)
+
+    def _check_flags(self, kind, remote_method, argument, names, user_id, version):
+        names = names if isinstance(names, list) else [names]
+        snapshots = self._user_snapshots
+
+        if snapshots is None:
+            snapshots = self._user_snapshots = UserSnapshots()
+
+        snapshot = snapshots.get(self._app_id, self._get_token(), user_id)
+
+        if snapshot is None:
+            snapshots.count('refreshes')
+            self.call(version, 'user', 'get', {'user_id':user_id})
+            snapshot = snapshots.get(self._app_id, self._get_token(), user_id)
+
+        if snapshot is not None:
+            snapshots.count('local_checks')
+            return all(snapshot[kind].get(name, False) for name in names)
+
+        # The user could not be snapshotted, ask the API instead
+        snapshots.count('remote_checks')
+        result = self.call(version, 'user', remote_method, {'user_id':user_id, argument:names})
+
+        return len(getattr(result, 'missing_'+kind, [])) == 0
+
+    def _update_snapshots(self, service, method, arguments, result):
+        if self._user_snapshots is None:
+            return
+
+        self._user_snapshots.observe(self._app_id, self._get_token(), service, method, arguments, result)
+
+    def _get_cached(self, version, service, method, arguments):
+        """
+        Look up a call in the response cache, returning the
+        cache key of the call and the cached result, if any.
+        """
+        if self._cache is None:
+            return None, None
+
+        cache_key = self._cache.get_key(self._app_id, self._get_token(), version, service, method, arguments)
+
+        if cache_key is None:
+            return None, None
+
+        cached = self._cache.get(cache_key)
+
+        if cached is None:
+            return cache_key, None
+
+        if self._logger.isEnabledFor(logging.DEBUG):
+            self._logger.debug("Serving {s}.{m} from cache".format(s=service, m=method))
+
+        return cache_key, self._handle_result(service, method, self._codec.loads(cached))
+
+    def _update_cache(self, cache_key, service, method, arguments, response, result):
+        if self._cache is None:
+            return
+
+        is_error_result = isinstance(result, IterableObject) and 'error_code' in result
+        self._cache.update(cache_key, service, method, arguments, response.text, is_error_result)
+
+    def _prepare_call(self, version, service, method):
+        """
+        Resolve the target url and headers of a call. Both are compiled
+        once and reused until the options they depend on change.
+        """
+        target_url = self._call_plans.get((version, service, method))
+
+        if target_url is None:
+            target_url = self._compile_call(version, service, method)
+
+        credentials = self._credentials.get()
+
+        if credentials is None:
+            headers = self._headers
+
+            if headers is None:
+                headers = self._headers = self._compile_headers(self._token)
+        else:
+            headers = credentials.headers
+
+            if headers is None or credentials.app_id != self._app_id:
+                headers = self._compile_headers(credentials.token)
+                self._credentials.set(Credentials(credentials.token, self._app_id, headers))
+
+        return target_url, headers
+
+    def _compile_call(self, version, service, method):
+        protocol = 'https' if self._secure else 'http'
+
+        if not service:
+            raise UserAppInvalidServiceException("No service specified.")
+
+        if not service:
+            raise UserAppInvalidMethodException("No method on service '{s}' specified.".format(s=service))
+
+        target_url = "{p}://{a}/v{v}/{s}.{m}".format(
+            p=protocol,
+            a=self._base_address,
+            v=version,
+            s=service,
+            m=method
+        )
+
+        self._call_plans[(version, service, method)] = target_url
+
+        return target_url
+
+    def _compile_headers(self, token):
+        encoded_credentials=None
+
+        # Python 2/3 compatibility
+        if sys.version_info[0] < 3:
+            encoded_credentials=base64.b64encode('{u}:{p}'.format(u=self._app_id, p=token)).encode('ascii')
+        else:
+            encoded_credentials=base64.b64encode(bytes('{u}:{p}'.format(u=self._app_id, p=token), 'ascii')).decode('ascii')
+
+        # Shared between calls, transports must not modify it
+        return {
+            'Content-Type':'application/json',
+            'Authorization':'Basic '+encoded_credentials
+        }
+
+    def _get_token(self):
+        credentials = self._credentials.get()
+
+        return self._token if credentials is None else credentials.token
+
+    def _set_token(self, token):
+        credentials = self._credentials.get()
+
+        if credentials is None:
+            self._token = token
+            self._headers = None
+        else:
+            # Only the current context sees the new token, not the contexts sharing the old credentials
+            self._credentials.set(Credentials(token))
+
+    def _handle_response(self, service, method, response, context=None):
+        """
+        Convert a transport response into a result, raising
+        on error results and keeping track of the token.
+        """
+        if context is None:
+            return self._handle_result(service, method, self._codec.loads(response.content))
+
+        request = getattr(response, 'request', None)
+        request_body = getattr(request, 'body', None)
+
+        context.status_code = response.status_code
+        context.request_bytes = len(request_body) if request_body is not None else len(self._codec.dumps(context.arguments))
+        context.response_bytes = len(response.content)
+
+        start = time.time()
+        data = self._codec.loads(response.content)
+        context.decode_time = time.time() - start
+
+        return self._handle_result(service, method, data, context)
+
+    def _handle_result(self, service, method, data, context=None):
+        """
+        Convert decoded response data into a result.
+        """
+        start = time.time() if context is not None else None
+
+        if self._lazy_responses:
+            result = DictionaryUtility.to_lazy_object(data)
+        else:
+            result = DictionaryUtility.to_object(data)
+        is_error_result=hasattr(result, 'error_code')
+
+        if context is not None:
+            context.convert_time = time.time() - start
+            context.error_code = result.error_code if is_error_result else None
+
+        # If we got an error back in the response result, or if the
+        # HTTP response code was bad, raise the appropriate exception.
+        if self._throw_errors and is_error_result:
+            if result.error_code == 'INVALID_SERVICE':
+                raise UserAppInvalidServiceException("Service '{s}' does not exist.".format(s=service), service)
+            elif result.error_code == 'INVALID_METHOD':
+                raise UserAppInvalidMethodException("Method '{m}' on service '{s}' does not exist.".format(m=method,s=service), service, method)
+            else:
+                raise UserAppServiceException(result.message, result.error_code)
+
+        # For ease of use. Automatically set/unset the token during login/logout
+        if service == 'user':
+            if not is_error_result and method == 'login':
+                self._set_token(result.token)
+            elif method == 'logout':
+                self._set_token("")
+
+        return result
+
+    def set_option(self, name, value):
+        if not self._is_valid_option(name):
+            raise UserAppInvalidOptionException("Option {s} does not exist.".format(s=name))
+
+        if name == 'cache' and value is True:
+            value = ResponseCache()
+
+        if name == 'user_snapshots' and value is True:
+            value = UserSnapshots()
+
+        if name == 'hedging' and value is True:
+            value = RequestHedger()
+
+        if name == 'single_flight' and value is True:
+            value = SingleFlight()
+
+        if name == 'hooks':
+            value = list(value) if value else []
+
+        if name == 'retry' and value is True:
+            value = RetryPolicy()
+
+        if name == 'circuit_breaker' and value is True:
+            value = CircuitBreaker()
+
+        if name == 'compression' and value is True:
+            value = Compression()
+
+        if name == 'codec':
+            value = JsonCodec.get_fastest() if value is True else (value if not value is None else JsonCodec())
+
+        if name in self._transport_options and hasattr(self._transport, 'configure'):
+            self._transport.configure(**{name:value})
+
+        setattr(self, '_'+name, value)
+
+        if name == 'trace_sample_rate':
+            self._tracer.sample_rate = value
+        elif name == 'trace_max_body':
+            self._tracer.max_body = value
+
+        # Drop compiled call plans depending on the option
+        if name in ['app_id','token']:
+            self._headers = None
+        elif name in ['base_address','secure']:
+            self._call_plans = {}
+
+    def get_option(self, name):
+        if not self._is_valid_option(name):
+            raise UserAppInvalidOptionException("Option {s} does not exist.".format(s=name))
+
+        if name == 'token':
+            return self._get_token()
+
+        return getattr(self, '_'+name)
+
+    def _is_valid_option(self, name):
+        return name in ['app_id','token','base_address','secure','debug','lazy_responses','cache','user_snapshots','timeout','hedging','retry','circuit_breaker','rate_limiter','hooks','trace_sample_rate','trace_max_body','single_flight'] + self._transport_options
+
+    def get_pool_stats(self):
+        if not hasattr(self._transport, 'get_pool_stats'):
+            return None
+
+        return self._transport.get_pool_stats()
+
+    def close(self):
+        if hasattr(self._transport, 'close'):
+            return self._transport.close()
+
+    def get_logger(self):
+        return self._logger
+
+    def set_logger(self, logger):
+        self._logger = logger
+        self._tracer.logger = logger
+
+class ClientProxy(object):
+    """
+    Proxies Python attribute/function calls into UserApp client calls.
+    """
+    _client_class=Client
+
+    def __init__(self, **kwargs):
+        self._client=None
+        self._parent=None
+        self._version=1
+        self._service_name=""
+        self._method_name=""
+        self._services={}
+        self._client_pool=None
+        self._schema=None
+
+        if 'parent' in kwargs:
+            self._parent=kwargs['parent']
+            del kwargs['parent']
+
+        if 'version' in kwargs:
+            self._version=kwargs['version']
+            del kwargs['version']
+
+        if 'service_name' in kwargs:
+            self._service_name=kwargs['service_name']
+            del kwargs['service_name']
+
+        if 'method_name' in kwargs:
+            self._method_name=kwargs['method_name']
+            del kwargs['method_name']
+
+        if 'schema' in kwargs:
+            self._schema=ServiceSchema.get_default() if kwargs['schema'] is True else kwargs['schema']
+            del kwargs['schema']
+
+        if 'client' in kwargs:
+            self._client=kwargs['client']
+        elif self._parent is None:
+            self._client=self._client_class(**kwargs)
+        else:
+            self._client=self._parent._client
+
+    def __call__(self, *args, **kwargs):
+        if self._parent is None:
+            raise UserAppInvalidMethodException("Service does not exist.")
+
+        # Per-call options are prefixed with an underscore, i.e. _timeout=0.2
+        if '_timeout' in kwargs:
+            timeout = kwargs.pop('_timeout')
+            return self._client.call(self._version, self._parent._service_name, self._method_name, kwargs, timeout=timeout)
+
+        return self._client.call(self._version, self._parent._service_name, self._method_name, kwargs)
+
+    def __getattr__(self, name):
+        if self._schema is not None:
+            stub = self._schema.get_stub(self, name)
+
+            if stub is not None:
+                object.__setattr__(self, name, stub)
+                return stub
+
+        attribute_name = name
+        name = self._apply_naming_convention(name)
+
+        if not name in self._services:
+            if self._parent is None and self._is_version(name):
+                self._services[name] = ClientProxy(
+                    parent=self,
+                    version=name[1:]
+                )
+            else:
+                self._services[name] = ClientProxy(
+                    parent=self,
                     version=self._version,
                     service_name=name if not self._service_name else "{s}.{m}".format(s=self._service_name, m=name),
                     method_name=name
                 )
 
+        # Cache on the instance, later lookups will not reach __getattr__
+        object.__setattr__(self, attribute_name, self._services[name])
+
         return self._services[name]
 
+    def iter(self, page_size=100, parallel=1, **kwargs):
+        """
+        Iterate all items of a search method, i.e.
+        api.user.search.iter(filters={...}, page_size=50).
+        """
+        if self._parent is None or not self._method_name:
+            raise UserAppInvalidMethodException("No method to iterate.")
+
+        return self._client.paginate(self._version, self._parent._service_name, self._method_name, kwargs, page_size=page_size, parallel=parallel)
+
+    def stream(self, **kwargs):
+        """
+        Call a method, parsing its result while it is received, i.e.
+        for user in api.user.search.stream(page_size=10000).
+        """
+        if self._parent is None or not self._method_name:
+            raise UserAppInvalidMethodException("No method to stream.")
+
+        timeout = kwargs.pop('_timeout', None)
+
+        return self._client.stream(self._version, self._parent._service_name, self._method_name, kwargs, timeout=timeout)
+
     def get_client(self):
         return self._client
 
@@ -355,6 +2930,51 @@ class ClientProxy(object):
     def set_logger(self, logger):
         return self._client.set_logger(logger)
 
+    def get_pool_stats(self):
+        return self._client.get_pool_stats()
+
+    def close(self):
+        return self._client.close()
+
+    def add_hook(self, hook):
+        self._client.add_hook(hook)
+
+    def remove_hook(self, hook):
+        self._client.remove_hook(hook)
+
+    def as_token(self, token):
+        return self._client.as_token(token)
+
+    def batch(self, max_workers=8):
+        """
+        Queue calls made through the returned batch and dispatch
+        them concurrently when the batch is executed.
+        """
+        return self._client.batch(self._version, max_workers=max_workers)
+
+    def gather(self, calls, max_workers=8):
+        """
+        Dispatch (method, arguments) pairs concurrently, i.e.
+        [(api.user.get, {'user_id':'x'}), (api.user.count, {})].
+        Returns results, or the raised exception, in submission order.
+        """
+        batch = self.batch(max_workers=max_workers)
+
+        for method, arguments in calls:
+            batch.queue(method._version, method._parent._service_name, method._method_name, arguments)
+
+        return batch.execute()
+
+    def for_app(self, app_id, token=""):
+        """
+        Get a handle for another app, sharing the options and
+        connection pool of this one. See ClientPool.
+        """
+        if self._client_pool is None:
+            self._client_pool = ClientPool(self)
+
+        return self._client_pool.get(app_id, token)
+
     def _is_version(self, s):
         if s.startswith('v'):
             try:
@@ -368,6 +2988,798 @@ class ClientProxy(object):
     def _apply_naming_convention(self, value):
         return re.sub(r'(?!^)_([a-zA-Z])', lambda m: m.group(1).upper(), value)
 
+class ServiceSchema(object):
+    """
+    Services and methods of the API per version, i.e.
+    {'1': {'user': ['get', 'search'], 'user.invoice': ['search']}}.
+    API(schema=...) calls them through stubs generated from it, found
+    without dynamic proxying. Names missing from the schema are proxied
+    dynamically, or rejected before any call is made if strict.
+    """
+    defaults = {}
+
+    def __init__(self, services, strict=False):
+        self.strict = strict
+        self._services = dict((str(version), dict((service, set(methods)) for service, methods in version_services.items()))
+            for version, version_services in services.items())
+        self._stubs = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def load(path, strict=False):
+        """
+        Load a schema from a JSON file of the same shape.
+        """
+        with open(path) as f:
+            return ServiceSchema(json.load(f), strict=strict)
+
+    @staticmethod
+    def get_default(strict=False):
+        """
+        Get the schema bundled with the library, shared
+        so its stubs are only generated once.
+        """
+        if not strict in ServiceSchema.defaults:
+            import userapp.schema
+            ServiceSchema.defaults[strict] = ServiceSchema(userapp.schema.services, strict=strict)
+
+        return ServiceSchema.defaults[strict]
+
+    def has_method(self, version, service, method):
+        return method in self._services.get(str(version), {}).get(service, ())
+
+    def validate(self, version, service, method):
+        """
+        Raise if the method is not in the schema.
+        """
+        services = self._services.get(str(version), {})
+
+        if not service in services:
+            raise UserAppInvalidServiceException("Service '{s}' does not exist in the schema.".format(s=service))
+
+        if not method in services[service]:
+            raise UserAppInvalidMethodException("Method '{s}.{m}' does not exist in the schema.".format(s=service, m=method))
+
+    def get_stub(self, parent, name):
+        """
+        Get a stub for the service name on the root proxy parent, or
+        None if it is to be proxied dynamically.
+        """
+        version = str(parent._version)
+        stubs = self._stubs.get(version)
+
+        if stubs is None:
+            with self._lock:
+                if not version in self._stubs:
+                    self._stubs[version] = self._generate(version)
+
+                stubs = self._stubs[version]
+
+        stub_class = stubs.get(name)
+
+        if stub_class is not None:
+            return stub_class.create(parent, stub_class.service_name)
+
+        # Private and special names, i.e. looked up by hasattr(), are never services
+        if self.strict and not name.startswith('_') and version in self._services and not parent._is_version(name):
+            raise UserAppInvalidServiceException("Service '{s}' does not exist in the schema.".format(s=parent._apply_naming_convention(name)))
+
+        return None
+
+    def _generate(self, version):
+        classes = {}
+
+        def get_class(service):
+            if not service in classes:
+                class_name = ''.join(part[:1].upper()+part[1:] for part in service.split('.'))+'Stub'
+                classes[service] = type(str(class_name), (ServiceStub,), {'service_name': service, 'schema': self})
+                parent, _, name = service.rpartition('.')
+
+                # Nested services are attributes of their parent, i.e. user.invoice
+                if parent:
+                    for alias, attribute in StubAttribute.create(name, classes[service], service).items():
+                        setattr(get_class(parent), alias, attribute)
+
+            return classes[service]
+
+        for service, methods in self._services.get(version, {}).items():
+            stub_class = get_class(service)
+
+            for method in methods:
+                for alias, attribute in StubAttribute.create(method, StubMethod, service+'.'+method).items():
+                    setattr(stub_class, alias, attribute)
+
+        roots = {}
+
+        for service, stub_class in classes.items():
+            if not '.' in service:
+                roots.update((alias, stub_class) for alias in StubAttribute.get_aliases(service))
+
+        return roots
+
+class StubAttribute(object):
+    """
+    Class attribute of a generated stub, creating the method or nested
+    service stub on first access and caching it on the instance.
+    """
+    def __init__(self, aliases, stub_class, service_name):
+        self._aliases = aliases
+        self._stub_class = stub_class
+        self._service_name = service_name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+
+        stub = self._stub_class.create(instance, self._service_name)
+
+        for alias in self._aliases:
+            instance.__dict__[alias] = stub
+
+        return stub
+
+    @staticmethod
+    def get_aliases(name):
+        # Both api.user.payment_method and api.user.paymentMethod
+        return [name, re.sub(r'([A-Z])', lambda m: '_'+m.group(1).lower(), name)]
+
+    @staticmethod
+    def create(name, stub_class, service_name):
+        aliases = StubAttribute.get_aliases(name)
+        attribute = StubAttribute(aliases, stub_class, service_name)
+        return dict((alias, attribute) for alias in aliases)
+
+class ServiceStub(ClientProxy):
+    """
+    Base of the service stubs generated by a ServiceSchema, holding its
+    methods and nested services as class attributes.
+    """
+    service_name = None
+    schema = None
+
+    @classmethod
+    def create(cls, parent, service_name):
+        stub = object.__new__(cls)
+        stub.__dict__.update(
+            _client=parent._client,
+            _parent=parent,
+            _version=parent._version,
+            _service_name=service_name,
+            _method_name=service_name.rpartition('.')[2],
+            _services={},
+            _client_pool=None,
+            _schema=None
+        )
+        return stub
+
+    def __getattr__(self, name):
+        if self.schema.strict and not name.startswith('_'):
+            self.schema.validate(self._version, self._service_name, self._apply_naming_convention(name))
+
+        return ClientProxy.__getattr__(self, name)
+
+class StubMethod(ServiceStub):
+    """
+    A method of a service stub, calling the client with its
+    names resolved up front.
+    """
+    @classmethod
+    def create(cls, parent, service_name):
+        stub = super(StubMethod, cls).create(parent, service_name)
+        stub.__dict__['_names'] = (parent._service_name, stub._method_name)
+        return stub
+
+    def __getattr__(self, name):
+        return ClientProxy.__getattr__(self, name)
+
+    def __call__(self, **kwargs):
+        service, method = self._names
+
+        if '_timeout' in kwargs:
+            timeout = kwargs.pop('_timeout')
+            return self._client.call(self._version, service, method, kwargs, timeout=timeout)
+
+        return self._client.call(self._version, service, method, kwargs)
+
+class StreamingResult(object):
+    """
+    The result of a call, parsed while it is being received. Its items
+    are decoded and yielded one at a time by iterating the result, so
+    only one item is held in memory at once. Other fields are available
+    as attributes. Fields sent after the items are only read once the
+    items have been iterated, accessing them earlier reads the remaining
+    items ahead into memory.
+    """
+    def __init__(self, response, convert=None, chunk_size=65536):
+        iter_content = getattr(response, 'iter_content', None)
+
+        self._response = response
+        self._chunks = iter_content(chunk_size) if iter_content is not None else iter([response.content])
+        self._chunk_size = chunk_size
+        self._convert = convert if not convert is None else DictionaryUtility.to_object
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._decoder = json.JSONDecoder()
+        self._buffer = ''
+        self._position = 0
+        self._eof = False
+        self._fields = {}
+        self._items = None
+        self._read_ahead = collections.deque()
+        self._iterated = False
+
+        self._expect('{')
+        self._read_fields()
+
+    @property
+    def items(self):
+        return iter(self)
+
+    def __iter__(self):
+        if self._iterated:
+            raise UserAppException("The items of a streaming result can only be iterated once.")
+
+        self._iterated = True
+
+        while len(self._read_ahead) > 0:
+            yield self._convert(self._read_ahead.popleft())
+
+        while True:
+            item = self._next_item()
+
+            if item is None:
+                return
+
+            yield self._convert(item)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+
+        while not name in self._fields and self._items is not None:
+            item = self._next_item()
+
+            if item is not None:
+                self._read_ahead.append(item)
+
+        if not name in self._fields:
+            raise AttributeError("Object has not attribute '{k}'".format(k=name))
+
+        return self._convert(self._fields[name])
+
+    def __contains__(self, name):
+        try:
+            getattr(self, name)
+            return True
+        except AttributeError:
+            return False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        if hasattr(self._response, 'close'):
+            self._response.close()
+
+    def to_dict(self):
+        """
+        Read the remaining result into a dictionary.
+        """
+        fields = dict(self._fields)
+
+        if not self._iterated:
+            fields['items'] = [DictionaryUtility.unwrap(item) for item in self]
+
+        return fields
+
+    def _read_fields(self):
+        """
+        Read fields until the start of the items, or the end of the result.
+        """
+        while True:
+            token = self._peek()
+
+            if token == '}':
+                self._position += 1
+                self._items = None
+                self.close()
+                return
+
+            if token == ',':
+                self._position += 1
+                continue
+
+            key = self._decode()
+            self._expect(':')
+
+            if key == 'items' and self._peek() == '[':
+                self._position += 1
+                self._items = True
+                return
+
+            self._fields[key] = self._decode()
+
+    def _next_item(self):
+        if self._items is None:
+            return None
+
+        token = self._peek()
+
+        if token == ']':
+            self._position += 1
+            self._read_fields()
+            return None
+
+        if token == ',':
+            self._position += 1
+
+        return self._decode()
+
+    def _decode(self):
+        self._peek()
+
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buffer, self._position)
+            except ValueError:
+                value, end = None, None
+
+            # A value ending with the buffer, like a number, may continue in the next chunk
+            if end is not None and (end < len(self._buffer) or self._eof):
+                self._position = end
+                return value
+
+            if not self._read():
+                raise UserAppTransportException("Recieved an incomplete or invalid JSON response.")
+
+    def _expect(self, token):
+        if self._peek() != token:
+            raise UserAppTransportException("Recieved an invalid JSON response, expected '{t}'.".format(t=token))
+
+        self._position += 1
+
+    def _peek(self):
+        while True:
+            while self._position < len(self._buffer) and self._buffer[self._position] in ' \t\r\n':
+                self._position += 1
+
+            if self._position < len(self._buffer):
+                return self._buffer[self._position]
+
+            if not self._read():
+                return None
+
+    def _read(self):
+        if self._eof:
+            return False
+
+        try:
+            chunk = next(self._chunks, None)
+        except (IOError, OSError) as e:
+            # Covers the exceptions of both requests and the standard library
+            raise UserAppTransportException("Reading response failed: {e}".format(e=e))
+
+        # Drop what has been parsed, keeping the buffer to about a chunk
+        self._buffer = self._buffer[self._position:]
+        self._position = 0
+
+        if chunk is None:
+            self._eof = True
+            self._buffer += self._text.decode(b'', True)
+        else:
+            self._buffer += self._text.decode(chunk)
+
+        return True
+
+class Paginator(object):
+    """
+    Iterates the items of a search method page by page, fetching the
+    next page in the background while the current one is consumed.
+    With parallel > 1, up to that many pages are fetched concurrently
+    once the total number of items is known. At most parallel + 1
+    pages are held in memory.
+    """
+    def __init__(self, client, version, service, method, arguments, page_size=100, parallel=1, start_page=1):
+        if page_size < 1 or parallel < 1 or start_page < 1:
+            raise ValueError("page_size, parallel and start_page must be at least 1.")
+
+        self._client=client
+        self._version=version
+        self._service=service
+        self._method=method
+        self._arguments=arguments
+        self._page_size=page_size
+        self._parallel=parallel
+        self._start_page=start_page
+        self.total_items=None
+
+    def __iter__(self):
+        for page in self.pages():
+            for item in getattr(page, 'items', None) or []:
+                yield item
+
+    def pages(self):
+        """
+        Iterate the results of each page, in order.
+        """
+        first_page=self._fetch(self._start_page)
+        self.total_items=getattr(first_page, 'total_items', None)
+
+        if self.total_items is not None:
+            page_count=max((self.total_items + self._page_size - 1) // self._page_size, 1)
+        else:
+            page_count=None
+
+        pool=WorkerPool(self._parallel)
+        pending=collections.deque()
+        next_page=self._start_page+1
+        page=first_page
+
+        try:
+            while page is not None:
+                items=getattr(page, 'items', None) or []
+
+                if page_count is not None:
+                    while len(pending) < self._parallel and next_page <= page_count:
+                        pending.append(pool.submit(self._fetch, next_page))
+                        next_page+=1
+                elif len(items) >= self._page_size and len(pending) == 0:
+                    # Without a total, keep going for as long as pages come back full
+                    pending.append(pool.submit(self._fetch, next_page))
+                    next_page+=1
+
+                yield page
+
+                page=pending.popleft().result() if len(pending) > 0 else None
+        finally:
+            pool.shutdown(wait=False)
+
+    def _fetch(self, page):
+        arguments=dict(self._arguments, page=page, page_size=self._page_size)
+        return self._client.call(self._version, self._service, self._method, arguments)
+
+class UserExporter(object):
+    """
+    Exports all users of an app to a file of newline delimited JSON,
+    optionally gzip compressed. Pages are fetched concurrently but
+    written one at a time, so memory use does not grow with the number
+    of users. A checkpoint is kept next to the file after every page,
+    letting an interrupted export resume where it stopped.
+    """
+    def __init__(self, api, page_size=100, parallel=4, fields=None, filters=None):
+        self._api=api
+        self._page_size=page_size
+        self._parallel=parallel
+        self._arguments={'sort_field':'created_at', 'sort_order':'asc'}
+
+        if fields is not None:
+            self._arguments['fields']=fields
+        if filters is not None:
+            self._arguments['filters']=filters
+
+    def export(self, path, compress=None, resume=True):
+        """
+        Export the users to path, compressing them if compress is True
+        or, by default, if path ends with '.gz'. Returns the number of
+        users and pages written.
+        """
+        compress=path.endswith('.gz') if compress is None else compress
+        checkpoint_path=path+'.checkpoint'
+        checkpoint=self._read_checkpoint(checkpoint_path) if resume else None
+        stats={'users':0, 'pages':0, 'resumed_from':None}
+
+        if checkpoint is not None and os.path.exists(path):
+            output=open(path, 'r+b')
+            output.truncate(checkpoint['offset'])
+            output.seek(checkpoint['offset'])
+            stats['users']=checkpoint['users']
+            stats['resumed_from']=checkpoint['page']+1
+        else:
+            output=open(path, 'wb')
+            checkpoint=None
+
+        client=self._api.get_client()
+        codec=client.get_option('codec')
+        page_number=stats['resumed_from'] or 1
+        paginator=Paginator(client, self._api._version, 'user', 'search', self._arguments,
+            page_size=self._page_size, parallel=self._parallel, start_page=page_number)
+
+        try:
+            for page in paginator.pages():
+                items=getattr(page, 'items', None) or []
+                lines=[]
+
+                for item in items:
+                    line=codec.dumps(DictionaryUtility.unwrap(item))
+                    lines.append(line if isinstance(line, bytes) else line.encode('utf-8'))
+
+                if lines:
+                    self._write(output, b'\n'.join(lines)+b'\n', compress)
+
+                stats['users']+=len(items)
+                stats['pages']+=1
+
+                self._write_checkpoint(checkpoint_path, {'page':page_number, 'offset':output.tell(), 'users':stats['users']})
+                page_number+=1
+        finally:
+            output.close()
+
+        os.remove(checkpoint_path)
+
+        return stats
+
+    def _write(self, output, data, compress):
+        if compress:
+            # Every page is a gzip member of its own, so the file can be
+            # truncated after any page and still be read as a whole
+            member=gzip.GzipFile(filename='', mode='wb', fileobj=output)
+            member.write(data)
+            member.close()
+        else:
+            output.write(data)
+
+        output.flush()
+
+    def _read_checkpoint(self, path):
+        if not os.path.exists(path):
+            return None
+
+        with open(path) as f:
+            return json.load(f)
+
+    def _write_checkpoint(self, path, checkpoint):
+        temporary_path=path+'.tmp'
+
+        with open(temporary_path, 'w') as f:
+            json.dump(checkpoint, f)
+
+        # Python 2 has no os.replace, where rename replaces on POSIX
+        getattr(os, 'replace', os.rename)(temporary_path, path)
+
+class BulkWriter(object):
+    """
+    Sends records, i.e. the arguments of user.save calls, through a
+    bounded number of concurrent calls. Reading records is held back
+    while max_pending calls are in flight. Transport errors are retried
+    with backoff as a RetryPolicy would, and the outcome of every record
+    is reported instead of failed records aborting the run.
+    """
+    def __init__(self, api, method='user.save', max_workers=8, max_pending=None, max_attempts=3, backoff=0.1):
+        if max_workers < 1 or max_attempts < 1:
+            raise ValueError("max_workers and max_attempts must be at least 1.")
+
+        self._api=api
+        self._service, _, self._method=method.rpartition('.')
+        self._max_workers=max_workers
+        self._max_pending=max_pending if not max_pending is None else max_workers * 2
+        self._max_attempts=max_attempts
+        self._backoff=backoff
+
+        if not self._service:
+            raise UserAppInvalidServiceException("No service specified in '{m}'.".format(m=method))
+
+    def write(self, records, report=None):
+        """
+        Write records, an iterable of dictionaries. If report is given,
+        the outcome of each record is written to it as a line of JSON.
+        Returns counts of the records written and failed.
+        """
+        stats={'records':0, 'succeeded':0, 'failed':0, 'retries':0, 'error_codes':{}}
+        pool=WorkerPool(self._max_workers)
+        pending=collections.deque()
+        start=time.time()
+
+        try:
+            for index, record in enumerate(records):
+                pending.append(pool.submit(self._save, index, record))
+
+                if len(pending) >= self._max_pending:
+                    self._finish(pending.popleft().result(), stats, report)
+
+            while len(pending) > 0:
+                self._finish(pending.popleft().result(), stats, report)
+        finally:
+            pool.shutdown(wait=False)
+
+        stats['seconds']=time.time() - start
+        stats['records_per_second']=stats['records'] / stats['seconds'] if stats['seconds'] > 0 else None
+
+        return stats
+
+    def write_file(self, path, report=None):
+        """
+        Write the records of a newline delimited JSON file, which is
+        read as gzip compressed if its name ends with '.gz'. Lines that
+        are not valid JSON are reported as failed records.
+        """
+        with (gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')) as f:
+            records=(self._parse_line(line) for line in f if line.strip())
+            return self.write(records, report)
+
+    def _parse_line(self, line):
+        try:
+            return json.loads(line.decode('utf-8'))
+        except ValueError as e:
+            # Passed on as the record, so it fails on its own instead of ending the run
+            return e
+
+    def _save(self, index, record):
+        client=self._api.get_client()
+        outcome={'index':index, 'status':'ok', 'error_code':None, 'message':None, 'attempts':0}
+
+        while True:
+            outcome['attempts']+=1
+
+            try:
+                if isinstance(record, ValueError):
+                    raise record
+
+                result=client.call(self._api._version, self._service, self._method, record)
+            except UserAppServiceException as e:
+                outcome.update(status='error', error_code=e.error_code, message=str(e))
+            except UserAppTransportException as e:
+                if outcome['attempts'] < self._max_attempts and RetryPolicy.is_retryable(self._method, e):
+                    time.sleep(random.uniform(0, self._backoff * (2 ** (outcome['attempts'] - 1))))
+                    continue
+
+                outcome.update(status='transport_error', error_code=e.__class__.__name__, message=str(e))
+            except Exception as e:
+                outcome.update(status='error', error_code=e.__class__.__name__, message=str(e))
+            else:
+                # When the client does not throw errors they come back as results
+                if isinstance(result, IterableObject) and 'error_code' in result:
+                    outcome.update(status='error', error_code=result.error_code, message=result.source.get('message'))
+
+            return outcome
+
+    def _finish(self, outcome, stats, report):
+        stats['records']+=1
+        stats['retries']+=outcome['attempts'] - 1
+
+        if outcome['status'] == 'ok':
+            stats['succeeded']+=1
+        else:
+            stats['failed']+=1
+            stats['error_codes'][outcome['error_code']]=stats['error_codes'].get(outcome['error_code'], 0) + 1
+
+        if report is not None:
+            report.write(json.dumps(outcome)+'\n')
+
+class BatchQueue(object):
+    """
+    Stands in for a client while calls are being queued in a batch.
+    """
+    def __init__(self):
+        self.calls = []
+
+    def call(self, version, service, method, arguments, timeout=None):
+        future = Future()
+        self.calls.append((future, (version, service, method, arguments, timeout)))
+        return future
+
+class Batch(ClientProxy):
+    """
+    Proxies calls into a queue which is dispatched concurrently over a
+    bounded pool of workers, either explicitly with execute() or when
+    leaving the batch context. Proxied calls return futures.
+    """
+    def __init__(self, client, version=1, max_workers=8):
+        ClientProxy.__init__(self, client=BatchQueue(), version=version)
+        self._target=client
+        self._max_workers=max_workers
+        self._results=None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.execute()
+            return
+
+        # Queued calls are not dispatched, fail them so waiting for them does not block
+        calls = self._client.calls
+        self._client.calls = []
+
+        for future, arguments in calls:
+            future.set_exception(exc_value)
+
+    def queue(self, version, service, method, arguments, timeout=None):
+        return self._client.call(version, service, method, arguments, timeout)
+
+    def execute(self):
+        """
+        Dispatch all queued calls and wait for them to finish. Returns
+        results, or the raised exception, in submission order.
+        """
+        calls = self._client.calls
+        self._client.calls = []
+
+        pool = WorkerPool(min(self._max_workers, max(len(calls), 1)))
+
+        try:
+            pending = [(future, pool.submit(self._target.call, *arguments)) for future, arguments in calls]
+
+            for future, result in pending:
+                exception = result.exception()
+                if exception is None:
+                    future.set_result(result.result())
+                else:
+                    future.set_exception(exception)
+        finally:
+            pool.shutdown(wait=False)
+
+        self._results = [future.exception() or future.result() for future, arguments in calls]
+
+        return self._results
+
+    @property
+    def results(self):
+        return self._results
+
+class ClientPool(object):
+    """
+    Hands out API handles per app id and token, all sharing the
+    transport and options of a template API. The least recently
+    used handles are dropped once max_clients are kept.
+    """
+    shared_options = ['base_address','secure','lazy_responses','cache','user_snapshots','timeout','hedging','retry',
+        'circuit_breaker','rate_limiter','hooks','trace_sample_rate','trace_max_body','single_flight'] + Client._transport_options
+
+    def __init__(self, api, max_clients=1000):
+        if max_clients < 1:
+            raise ValueError("max_clients must be at least 1.")
+
+        self._api = api
+        self._max_clients = max_clients
+        self._handles = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'created':0, 'reused':0, 'evictions':0}
+
+    def get(self, app_id, token=""):
+        key = (app_id, token)
+
+        with self._lock:
+            handle = self._handles.pop(key, None)
+
+            if handle is None:
+                handle = self._create(app_id, token)
+                self._stats['created'] += 1
+            else:
+                self._stats['reused'] += 1
+
+            self._handles[key] = handle
+
+            if len(self._handles) > self._max_clients:
+                self._handles.popitem(last=False)
+                self._stats['evictions'] += 1
+
+        return handle
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['clients'] = len(self._handles)
+
+        return stats
+
+    def _create(self, app_id, token):
+        template = self._api.get_client()
+        options = dict((name, getattr(template, '_'+name)) for name in self.shared_options)
+
+        client = template.__class__(
+            app_id,
+            token,
+            throw_errors=template._throw_errors,
+            logger=template.get_logger(),
+            transport=template._transport,
+            **options
+        )
+
+        return self._api.__class__(client=client, version=self._api._version, schema=self._api._schema)
+
 class API(ClientProxy):
     """
     Wraps the UserApp API for ease of access.
@@ -382,4 +3794,22 @@ class API(ClientProxy):
         if API.instance is None:
             API.instance=API(**kwargs)
 
-        return API.instance
\ No newline at end of file
+        return API.instance
+
+    # Only on the root, as api.user.has_permission() is the remote user.hasPermission
+    def has_permission(self, permission, user_id='self'):
+        return self._client.has_permission(permission, user_id=user_id, version=self._version)
+
+    def has_feature(self, feature, user_id='self'):
+        return self._client.has_feature(feature, user_id=user_id, version=self._version)
+
+if sys.version_info >= (3, 7):
+    # asyncio is only imported once the async client is first used
+    def __getattr__(name):
+        if name in ('AsyncAPI', 'AsyncClient', 'AsyncNativeTransport'):
+            import userapp.aio
+            return getattr(userapp.aio, name)
+
+        raise AttributeError("module '{m}' has no attribute '{n}'".format(m=__name__, n=name))
+elif sys.version_info >= (3, 5):
+    from userapp.aio import AsyncAPI, AsyncClient, AsyncNativeTransport
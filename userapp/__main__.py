@@ -0,0 +1,104 @@
+""" Command line tools for the UserApp API, i.e. python -m userapp export users.ndjson.gz """
+
+import os
+import sys
+import argparse
+
+import userapp
+
+def create_api(options, retry=None):
+    return userapp.API(
+        app_id=options.app_id,
+        token=options.token,
+        base_address=options.base_address,
+        secure=not options.insecure,
+        retry=retry
+    )
+
+def export(options):
+    api = create_api(options, retry=True)
+    exporter = userapp.UserExporter(api, page_size=options.page_size, parallel=options.parallel, fields=options.fields)
+
+    try:
+        stats = exporter.export(options.path, compress=True if options.gzip else None, resume=not options.restart)
+    finally:
+        api.close()
+
+    if stats['resumed_from'] is not None:
+        print("Resumed from page {p}.".format(p=stats['resumed_from']))
+
+    print("Exported {u} users in {p} pages to {f}.".format(u=stats['users'], p=stats['pages'], f=options.path))
+
+def write(options):
+    # The writer retries failed records itself
+    api = create_api(options)
+    writer = userapp.BulkWriter(api, method=options.method, max_workers=options.workers)
+    report = open(options.report, 'w') if options.report else None
+
+    try:
+        stats = writer.write_file(options.path, report=report)
+    finally:
+        api.close()
+
+        if report is not None:
+            report.close()
+
+    print("Wrote {s} of {r} records in {t:.1f}s ({p:.0f} records/s), {f} failed.".format(
+        s=stats['succeeded'],
+        r=stats['records'],
+        t=stats['seconds'],
+        p=stats['records_per_second'] or 0,
+        f=stats['failed']
+    ))
+
+    for error_code, count in sorted(stats['error_codes'].items()):
+        print("  {e}: {c}".format(e=error_code, c=count))
+
+    return 0 if stats['failed'] == 0 else 1
+
+def create_parser():
+    parser = argparse.ArgumentParser(prog='python -m userapp', description="Command line tools for the UserApp API.")
+    parser.add_argument('--app-id', default=os.environ.get('USERAPP_APP_ID'), help="App to authenticate against. Default: $USERAPP_APP_ID.")
+    parser.add_argument('--token', default=os.environ.get('USERAPP_TOKEN', ''), help="Token to authenticate with. Default: $USERAPP_TOKEN.")
+    parser.add_argument('--base-address', default='api.userapp.io', help="The address to call against. Default: api.userapp.io.")
+    parser.add_argument('--insecure', action='store_true', help="Call the API over HTTP instead of HTTPS.")
+
+    commands = parser.add_subparsers(dest='command')
+
+    export_parser = commands.add_parser('export', help="Export all users as newline delimited JSON.")
+    export_parser.add_argument('path', help="File to write to, gzip compressed if it ends with .gz.")
+    export_parser.add_argument('--gzip', action='store_true', help="Compress the output regardless of its name.")
+    export_parser.add_argument('--page-size', type=int, default=100, help="Users fetched per call. Default: 100.")
+    export_parser.add_argument('--parallel', type=int, default=4, help="Pages fetched concurrently. Default: 4.")
+    export_parser.add_argument('--fields', nargs='+', help="Only export these user fields.")
+    export_parser.add_argument('--restart', action='store_true', help="Ignore any checkpoint and export from the start.")
+    export_parser.set_defaults(handler=export)
+
+    write_parser = commands.add_parser('write', help="Save records from a newline delimited JSON file, i.e. with user.save.")
+    write_parser.add_argument('path', help="File to read records from, gzip compressed if it ends with .gz.")
+    write_parser.add_argument('--method', default='user.save', help="Method to call with each record. Default: user.save.")
+    write_parser.add_argument('--workers', type=int, default=8, help="Concurrent calls. Default: 8.")
+    write_parser.add_argument('--report', help="File to write the outcome of each record to, as newline delimited JSON.")
+    write_parser.set_defaults(handler=write)
+
+    return parser
+
+def main(args=None):
+    parser = create_parser()
+    options = parser.parse_args(args)
+
+    if not getattr(options, 'handler', None):
+        parser.print_help()
+        return 2
+
+    if not options.app_id:
+        parser.error("An app id is required, pass --app-id or set USERAPP_APP_ID.")
+
+    try:
+        return options.handler(options) or 0
+    except userapp.UserAppException as e:
+        sys.stderr.write("Error: {e}\n".format(e=e))
+        return 1
+
+if __name__ == '__main__':
+    sys.exit(main())
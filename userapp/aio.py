@@ -0,0 +1,465 @@
+""" Asyncio client for the UserApp API (Python 3.5+). """
+
+import ssl
+import json
+import time
+import asyncio
+
+from urllib.parse import urlsplit
+
+from userapp import Client, ClientProxy, UserSnapshots, JsonCodec, Compression, UserAppException, UserAppTransportException, UserAppConnectionException, UserAppTimeoutException, UserAppInvalidOptionException
+
+class AsyncResponse(object):
+    """
+    A fully read HTTP response, exposing the same surface
+    as the requests response used by the sync client.
+    """
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return json.loads(self.text)
+
+class AsyncConnection(object):
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.time()
+
+    def close(self):
+        self.writer.close()
+
+class AsyncNativeTransport(object):
+    """
+    Asyncio HTTP/1.1 transport that keeps connections
+    alive in a per-host pool between calls.
+    """
+    def __init__(self, logger, pool_max_connections=10, pool_idle_timeout=None, connect_timeout=None, read_timeout=None, codec=None, compression=None):
+        self._logger = logger
+        self._codec = codec if not codec is None else JsonCodec()
+        self._compression = compression
+        self._pool_max_connections = pool_max_connections
+        self._pool_idle_timeout = pool_idle_timeout
+        self._connect_timeout = connect_timeout
+        self._read_timeout = read_timeout
+        self._idle = {}
+        self._limits = {}
+        self._stats = {'connections_created':0, 'connections_reused':0, 'requests':0, 'evictions':0}
+
+    async def call(self, method, url, headers=None, body=None):
+        if headers is None:
+            headers={}
+
+        if 'Content-Type' in headers:
+            if headers['Content-Type'] == 'application/json':
+
+                body=self._codec.dumps(body)
+
+        if self._compression is not None:
+            headers, body = self._compression.prepare(headers, body)
+
+        if method != 'post':
+            raise UserAppTransportException("Method {m} not supported.".format(m=method))
+
+        target = urlsplit(url)
+        secure = target.scheme == 'https'
+        host = target.hostname
+        port = target.port or (443 if secure else 80)
+        key = (secure, host, port)
+
+        payload = body.encode('utf-8') if isinstance(body, str) else (body or b'')
+        request = self._format_request(target, headers, payload)
+
+        if not key in self._limits:
+            self._limits[key] = asyncio.Semaphore(self._pool_max_connections)
+
+        async with self._limits[key]:
+            connection, reused = self._checkout(key)
+
+            if connection is None:
+                connection = await self._connect(secure, host, port)
+
+            try:
+                try:
+                    response, keep_alive = await self._send(connection, request)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    connection.close()
+
+                    # A pooled connection may have been closed by the server while idle
+                    if not reused:
+                        raise UserAppTransportException("Connection to {h}:{p} was closed.".format(h=host, p=port))
+
+                    connection = await self._connect(secure, host, port)
+                    response, keep_alive = await self._send(connection, request)
+            except BaseException as e:
+                # Also when the call is cancelled on timeout, as the connection is left mid response
+                connection.close()
+
+                if isinstance(e, (OSError, ValueError, asyncio.IncompleteReadError)):
+                    raise UserAppTransportException("Invalid response from {h}:{p}: {e}".format(h=host, p=port, e=e))
+
+                raise
+
+            self._stats['requests'] += 1
+
+            if keep_alive:
+                connection.last_used = time.time()
+                self._idle.setdefault(key, []).append(connection)
+            else:
+                connection.close()
+
+        return response
+
+    def configure(self, **options):
+        for name, value in options.items():
+            setattr(self, '_'+name, value)
+
+    def get_pool_stats(self):
+        stats = dict(self._stats)
+        stats['connections_open'] = sum(len(connections) for connections in self._idle.values())
+        return stats
+
+    async def close(self):
+        for connections in self._idle.values():
+            for connection in connections:
+                connection.close()
+
+        self._idle = {}
+
+    def _checkout(self, key):
+        connections = self._idle.get(key, [])
+        now = time.time()
+
+        while len(connections) > 0:
+            connection = connections.pop()
+
+            if self._pool_idle_timeout is not None and now - connection.last_used > self._pool_idle_timeout:
+                connection.close()
+                self._stats['evictions'] += 1
+                continue
+
+            self._stats['connections_reused'] += 1
+            return connection, True
+
+        return None, False
+
+    async def _connect(self, secure, host, port):
+        context = ssl.create_default_context() if secure else None
+
+        try:
+            reader, writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port, ssl=context),
+                self._connect_timeout
+            )
+        except asyncio.TimeoutError:
+            raise UserAppTimeoutException("Timed out connecting to {h}:{p}.".format(h=host, p=port))
+        except OSError as e:
+            raise UserAppConnectionException("Could not connect to {h}:{p}: {e}".format(h=host, p=port, e=e))
+
+        self._stats['connections_created'] += 1
+
+        return AsyncConnection(reader, writer)
+
+    async def _send(self, connection, request):
+        connection.writer.write(request)
+
+        try:
+            return await asyncio.wait_for(self._read_response(connection.reader), self._read_timeout)
+        except asyncio.TimeoutError:
+            connection.close()
+            raise UserAppTimeoutException("Timed out waiting for response.")
+
+    async def _read_response(self, reader):
+        status_line = await reader.readline()
+
+        if not status_line:
+            raise ConnectionError("Connection closed by server.")
+
+        version, status_code = status_line.decode('latin-1').split(None, 2)[:2]
+        headers = {}
+
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = headers.get('connection', '').lower() != 'close' and version != 'HTTP/1.0'
+
+        if headers.get('transfer-encoding', '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size == 0:
+                    await reader.readline()
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            content = b''.join(chunks)
+        elif 'content-length' in headers:
+            content = await reader.readexactly(int(headers['content-length']))
+        else:
+            content = await reader.read()
+            keep_alive = False
+
+        encoding = headers.get('content-encoding')
+
+        if Compression.create_decompressor(encoding) is not None:
+            received = len(content)
+            content = Compression.decompress(encoding, content)
+
+            if self._compression is not None:
+                self._compression.record_response(received, len(content))
+
+        return AsyncResponse(int(status_code), headers, content), keep_alive
+
+    def _format_request(self, target, headers, payload):
+        path = target.path or '/'
+        if target.query:
+            path += '?' + target.query
+
+        lines = ['POST {p} HTTP/1.1'.format(p=path), 'Host: {h}'.format(h=target.netloc)]
+        lines.extend('{n}: {v}'.format(n=name, v=value) for name, value in headers.items())
+        lines.append('Content-Length: {l}'.format(l=len(payload)))
+        lines.append('Connection: keep-alive')
+
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + payload
+
+class AsyncClient(Client):
+    """
+    Handles communication with the UserApp API without blocking the event loop.
+    """
+    def __init__(self, *args, **kwargs):
+        if kwargs.get('hedging') is not None:
+            raise UserAppInvalidOptionException("Option hedging is not supported by the asyncio client.")
+
+        Client.__init__(self, *args, **kwargs)
+
+    def set_option(self, name, value):
+        if name == 'hedging' and value is not None:
+            raise UserAppInvalidOptionException("Option hedging is not supported by the asyncio client.")
+
+        Client.set_option(self, name, value)
+
+    def _create_transport(self):
+        return AsyncNativeTransport(
+            self._logger,
+            pool_max_connections=self._pool_max_connections,
+            pool_idle_timeout=self._pool_idle_timeout,
+            connect_timeout=self._connect_timeout,
+            read_timeout=self._read_timeout,
+            codec=self._codec,
+            compression=self._compression
+        )
+
+    async def call(self, version, service, method, arguments, timeout=None):
+        if not self._hooks:
+            return await self._call(version, service, method, arguments, timeout, None)
+
+        context = self._start_call(version, service, method, arguments)
+
+        try:
+            result = await self._call(version, service, method, arguments, timeout, context)
+        except Exception as e:
+            self._fail_call(context, e)
+            raise
+
+        return self._finish_call(context, result)
+
+    async def _call(self, version, service, method, arguments, timeout, context):
+        cache_key, result = self._get_cached(version, service, method, arguments)
+
+        if result is not None:
+            if context is not None:
+                context.cached = True
+            # A snapshot refresh may be served from the cache as well
+            self._update_snapshots(service, method, arguments, result)
+            return result
+
+        target_url, headers = self._prepare_call(version, service, method)
+        timeout = timeout if not timeout is None else self._timeout
+        traced = self._tracer.should_trace()
+
+        if traced:
+            self._tracer.trace_request('post', target_url, headers, arguments)
+
+        async def send_once(timeout=timeout):
+            if self._rate_limiter is not None:
+                entry = self._rate_limiter.enqueue(self._app_id, service, method)
+                wait = self._rate_limiter.try_acquire(entry)
+
+                try:
+                    while wait is not None:
+                        await asyncio.sleep(wait)
+                        wait = self._rate_limiter.try_acquire(entry)
+                except asyncio.CancelledError:
+                    self._rate_limiter.cancel(entry)
+                    raise
+
+            try:
+                response = await asyncio.wait_for(self._transport.call(
+                    'post',
+                    url=target_url,
+                    headers=headers,
+                    body=arguments
+                ), timeout)
+            except asyncio.TimeoutError:
+                raise UserAppTimeoutException("Call to {s}.{m} did not complete within {t} seconds.".format(s=service, m=method, t=timeout))
+
+            self._check_response(response)
+
+            return response
+
+        async def send():
+            attempt = 1
+            # Retries share the timeout of the call rather than getting one each
+            deadline = None if timeout is None else time.time() + timeout
+
+            if self._retry is not None:
+                self._retry.record_call()
+
+            while True:
+                remaining = None if deadline is None else deadline - time.time()
+
+                try:
+                    return await self._attempt(lambda: send_once(remaining))
+                except UserAppTransportException as e:
+                    backoff = None if self._retry is None else self._retry.get_backoff(method, e, attempt)
+
+                    if backoff is None or deadline is not None and time.time() + backoff >= deadline:
+                        raise
+
+                    await asyncio.sleep(backoff)
+                    attempt += 1
+
+        flight_key = None
+
+        if self._single_flight is not None:
+            flight_key = self._single_flight.get_key(self._app_id, self._get_token(), version, service, method, arguments)
+
+        if flight_key is None:
+            response = await send()
+        else:
+            response = await self._send_coalesced(flight_key, send, timeout)
+
+        if traced:
+            self._tracer.trace_response(response)
+
+        result = self._handle_response(service, method, response, context)
+        self._update_cache(cache_key, service, method, arguments, response, result)
+        self._update_snapshots(service, method, arguments, result)
+
+        return result
+
+    def paginate(self, version, service, method, arguments, page_size=100, parallel=1):
+        raise UserAppException("Iterating results is not supported by the asyncio client.")
+
+    def batch(self, version, max_workers=8):
+        # Calls are made concurrently with asyncio.gather() instead
+        raise UserAppException("Batches are not supported by the asyncio client.")
+
+    def stream(self, version, service, method, arguments, timeout=None):
+        raise UserAppException("Streaming results is not supported by the asyncio client.")
+
+    async def _send_coalesced(self, key, send, timeout):
+        future, leader = self._single_flight.join(key, asyncio.get_event_loop().create_future)
+
+        if not leader:
+            try:
+                return await asyncio.wait_for(asyncio.shield(future), timeout)
+            except asyncio.TimeoutError:
+                raise UserAppTimeoutException("Call did not complete within {t} seconds.".format(t=timeout))
+
+        try:
+            response = await send()
+        except asyncio.CancelledError:
+            self._single_flight.leave(key, future, exception=UserAppTransportException("Call was cancelled."))
+            future.exception()
+            raise
+        except Exception as e:
+            self._single_flight.leave(key, future, exception=e)
+            # Followers re-raise the exception, do not log it as unretrieved
+            future.exception()
+            raise
+
+        self._single_flight.leave(key, future, response=response)
+
+        return response
+
+    async def _attempt(self, send):
+        if self._circuit_breaker is None:
+            return await send()
+
+        self._circuit_breaker.before_call(self._base_address)
+
+        try:
+            response = await send()
+        except UserAppTransportException:
+            self._circuit_breaker.record_failure(self._base_address)
+            raise
+        except BaseException:
+            # Other errors say nothing about the host, but a trial must not stay pending
+            self._circuit_breaker.record_failure(self._base_address, trial_only=True)
+            raise
+
+        self._circuit_breaker.record_success(self._base_address)
+
+        return response
+
+    async def _check_flags(self, kind, remote_method, argument, names, user_id, version):
+        names = names if isinstance(names, list) else [names]
+        snapshots = self._user_snapshots
+
+        if snapshots is None:
+            snapshots = self._user_snapshots = UserSnapshots()
+
+        snapshot = snapshots.get(self._app_id, self._get_token(), user_id)
+
+        if snapshot is None:
+            snapshots.count('refreshes')
+            await self.call(version, 'user', 'get', {'user_id':user_id})
+            snapshot = snapshots.get(self._app_id, self._get_token(), user_id)
+
+        if snapshot is not None:
+            snapshots.count('local_checks')
+            return all(snapshot[kind].get(name, False) for name in names)
+
+        snapshots.count('remote_checks')
+        result = await self.call(version, 'user', remote_method, {'user_id':user_id, argument:names})
+
+        return len(getattr(result, 'missing_'+kind, [])) == 0
+
+    async def close(self):
+        if hasattr(self._transport, 'close'):
+            await self._transport.close()
+
+class AsyncAPI(ClientProxy):
+    """
+    Wraps the UserApp API for ease of access, returning awaitables.
+    """
+    _client_class=AsyncClient
+
+    instance=None
+
+    def __init__(self, *args, **kwargs):
+        ClientProxy.__init__(self, *args, **kwargs)
+
+    @staticmethod
+    def get_instance(**kwargs):
+        if AsyncAPI.instance is None:
+            AsyncAPI.instance=AsyncAPI(**kwargs)
+
+        return AsyncAPI.instance
+
+    def has_permission(self, permission, user_id='self'):
+        return self._client.has_permission(permission, user_id=user_id, version=self._version)
+
+    def has_feature(self, feature, user_id='self'):
+        return self._client.has_feature(feature, user_id=user_id, version=self._version)
@@ -0,0 +1,17 @@
+""" Services and methods of the UserApp API per version, bundled for generating stubs. See userapp.ServiceSchema. """
+
+services = {
+    '1': {
+        'user': ['login', 'logout', 'save', 'get', 'search', 'remove', 'count', 'resetPassword', 'changePassword',
+            'verifyEmail', 'hasPermission', 'hasFeature', 'lock', 'unlock'],
+        'user.paymentMethod': ['save', 'get', 'search', 'remove'],
+        'user.invoice': ['get', 'search'],
+        'token': ['save', 'get', 'search', 'remove', 'count', 'heartbeat'],
+        'permission': ['save', 'get', 'search', 'remove', 'count'],
+        'feature': ['save', 'get', 'search', 'remove', 'count'],
+        'property': ['save', 'get', 'search', 'remove', 'count'],
+        'plan': ['save', 'get', 'search', 'remove', 'count'],
+        'priceList': ['save', 'get', 'search', 'remove', 'count'],
+        'oauth': ['getAuthorizationUrl', 'getAccessToken']
+    }
+}